@@ -0,0 +1,43 @@
+"""
+Decoding status streams: stdlib json against cassini.codec
+
+Before cassini.codec, a status payload was decoded to str and parsed with json.loads, once in
+the MQTT server and once more in SaturnPrinter. Now it is parsed once, from bytes, with orjson
+or msgspec when installed (the ``fast`` extra).
+
+    python -m benchmarks.bench_codec [capture file]
+"""
+
+import json
+import sys
+from pathlib import Path
+
+from cassini import codec
+
+from .common import best_of, status_stream
+
+
+def main():
+    stream = status_stream(Path(sys.argv[1]) if len(sys.argv) > 1 else None)
+    if not stream:
+        sys.exit("No status messages in the capture")
+
+    def before():
+        for payload in stream:
+            text = payload.decode("utf-8")
+            json.loads(text)
+            json.loads(text)
+
+    def after():
+        for payload in stream:
+            codec.loads(payload)
+
+    baseline = best_of(before)
+    current = best_of(after)
+    print(f"{len(stream)} status messages, codec backend: {codec.BACKEND}")
+    print(f"decode twice with json: {len(stream) / baseline:12,.0f} msg/s")
+    print(f"decode once with codec: {len(stream) / current:12,.0f} msg/s ({baseline / current:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
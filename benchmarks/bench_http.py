@@ -0,0 +1,90 @@
+"""
+File serving throughput with HTTP worker processes and uvloop
+
+Simulated printers (one process each, so that the clients don't compete with the server for
+the event loop) download the same file from the HTTP server at once, with the server on the
+default event loop and on uvloop, and with 0 or more extra SO_REUSEPORT worker processes.
+
+    python -m benchmarks.bench_http [printers] [file size in MiB]
+"""
+
+import asyncio
+import http.client
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from cassini.loop import reuse_port_supported, use_uvloop
+from cassini.servers import create_http_server
+
+DOWNLOADS_PER_PRINTER = 3
+READ_SIZE = 1 << 20
+
+
+# Download path downloads times, as a printer would; returns the bytes received
+def download(port: int, path: str, downloads: int) -> int:
+    received = 0
+    for _ in range(downloads):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        conn.request("GET", path)
+        response = conn.getresponse()
+        while data := response.read(READ_SIZE):
+            received += len(data)
+        conn.close()
+    return received
+
+
+async def serve(filename: Path, printers: int, workers: int) -> float:
+    http, *_ = await create_http_server(workers=workers)
+    path, _ = await http.acquire_file(filename, "goo")
+    await http.routes_ready()
+    loop = asyncio.get_running_loop()
+    try:
+        with ProcessPoolExecutor(printers) as clients:
+            # start the client processes before the clock does
+            await asyncio.gather(*(loop.run_in_executor(clients, time.sleep, 0.1) for _ in range(printers)))
+            started = time.perf_counter()
+            received = await asyncio.gather(
+                *(
+                    loop.run_in_executor(clients, download, http.port, path, DOWNLOADS_PER_PRINTER)
+                    for _ in range(printers)
+                )
+            )
+            elapsed = time.perf_counter() - started
+    finally:
+        http.release_file(path)
+        await http.close()
+    return sum(received) / elapsed
+
+
+def main():
+    printers = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 64  # noqa: PLR2004
+    workers = [0, 1, 3] if reuse_port_supported() else [0]
+    loops = ["asyncio"]
+    if importlib.util.find_spec("uvloop") is not None:
+        loops.append("uvloop")
+    else:
+        print("uvloop is not installed, only measuring the default event loop")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = Path(tmp) / "cube.goo"
+        filename.write_bytes(os.urandom(size * 1024 * 1024))
+        print(f"{printers} printers downloading {size} MiB {DOWNLOADS_PER_PRINTER} times each, {os.cpu_count()} CPUs")
+        for loop_name in loops:
+            for count in workers:
+                if loop_name == "uvloop":
+                    use_uvloop()
+                try:
+                    rate = asyncio.run(serve(filename, printers, count))
+                finally:
+                    asyncio.set_event_loop_policy(None)
+                print(f"{loop_name:>8}, {count} extra workers: {rate / 1024 / 1024:8.0f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Cost of debug logging on the per-message paths when debug logging is off
+
+Compares handling a status message with no logging at all, with the eager f-string the status
+path used to log, and with the lazy call it uses now, with the log level at ERROR.
+
+    python -m benchmarks.bench_logging
+"""
+
+import sys
+
+from loguru import logger
+
+from cassini import codec
+from cassini.saturn_printer import SaturnPrinter
+
+from .common import best_of, status_message, status_stream
+
+
+def main():
+    logger.remove()
+    logger.add(sys.stderr, level="ERROR")
+    logger.enable("cassini")
+    stream = [codec.loads(payload)["Data"]["Status"] for payload in status_stream(count=50000)]
+    printer = SaturnPrinter(
+        desc={
+            "Id": "",
+            "Data": {
+                "Attributes": {"Name": "", "MachineName": "", "MainboardID": ""},
+                "Status": status_message("", 0)["Data"]["Status"],
+            },
+        }
+    )
+
+    def silent():
+        for status in stream:
+            printer.last_status = status
+
+    def eager():
+        for status in stream:
+            printer.last_status = status
+            logger.debug(f"STATUS: {status}")
+
+    def lazy():
+        for status in stream:
+            printer.incoming_status(status)
+
+    baseline = best_of(silent)
+    print(f"{len(stream)} status messages at ERROR level, per message:")
+    for name, func in (("no logging", silent), ("f-string", eager), ("incoming_status", lazy)):
+        elapsed = best_of(func)
+        print(f"{name:>16}: {elapsed / len(stream) * 1e9:8.0f} ns ({(elapsed - baseline) / len(stream) * 1e9:+.0f} ns)")
+
+
+if __name__ == "__main__":
+    main()
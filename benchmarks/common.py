@@ -0,0 +1,61 @@
+"""Shared helpers for the benchmarks"""
+
+import time
+from pathlib import Path
+
+from cassini import codec
+from cassini.capture import MQTT_IN, read_capture
+
+
+# A status message as a Saturn 3 Ultra sends it every few seconds while printing
+def status_message(printer_id: str, layer: int) -> dict:
+    return {
+        "Data": {
+            "Status": {
+                "CurrentStatus": 1,
+                "PreviousStatus": 0,
+                "PrintInfo": {
+                    "Status": 2,
+                    "CurrentLayer": layer,
+                    "TotalLayer": 1200,
+                    "CurrentTicks": layer * 9800,
+                    "TotalTicks": 11760000,
+                    "Filename": "ResinXP2-ValidationMatrix_v2.goo",
+                    "ErrorNumber": 0,
+                    "TaskId": "0a69ee780fbd40d7bfb95b312250bf46",
+                },
+                "FileTransferInfo": {
+                    "Status": 0,
+                    "DownloadOffset": 0,
+                    "CheckOffset": 0,
+                    "FileTotalSize": 0,
+                    "Filename": "",
+                },
+                "TempOfUVLED": 36.5,
+                "TimeLapseStatus": 0,
+                "TempOfBox": 28.2,
+                "TempTargetBox": 0,
+            },
+            "MainboardID": printer_id,
+            "TimeStamp": 1700000000 + layer * 10,
+        },
+        "Topic": f"sdcp/status/{printer_id}",
+    }
+
+
+# Status payloads to decode: the MQTT frames of a capture if one is given, or else a synthetic
+# stream of count messages from a few printers
+def status_stream(capture: Path | None = None, count: int = 20000) -> list[bytes]:
+    if capture is not None:
+        return [r.payload for r in read_capture(capture) if r.kind == MQTT_IN and "/sdcp/status/" in r.topic]
+    return [codec.dumps(status_message(f"PRINTER{i % 8:08d}", i // 8)) for i in range(count)]
+
+
+# Best of repeats runs of func, in seconds
+def best_of(func, repeats: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
@@ -19,6 +19,7 @@ nox.options.sessions = (
 locations = (
     "src",
     "tests",
+    "benchmarks",
 )
 
 
@@ -51,6 +52,15 @@ def tests(session: nox.Session) -> None:
     )
 
 
+@nox.session(python="3.10")
+def benchmarks(session: nox.Session) -> None:
+    """Run the benchmarks, with the fast and analytics extras."""
+    # -G selects optional-dependency groups (extras) as well as dependency groups
+    session.run_always("pdm", "install", "--frozen-lockfile", "--dev", "-G", "fast", "-G", "analytics", external=True)
+    for benchmark in sorted(Path("benchmarks").glob("bench_*.py")):
+        session.run("python", "-m", f"benchmarks.{benchmark.stem}", external=True)
+
+
 @nox.session(python="3.10")
 def coverage(session: nox.Session) -> None:
     """Produce the coverage report."""
@@ -0,0 +1,267 @@
+"""
+Asyncio API for printers and fleets
+
+``SaturnEndpoint`` (in ``cassini.saturn_printer``, whose blocking ``refresh`` and
+``refresh_all`` run on it too) is a single asyncio datagram endpoint that does UDP discovery
+and status for any number of printers, matching answers to printers by address, so refreshing
+hundreds of printers costs one socket and no threads. ``AsyncSaturnPrinter`` wraps a
+``SaturnPrinter`` with coroutines for everything, and ``AsyncFleet`` discovers, refreshes
+and drives many of them from one event loop, keeping their connections in a
+``SessionPool``.
+
+``Fleet`` is the blocking facade for callers without an event loop of their own (such as
+the RPP web server): it runs an ``AsyncFleet`` on an event loop in a background thread, so
+any number of threads can call into it, and ``submit`` starts an operation without waiting
+for it.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+from pathlib import Path
+from typing import Final
+
+from loguru import logger
+
+from cassini.discovery import broadcast_addresses
+from cassini.exceptions import CommandError, PrintError, UploadError
+from cassini.saturn_printer import SaturnEndpoint, SaturnPrinter
+from cassini.sessions import SessionPool
+
+# times a printer that dropped its connection during an upload is reconnected to try again
+RECONNECT_ATTEMPTS: Final[int] = 1
+
+
+class AsyncSaturnPrinter:
+    def __init__(self, printer: SaturnPrinter, endpoint: SaturnEndpoint):
+        self.printer = printer
+        self.endpoint = endpoint
+
+    @property
+    def id(self):
+        return self.printer.id
+
+    @property
+    def name(self):
+        return self.printer.name
+
+    @property
+    def addr(self):
+        return self.printer.addr
+
+    @property
+    def desc(self):
+        return self.printer.desc
+
+    def describe(self):
+        return self.printer.describe()
+
+    async def refresh(self, timeout=5) -> bool:
+        return bool(await self.endpoint.refresh([self.printer], timeout))
+
+    async def status(self, timeout=5) -> dict:
+        if not await self.refresh(timeout):
+            logger.warning(f"{self.describe()}: using the last known status")
+        return self.printer.summary()
+
+    async def connect(self, mqtt, http) -> bool:
+        return await self.printer.connect(mqtt, http)
+
+    async def disconnect(self):
+        await self.printer.disconnect()
+
+    async def upload_file(self, filename, compress=False, progress=None):
+        return await self.printer.upload_file(filename, compress=compress, progress=progress)
+
+    def upload_progress(self, filename, compress=False):
+        return self.printer.upload_progress(filename, compress=compress)
+
+    async def print_file(self, filename) -> bool:
+        return await self.printer.print_file(filename)
+
+    async def wait_for_status(self, predicate, timeout=None):
+        return await self.printer.wait_for_status(predicate, timeout=timeout)
+
+    # Spoofs a UDP packet with scapy, which blocks, so it runs in a thread
+    async def connect_mqtt(self, mqtt_host, mqtt_port):
+        await asyncio.to_thread(self.printer.connect_mqtt, mqtt_host, mqtt_port)
+
+
+class AsyncFleet:
+    def __init__(self, timeout=5, broker=None, history=None, http_host=None):
+        self.timeout = timeout
+        self.broker = broker
+        self.history = history
+        self.endpoint = SaturnEndpoint()
+        # MainboardID -> printer
+        self.printers: dict[str, AsyncSaturnPrinter] = {}
+        self.pool = SessionPool(broker=broker, http_host=http_host)
+
+    async def open(self):
+        await self.endpoint.open()
+        return self
+
+    async def close(self):
+        await self.pool.close()
+        self.endpoint.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    def __iter__(self):
+        return iter(list(self.printers.values()))
+
+    def __len__(self):
+        return len(self.printers)
+
+    def get(self, printer_id) -> AsyncSaturnPrinter | None:
+        return self.printers.get(printer_id)
+
+    def add(self, addr, desc) -> AsyncSaturnPrinter:
+        printer_id = desc["Data"]["Attributes"]["MainboardID"]
+        if (printer := self.printers.get(printer_id)) is not None:
+            printer.printer.addr = addr
+            printer.printer.set_desc(desc)
+            return printer
+        printer = AsyncSaturnPrinter(
+            SaturnPrinter(addr, desc, timeout=self.timeout, history=self.history), self.endpoint
+        )
+        self.printers[printer_id] = printer
+        return printer
+
+    # broadcast can be a single address or a list of them; by default that's the broadcast address
+    # of every local interface
+    async def discover(self, timeout=1, broadcast=None, limit=None) -> list[AsyncSaturnPrinter]:
+        if broadcast is None:
+            broadcast = await asyncio.to_thread(broadcast_addresses)
+        elif isinstance(broadcast, str):
+            broadcast = [broadcast]
+        found = await self.endpoint.discover(broadcast, timeout=timeout, limit=limit)
+        return [self.add(addr, desc) for addr, desc in found]
+
+    async def find_printer(self, addr: str, timeout=1) -> AsyncSaturnPrinter | None:
+        found = await self.endpoint.discover([addr], timeout=timeout, limit=1)
+        if not found or found[0][0][0] != addr:
+            return None
+        return self.add(*found[0])
+
+    # Refresh the given printers (all by default) concurrently; returns the ones that answered
+    async def refresh(self, printers=None, timeout=1) -> list[AsyncSaturnPrinter]:
+        printers = list(self.printers.values()) if printers is None else printers
+        answered = await asyncio.gather(*(p.refresh(timeout) for p in printers))
+        return [p for p, ok in zip(printers, answered, strict=True) if ok]
+
+    async def statuses(self, timeout=1) -> dict[str, dict]:
+        await self.refresh(timeout=timeout)
+        return {p.id: p.printer.summary() for p in self.printers.values()}
+
+    # Connect a printer to this fleet's servers, unless its session is still up: all printers share
+    # the HTTP server, and each gets an MQTT server of its own unless they are driven through a broker
+    async def connect(self, printer: AsyncSaturnPrinter) -> bool:
+        try:
+            await self.pool.get(printer.printer)
+        except ConnectionError:
+            return False
+        return True
+
+    # progress is called with a TransferProgress for every status update during the transfer. Failed
+    # transfers are retried by SaturnPrinter.upload_file; if the printer dropped its connection, it
+    # is reconnected for one more go. Raises UploadError if the upload still fails.
+    async def upload(self, printer: AsyncSaturnPrinter, filename, compress=False, start_printing=False, progress=None):
+        for attempt in range(RECONNECT_ATTEMPTS + 1):
+            try:
+                async with self.pool.session(printer.printer, stage=filename, compress=compress) as session:
+                    result = await session.upload_file(filename, compress=compress, progress=progress)
+                    if start_printing:
+                        await self.start_print(session, Path(filename).name)
+                    return result
+            except UploadError as e:
+                if attempt == RECONNECT_ATTEMPTS or self.pool.attached(printer.printer):
+                    raise
+                logger.warning(f"{printer.describe()}: lost the connection during the upload, reconnecting ({e})")
+
+    async def print_file(self, printer: AsyncSaturnPrinter, filename):
+        async with self.pool.session(printer.printer) as session:
+            await self.start_print(session, filename)
+
+    async def start_print(self, session: SaturnPrinter, filename):
+        try:
+            started = await session.print_file(filename)
+        except CommandError as e:
+            raise PrintError(str(e)) from e
+        if not started:
+            msg = f"{session.describe()} did not start printing {filename}"
+            raise PrintError(msg)
+
+
+class Fleet:
+    def __init__(self, timeout=5, broker=None, history=None, http_host=None):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="cassini-fleet", daemon=True)
+        self.thread.start()
+        self.aio = AsyncFleet(timeout=timeout, broker=broker, history=history, http_host=http_host)
+        self.call(self.aio.open())
+
+    # Run a coroutine on the fleet's loop and wait for its result
+    def call(self, coro, timeout=None):
+        return self.submit(coro).result(timeout)
+
+    # Start a coroutine on the fleet's loop without waiting for it
+    def submit(self, coro) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self.call(self.shutdown())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    # The loop is ours alone, so whatever is still running on it (client connections of the
+    # servers, for one) can be cancelled
+    async def shutdown(self):
+        await self.aio.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.aio)
+
+    def get(self, printer_id) -> AsyncSaturnPrinter | None:
+        return self.aio.get(printer_id)
+
+    def discover(self, timeout=1, broadcast=None, limit=None) -> list[AsyncSaturnPrinter]:
+        return self.call(self.aio.discover(timeout=timeout, broadcast=broadcast, limit=limit))
+
+    def find_printer(self, addr: str, timeout=1) -> AsyncSaturnPrinter | None:
+        return self.call(self.aio.find_printer(addr, timeout=timeout))
+
+    def refresh(self, printers=None, timeout=1) -> list[AsyncSaturnPrinter]:
+        return self.call(self.aio.refresh(printers, timeout=timeout))
+
+    def status(self, printer: AsyncSaturnPrinter, timeout=5) -> dict:
+        return self.call(printer.status(timeout))
+
+    def statuses(self, timeout=1) -> dict[str, dict]:
+        return self.call(self.aio.statuses(timeout=timeout))
+
+    # progress is called on the fleet's thread
+    def upload(self, printer: AsyncSaturnPrinter, filename, compress=False, start_printing=False, progress=None):
+        return self.call(
+            self.aio.upload(printer, filename, compress=compress, start_printing=start_printing, progress=progress)
+        )
+
+    def print_file(self, printer: AsyncSaturnPrinter, filename):
+        return self.call(self.aio.print_file(printer, filename))
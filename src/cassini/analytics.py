@@ -0,0 +1,292 @@
+"""
+Fleet analytics over the status history
+
+Loads the layer counter of every printer in the status history into NumPy arrays and works
+out, for all of them at once:
+
+- how long each layer took (the time between layer changes, spread evenly over the layers
+  a printer advanced between two status messages) and how long the printer spent in the
+  ``EXPOSURE`` state on each layer, where the status messages show it;
+- when the current print will finish, from the median time of the most recent layers, so a
+  slow first layer or a single long lift doesn't throw the estimate off;
+- layers printed per hour of printing, finished prints and how much of the time the printer
+  was printing at all;
+- anomalies: a print whose layer counter hasn't moved for many times its usual layer time
+  (stalled), recent layers much slower than the rest of the print (slowdown), and single
+  layers that took far longer than usual.
+
+Per-layer times of all printers are stacked into one matrix, right-aligned and padded with
+NaN, so the medians and flags of the whole fleet come out of a handful of array operations.
+NumPy is only needed for this module (install the ``analytics`` extra).
+"""
+
+import importlib.util
+import math
+import time
+from typing import Final
+
+from cassini.history import (
+    FILENAME_FIELD,
+    FINISHED_PRINT_STATES,
+    LAYER_FIELD,
+    PRINT_STATUS_FIELD,
+    TOTAL_LAYERS_FIELD,
+    StatusHistory,
+)
+from cassini.saturn_printer import ACTIVE_PRINT_STATES, PrintInfoStatus
+
+# number of most recent layers the ETA is based on
+RECENT_LAYERS: Final[int] = 20
+# a layer counter that hasn't moved for this many usual layer times means the print is stalled
+STALL_FACTOR: Final[float] = 5.0
+# but never before this many seconds, as a printer may report status only every few seconds
+MIN_STALL_SECONDS: Final[float] = 60.0
+# recent layers this much slower than the print's median layer time are a slowdown
+SLOWDOWN_FACTOR: Final[float] = 1.5
+# single layers this much slower than the print's median layer time are reported
+SLOW_LAYER_FACTOR: Final[float] = 3.0
+# how far back watch looks for the start of the current print
+SEED_WINDOW: Final[float] = 48 * 3600.0
+
+
+def numpy_available() -> bool:
+    return importlib.util.find_spec("numpy") is not None
+
+
+def require_numpy():
+    try:
+        # imported here so commands that don't analyse anything don't pay for loading NumPy
+        import numpy as np  # noqa: PLC0415
+    except ImportError as e:
+        msg = "Fleet analytics need NumPy, install the analytics extra: pip install 'cassini[analytics]'"
+        raise ImportError(msg) from e
+    return np
+
+
+# Arrays of one printer's status history: timestamp, layer, total layers (NaN where unknown) and
+# print status (-1 where unknown), plus the filename of every row
+def load_series(history: StatusHistory, printer_id: str, start: float | None = None, end: float | None = None) -> dict:
+    np = require_numpy()
+    fields = [LAYER_FIELD, TOTAL_LAYERS_FIELD, PRINT_STATUS_FIELD, FILENAME_FIELD]
+    rows = history.series(printer_id, fields, start, end)
+    nan = float("nan")
+    return {
+        "ts": np.array([row[0] for row in rows], dtype=np.float64),
+        "layer": np.array([nan if row[1] is None else row[1] for row in rows], dtype=np.float64),
+        "total": np.array([nan if row[2] is None else row[2] for row in rows], dtype=np.float64),
+        "status": np.array([-1 if row[3] is None else row[3] for row in rows], dtype=np.int64),
+        "filename": [row[4] for row in rows],
+    }
+
+
+# (start, end) row index pairs of the prints in a series; end is exclusive
+def print_segments(status) -> list[tuple[int, int]]:
+    np = require_numpy()
+    active = np.isin(status, list(ACTIVE_PRINT_STATES)).astype(np.int8)
+    edges = np.diff(np.concatenate(([0], active, [0])))
+    return list(zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist(), strict=True))
+
+
+# Time each layer took, as (layer numbers, seconds). A layer change is only seen when the next
+# status message arrives, so when a printer advanced several layers between two messages the time
+# is split evenly between them.
+def layer_durations(ts, layer):
+    np = require_numpy()
+    known = ~np.isnan(layer)
+    ts, layer = ts[known], layer[known]
+    changes = np.flatnonzero(np.diff(layer) > 0) + 1
+    if len(changes) <= 1:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    reached = layer[changes]
+    advanced = np.diff(reached).astype(np.int64)
+    durations = np.repeat(np.diff(ts[changes]) / advanced, advanced)
+    return np.arange(int(reached[0]) + 1, int(reached[-1]) + 1), durations
+
+
+# Seconds spent in the EXPOSURE state on each layer, as (layer numbers, seconds). Only layers on
+# which an exposure was seen are included.
+def exposure_times(ts, layer, status):
+    np = require_numpy()
+    known = ~np.isnan(layer)
+    ts, layer, status = ts[known], layer[known], status[known]
+    if len(ts) <= 1:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    exposing = status[:-1] == PrintInfoStatus.EXPOSURE
+    layers = layer[:-1][exposing].astype(np.int64)
+    seconds = np.bincount(layers, weights=np.diff(ts)[exposing])
+    seen = np.flatnonzero(np.bincount(layers, minlength=len(seconds)))
+    return seen, seconds[seen]
+
+
+# Stack rows of different lengths into one matrix, right-aligned so that the last column holds the
+# most recent value of every row, padded with NaN on the left
+def right_aligned(rows):
+    np = require_numpy()
+    width = max((len(row) for row in rows), default=0)
+    matrix = np.full((len(rows), max(width, 1)), np.nan)
+    for i, row in enumerate(rows):
+        if len(row):
+            matrix[i, width - len(row) :] = row
+    return matrix
+
+
+# ETA and anomaly flags for many prints at once. durations holds the layer times of each print,
+# the other arguments one value per print: the layer it's on, its total layers, when its layer last
+# changed and whether it's still printing.
+def estimate(durations: list, current, total, last_change, printing, *, now: float | None = None) -> dict:
+    np = require_numpy()
+    now = time.time() if now is None else now
+    current, total = np.asarray(current, dtype=np.float64), np.asarray(total, dtype=np.float64)
+    last_change = np.asarray(last_change, dtype=np.float64)
+    printing = np.asarray(printing, dtype=bool)
+
+    matrix = right_aligned(durations)
+    measured = ~np.isnan(matrix).all(axis=1)
+    median = np.full(len(matrix), np.nan)
+    recent = np.full(len(matrix), np.nan)
+    median[measured] = np.nanmedian(matrix[measured], axis=1)
+    recent[measured] = np.nanmedian(matrix[measured, -RECENT_LAYERS:], axis=1)
+
+    since_change = np.maximum(now - last_change, 0.0)
+    remaining = np.maximum(total - current, 0.0)
+    # the layer being printed has already had part of its time
+    eta = np.maximum(remaining * recent - np.minimum(since_change, recent), 0.0)
+    eta[~printing] = np.nan
+    stalled = printing & (since_change > np.maximum(STALL_FACTOR * np.nan_to_num(recent), MIN_STALL_SECONDS))
+    slowdown = printing & measured & (recent > SLOWDOWN_FACTOR * median)
+    return {
+        "layer_time": median,
+        "recent_layer_time": recent,
+        "eta": eta,
+        "finish": now + eta,
+        "stalled": stalled,
+        "slowdown": slowdown,
+    }
+
+
+def optional(value) -> float | None:
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+# Analytics for every printer in the history (or the given ones), over the status recorded since
+# since. Each printer gets a dict of plain values, ready to be serialized.
+def analyze_fleet(
+    history: StatusHistory,
+    printer_ids: list[str] | None = None,
+    since: float | None = None,
+    now: float | None = None,
+) -> dict[str, dict]:
+    np = require_numpy()
+    now = time.time() if now is None else now
+    printer_ids = history.printers() if printer_ids is None else printer_ids
+
+    prints = []
+    for printer_id in printer_ids:
+        series = load_series(history, printer_id, since, now)
+        ts, layer, status = series["ts"], series["layer"], series["status"]
+        segments = print_segments(status)
+        info = {"printer_id": printer_id, **throughput(series, segments)}
+        if segments:
+            start, end = segments[-1]
+            print_ts, print_layer = ts[start:end], layer[start:end]
+            layers, durations = layer_durations(print_ts, print_layer)
+            exposed_layers, exposure = exposure_times(print_ts, print_layer, status[start:end])
+            known = np.flatnonzero(~np.isnan(print_layer))
+            current = print_layer[known[-1]] if len(known) else np.nan
+            # the first status message that reported the current layer
+            changed = known[print_layer[known] == current]
+            info.update(
+                filename=series["filename"][end - 1],
+                started=float(print_ts[0]),
+                printing=end == len(ts),
+                current_layer=optional(current),
+                total_layers=optional(series["total"][end - 1]),
+                last_change=float(print_ts[changed[0]]) if len(changed) else float(print_ts[0]),
+                layers=layers,
+                durations=durations,
+                exposure=optional(np.median(exposure)) if len(exposure) else None,
+                exposed_layers=len(exposed_layers),
+            )
+        prints.append(info)
+
+    timed = [p for p in prints if "durations" in p]
+    if timed:
+        estimates = estimate(
+            [p["durations"] for p in timed],
+            [np.nan if p["current_layer"] is None else p["current_layer"] for p in timed],
+            [np.nan if p["total_layers"] is None else p["total_layers"] for p in timed],
+            [p["last_change"] for p in timed],
+            [p["printing"] for p in timed],
+            now=now,
+        )
+        for i, p in enumerate(timed):
+            slow = p["durations"] > SLOW_LAYER_FACTOR * estimates["layer_time"][i]
+            p.update(
+                layer_time=optional(estimates["layer_time"][i]),
+                recent_layer_time=optional(estimates["recent_layer_time"][i]),
+                eta=optional(estimates["eta"][i]),
+                finish=optional(estimates["finish"][i]),
+                stalled=bool(estimates["stalled"][i]),
+                slowdown=bool(estimates["slowdown"][i]),
+                slow_layers=p["layers"][slow].tolist(),
+            )
+            del p["layers"], p["durations"]
+    return {p["printer_id"]: p for p in prints}
+
+
+# Layers per hour of printing, finished prints and the share of the recorded time spent printing
+def throughput(series: dict, segments: list[tuple[int, int]]) -> dict:
+    np = require_numpy()
+    ts, layer, status = series["ts"], series["layer"], series["status"]
+    if len(ts) <= 1:
+        return {"layers_per_hour": 0.0, "finished_prints": 0, "utilization": 0.0}
+    active = np.isin(status[:-1], list(ACTIVE_PRINT_STATES))
+    printing_time = np.diff(ts)[active].sum()
+    advanced = np.diff(np.nan_to_num(layer))
+    layers = advanced[active & (advanced > 0)].sum()
+    ends = [end for _, end in segments if end < len(ts)]
+    finished = int(np.isin(status[ends], list(FINISHED_PRINT_STATES)).sum()) if ends else 0
+    return {
+        "layers_per_hour": float(layers / printing_time * 3600) if printing_time > 0 else 0.0,
+        "finished_prints": finished,
+        "utilization": float(printing_time / (ts[-1] - ts[0])) if ts[-1] > ts[0] else 0.0,
+    }
+
+
+# Live ETA for cassini watch: keeps the layer counter of one printer as it's polled, seeded with
+# the current print from the status history when there is one
+class PrintClock:
+    def __init__(self, history: StatusHistory | None = None, printer_id: str | None = None):
+        np = require_numpy()
+        self.ts = np.empty(0)
+        self.layer = np.empty(0)
+        if history is not None and printer_id is not None:
+            self.seed(history, printer_id)
+
+    def seed(self, history: StatusHistory, printer_id: str) -> None:
+        series = load_series(history, printer_id, start=time.time() - SEED_WINDOW)
+        segments = print_segments(series["status"])
+        if segments and segments[-1][1] == len(series["ts"]):
+            start, _ = segments[-1]
+            self.ts, self.layer = series["ts"][start:], series["layer"][start:]
+
+    def observe(self, layer: int, timestamp: float | None = None) -> None:
+        np = require_numpy()
+        timestamp = time.time() if timestamp is None else timestamp
+        if len(self.layer) and layer < self.layer[-1]:
+            # a new print started
+            self.ts, self.layer = np.empty(0), np.empty(0)
+        self.ts = np.append(self.ts, timestamp)
+        self.layer = np.append(self.layer, float(layer))
+
+    # (seconds left or None while unknown, whether the print looks stalled)
+    def eta(self, total: int, now: float | None = None) -> tuple[float | None, bool]:
+        np = require_numpy()
+        if not len(self.layer):
+            return None, False
+        _, durations = layer_durations(self.ts, self.layer)
+        current = self.layer[-1]
+        last_change = self.ts[np.flatnonzero(self.layer == current)[0]]
+        estimates = estimate([durations], [current], [total], [last_change], [True], now=now)
+        return optional(estimates["eta"][0]), bool(estimates["stalled"][0])
@@ -0,0 +1,290 @@
+"""
+Driving printers through an external MQTT 3.1.1 broker
+
+The printers are pointed at the broker with ``connect-mqtt``, and cassini connects to the
+same broker as an ordinary client. ``attach`` subscribes to one printer's response, status
+and attributes topics and queues its messages separately from everyone else's, so any
+number of printers can share the one broker connection.
+
+``status_messages`` subscribes to the status of the whole fleet. With a ``share_group`` it
+uses the shared subscription ``$share/<group>//sdcp/status/+``, and the broker then hands
+each status message to only one of the clients in the group, which lets several cassini
+workers on different hosts split the status stream of a large fleet between them. A client
+that has attached a printer and also subscribes to the fleet's status may get that
+printer's status twice.
+"""
+
+import asyncio
+import contextlib
+import secrets
+import struct
+from typing import Final
+
+from loguru import logger
+
+from cassini.simple_mqtt_server import (
+    MQTT_CONNACK,
+    MQTT_CONNECT,
+    MQTT_DISCONNECT,
+    MQTT_PINGREQ,
+    MQTT_PINGRESP,
+    MQTT_PUBACK,
+    MQTT_PUBLISH,
+    MQTT_SUBACK,
+    MQTT_SUBSCRIBE,
+    MQTT_UNSUBACK,
+    MQTT_UNSUBSCRIBE,
+    SUBACK_FAILURE,
+    encode_length,
+    read_packet,
+)
+from cassini.transport import MQTTTransport
+
+DEFAULT_BROKER_PORT: Final[int] = 1883
+DEFAULT_KEEPALIVE: Final[int] = 60
+SUBSCRIBE_QOS: Final[int] = 1
+
+CONNACK_ERRORS: Final[dict[int, str]] = {
+    1: "unacceptable protocol version",
+    2: "client identifier rejected",
+    3: "server unavailable",
+    4: "bad user name or password",
+    5: "not authorized",
+}
+
+
+def parse_broker_address(address: str) -> tuple[str, int]:
+    host, sep, port = address.rpartition(":")
+    if not sep:
+        return address, DEFAULT_BROKER_PORT
+    return host, int(port)
+
+
+def mqtt_string(value: str | bytes) -> bytes:
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return struct.pack("!H", len(value)) + value
+
+
+def printer_topics(printer_id: str) -> list[str]:
+    return [f"/sdcp/response/{printer_id}", f"/sdcp/status/{printer_id}", f"/sdcp/attributes/{printer_id}"]
+
+
+class BrokerTransport(MQTTTransport):
+    def __init__(
+        self,
+        host: str,
+        port: int = DEFAULT_BROKER_PORT,
+        *,
+        client_id: str | None = None,
+        username: str | None = None,
+        password: str | None = None,
+        share_group: str | None = None,
+        keepalive: int = DEFAULT_KEEPALIVE,
+        capture=None,
+        http_host: str | None = None,
+    ):
+        self.host = host
+        self.port = port
+        self.client_id = client_id or f"cassini-{secrets.token_hex(4)}"
+        self.username = username
+        self.password = password
+        self.share_group = share_group
+        self.keepalive = keepalive
+        self.capture = capture
+        # by default, the address we reach the broker from, which printers on the same network can reach too
+        self.local_host = http_host
+        self.reader = None
+        self.writer = None
+        # set once the broker connection is gone, whether we closed it or it dropped
+        self.closed = False
+        self.tasks = []
+        self.next_pack_id_value = 1
+        # packet id -> future resolved by the matching SUBACK/UNSUBACK
+        self.pending_acks = {}
+        # printer id -> queue of that printer's messages
+        self.queues: dict[str, asyncio.Queue] = {}
+        self.fleet_status = None
+
+    async def start(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.local_host is None:
+            self.local_host = self.writer.get_extra_info("sockname")[0]
+
+        flags = 0x02  # clean session
+        payload = mqtt_string(self.client_id)
+        if self.username is not None:
+            flags |= 0x80
+            payload += mqtt_string(self.username)
+            if self.password is not None:
+                flags |= 0x40
+                payload += mqtt_string(self.password)
+        variable_header = mqtt_string("MQTT") + bytes([4, flags]) + struct.pack("!H", self.keepalive)
+        await self.send_msg(MQTT_CONNECT, payload=variable_header + payload)
+
+        msg_type, _, body = await self.read_msg()
+        if msg_type != MQTT_CONNACK:
+            msg = f"Expected CONNACK from {self.host}:{self.port}, got packet type {msg_type}"
+            raise ConnectionError(msg)
+        if body[1] != 0:
+            msg = f"Broker {self.host}:{self.port} refused connection: {CONNACK_ERRORS.get(body[1], body[1])}"
+            raise ConnectionError(msg)
+        logger.debug(f"Connected to MQTT broker {self.host}:{self.port} as {self.client_id}")
+
+        self.tasks = [asyncio.create_task(self.read_loop()), asyncio.create_task(self.ping_loop())]
+
+    async def serve_forever(self):
+        await asyncio.gather(*self.tasks)
+
+    def http_host(self) -> str | None:
+        return self.local_host
+
+    async def close(self):
+        if self.writer is None:
+            return
+        with contextlib.suppress(ConnectionError):
+            await self.send_msg(MQTT_DISCONNECT)
+        for task in self.tasks:
+            task.cancel()
+        self.closed = True
+        self.writer.close()
+        with contextlib.suppress(ConnectionError):
+            await self.writer.wait_closed()
+        self.writer = None
+
+    # The broker went away: fail whatever waits on it now, instead of letting every wait time out
+    def connection_lost(self):
+        self.closed = True
+        for task in self.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        for future in self.pending_acks.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Lost the connection to MQTT broker {self.host}:{self.port}"))
+        self.pending_acks.clear()
+        for queue in [*self.queues.values(), self.fleet_status]:
+            if queue is not None:
+                queue.put_nowait(None)
+
+    async def attach(self, printer):
+        self.queues.setdefault(printer.id, asyncio.Queue())
+        await self.subscribe(printer_topics(printer.id))
+        return True
+
+    async def detach(self, printer):
+        # a broker that went away has dropped our subscriptions already
+        if not self.closed:
+            await self.unsubscribe(printer_topics(printer.id))
+        self.queues.pop(printer.id, None)
+
+    def attached(self, printer):
+        return not self.closed and self.writer is not None and printer.id in self.queues
+
+    def publish(self, topic, payload: bytes | str):
+        self.check_connected()
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if self.capture is not None:
+            self.capture.mqtt_out(topic, payload)
+        # QoS 0, so no packet identifier
+        self.writer.write(bytes([MQTT_PUBLISH << 4]) + encode_length(len(topic.encode()) + 2 + len(payload)))
+        self.writer.write(mqtt_string(topic) + payload)
+
+    async def next_published_message(self, printer_id=None):
+        queue = self.queues.setdefault(printer_id, asyncio.Queue())
+        if (message := await queue.get()) is None:
+            # leave the marker for the next reader too
+            queue.put_nowait(None)
+            self.check_connected()
+        return message
+
+    # Yield (printer id, raw status payload) for status messages of printers that aren't attached
+    async def status_messages(self):
+        if self.fleet_status is None:
+            self.fleet_status = asyncio.Queue()
+            topic = "/sdcp/status/+"
+            await self.subscribe([f"$share/{self.share_group}/{topic}" if self.share_group else topic])
+        while (message := await self.fleet_status.get()) is not None:
+            yield message
+        self.fleet_status.put_nowait(None)
+        self.check_connected()
+
+    async def subscribe(self, topics):
+        packid = self.next_pack_id()
+        payload = b"".join(mqtt_string(t) + bytes([SUBSCRIBE_QOS]) for t in topics)
+        codes = await self.request_ack(MQTT_SUBSCRIBE, packid, payload)
+        if failed := [t for t, code in zip(topics, codes, strict=False) if code == SUBACK_FAILURE]:
+            msg = f"Broker rejected subscription to {', '.join(failed)}"
+            raise ConnectionError(msg)
+        logger.debug(f"Subscribed to {topics}")
+
+    async def unsubscribe(self, topics):
+        await self.request_ack(MQTT_UNSUBSCRIBE, self.next_pack_id(), b"".join(mqtt_string(t) for t in topics))
+
+    # SUBSCRIBE and UNSUBSCRIBE have the reserved flags 0b0010
+    async def request_ack(self, msg_type, packid, payload):
+        future = asyncio.get_running_loop().create_future()
+        self.pending_acks[packid] = future
+        await self.send_msg(msg_type, flags=0x2, payload=struct.pack("!H", packid) + payload)
+        return await asyncio.wait_for(future, timeout=self.keepalive)
+
+    async def read_loop(self):
+        try:
+            while True:
+                msg_type, flags, body = await self.read_msg()
+                if msg_type == MQTT_PUBLISH:
+                    await self.handle_publish(flags, body)
+                elif msg_type in (MQTT_SUBACK, MQTT_UNSUBACK):
+                    packid = struct.unpack("!H", body[:2])[0]
+                    if (future := self.pending_acks.pop(packid, None)) is not None and not future.done():
+                        future.set_result(body[2:])
+                elif msg_type != MQTT_PINGRESP:
+                    logger.debug("Ignoring MQTT packet type {} from broker", msg_type)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.error(f"MQTT broker {self.host}:{self.port} closed the connection")
+            # waiters get the ConnectionError, so the loop itself just ends
+            self.connection_lost()
+
+    async def handle_publish(self, flags, body):
+        qos = (flags >> 1) & 0x3
+        topic_len = struct.unpack("!H", body[:2])[0]
+        topic = body[2 : 2 + topic_len].decode("utf-8")
+        payload_start = 2 + topic_len
+        if qos > 0:
+            packid = struct.unpack("!H", body[payload_start : payload_start + 2])[0]
+            payload_start += 2
+            await self.send_msg(MQTT_PUBACK, payload=struct.pack("!H", packid))
+        payload = body[payload_start:]
+
+        if self.capture is not None:
+            self.capture.mqtt_in(topic, payload)
+        printer_id = topic.rsplit("/", 1)[-1]
+        if (queue := self.queues.get(printer_id)) is not None:
+            queue.put_nowait({"topic": topic, "payload": payload})
+        elif self.fleet_status is not None and topic.startswith("/sdcp/status/"):
+            self.fleet_status.put_nowait((printer_id, payload))
+        else:
+            logger.debug("Dropping message on {} for unattached printer", topic)
+
+    async def ping_loop(self):
+        while True:
+            await asyncio.sleep(self.keepalive / 2)
+            await self.send_msg(MQTT_PINGREQ)
+
+    async def read_msg(self):
+        return await read_packet(self.reader)
+
+    async def send_msg(self, msg_type, flags=0, payload=b""):
+        self.check_connected()
+        self.writer.write(bytes([msg_type << 4 | flags]) + encode_length(len(payload)) + payload)
+        await self.writer.drain()
+
+    def check_connected(self):
+        if self.closed or self.writer is None:
+            msg = f"Not connected to MQTT broker {self.host}:{self.port}"
+            raise ConnectionError(msg)
+
+    def next_pack_id(self):
+        pack_id = self.next_pack_id_value
+        self.next_pack_id_value = pack_id % 0xFFFF + 1
+        return pack_id
@@ -0,0 +1,168 @@
+"""
+Recording and replaying of MQTT/UDP traffic
+
+A capture file starts with ``CAPTURE_MAGIC`` followed by one record per frame: a fixed
+header (timestamp as a double, frame kind, topic length, payload length) and then the
+raw topic and payload bytes. For MQTT frames the topic is the MQTT topic, for UDP frames
+it is the remote ``host:port``.
+"""
+
+import asyncio
+import contextlib
+import struct
+import time
+from pathlib import Path
+from typing import Final, NamedTuple
+
+from loguru import logger
+
+from cassini import codec
+from cassini.saturn_printer import SaturnPrinter
+
+CAPTURE_MAGIC: Final[bytes] = b"CSNCAP01"
+RECORD_HEADER: Final[struct.Struct] = struct.Struct("!dBHI")
+
+MQTT_IN: Final[int] = 1
+MQTT_OUT: Final[int] = 2
+UDP_IN: Final[int] = 3
+UDP_OUT: Final[int] = 4
+
+
+class CaptureRecord(NamedTuple):
+    timestamp: float
+    kind: int
+    topic: str
+    payload: bytes
+
+
+class CaptureWriter:
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self.file = open(self.path, "wb")
+        self.file.write(CAPTURE_MAGIC)
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, kind: int, topic: str, payload: bytes | str) -> None:
+        topic = topic.encode("utf-8")
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.file.write(RECORD_HEADER.pack(time.time(), kind, len(topic), len(payload)) + topic + payload)
+        self.count += 1
+
+    def mqtt_in(self, topic: str, payload: bytes) -> None:
+        self.write(MQTT_IN, topic, payload)
+
+    def mqtt_out(self, topic: str, payload: bytes | str) -> None:
+        self.write(MQTT_OUT, topic, payload)
+
+    def udp_in(self, addr: tuple, payload: bytes) -> None:
+        self.write(UDP_IN, f"{addr[0]}:{addr[1]}", payload)
+
+    def udp_out(self, addr: tuple, payload: bytes) -> None:
+        self.write(UDP_OUT, f"{addr[0]}:{addr[1]}", payload)
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+            logger.info(f"Captured {self.count} frames to {self.path}")
+
+
+# Record UDP traffic of every SaturnPrinter for the duration of the block. Yields the writer, to be
+# handed on to the MQTT server, or None when path is None and nothing should be captured.
+@contextlib.contextmanager
+def capturing(path: Path | str | None):
+    if path is None:
+        yield None
+        return
+    with CaptureWriter(path) as writer:
+        SaturnPrinter.capture = writer
+        try:
+            yield writer
+        finally:
+            SaturnPrinter.capture = None
+
+
+def read_capture(path: Path | str):
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            msg = f"{path} is not a cassini capture file"
+            raise ValueError(msg)
+        while header := f.read(RECORD_HEADER.size):
+            if len(header) < RECORD_HEADER.size:
+                logger.warning(f"Truncated record at the end of {path}")
+                return
+            timestamp, kind, topic_len, payload_len = RECORD_HEADER.unpack(header)
+            topic = f.read(topic_len).decode("utf-8")
+            yield CaptureRecord(timestamp, kind, topic, f.read(payload_len))
+
+
+# Stand-in for SimpleMQTTServer that the replayer feeds captured frames into
+class ReplayMQTT:
+    def __init__(self):
+        self.port = 0
+        self.incoming_messages = asyncio.Queue()
+        self.published = 0
+
+    def publish(self, topic, payload):  # noqa: ARG002
+        self.published += 1
+
+    async def next_published_message(self, printer_id=None):  # noqa: ARG002
+        return await self.incoming_messages.get()
+
+
+class CaptureReplayer:
+    def __init__(self, path: Path | str, history=None):
+        self.path = Path(path)
+        self.history = history
+        self.printers: dict[str, SaturnPrinter] = {}
+
+    def printer_for(self, printer_id: str, desc: dict | None = None) -> SaturnPrinter:
+        if (printer := self.printers.get(printer_id)) is None:
+            printer = SaturnPrinter(history=self.history)
+            printer.id = printer_id
+            printer.mqtt = ReplayMQTT()
+            self.printers[printer_id] = printer
+        if desc is not None:
+            printer.set_desc(desc)
+        return printer
+
+    # Play the capture back. With speed=1.0 frames are delivered with their original spacing,
+    # larger values play faster, and speed=0 delivers everything as fast as possible.
+    async def replay(self, speed: float = 1.0) -> dict:
+        count = 0
+        first_ts = None
+        started = time.perf_counter()
+        for record in read_capture(self.path):
+            if first_ts is None:
+                first_ts = record.timestamp
+            if speed > 0:
+                delay = (record.timestamp - first_ts) / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            if record.kind == MQTT_IN:
+                printer = self.printer_for(record.topic.rsplit("/", 1)[-1])
+                printer.mqtt.incoming_messages.put_nowait({"topic": record.topic, "payload": record.payload})
+                topic, data = await printer.next_message()
+                printer.dispatch_message(topic, data)
+            elif record.kind == UDP_IN:
+                desc = codec.loads(record.payload)
+                printer = self.printer_for(desc["Data"]["Attributes"]["MainboardID"], desc)
+                printer.incoming_status(desc["Data"]["Status"])
+            else:
+                continue
+            count += 1
+
+        elapsed = time.perf_counter() - started
+        return {
+            "frames": count,
+            "printers": len(self.printers),
+            "elapsed": elapsed,
+            "frames_per_second": count / elapsed if elapsed > 0 else 0.0,
+        }
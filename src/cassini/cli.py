@@ -19,10 +19,40 @@ from rich import print as rprint
 from rich.console import Console
 from rich.live import Live
 
-from cassini.commands import do_print, do_status, do_status_full, do_upload, do_watch, live_status
+from cassini.capture import capturing
+from cassini.commands import (
+    do_analytics,
+    do_discover,
+    do_history,
+    do_live_records,
+    do_print,
+    do_queue_list,
+    do_queue_run,
+    do_record,
+    do_replay,
+    do_status,
+    do_status_full,
+    do_status_records,
+    do_upload,
+    do_watch,
+)
+from cassini.dashboard import StatusDashboard
+from cassini.discovery import PrinterRegistry
+from cassini.history import StatusHistory
 from cassini.logging import init_logger
-from cassini.saturn_printer import SaturnPrinter
-from cassini.utils import find_printer_addr, get_printers
+from cassini.loop import use_uvloop
+from cassini.records import OutputFormat
+from cassini.scheduler import JobQueue
+from cassini.utils import (
+    PrinterResolver,
+    default_history_path,
+    default_queue_path,
+    default_registry_path,
+    discover_printers,
+    find_printer_addr,
+    get_printers,
+    resolve_printer,
+)
 
 try:
     __version__ = version("cassini")
@@ -51,6 +81,14 @@ cassini = typer.Typer(
     rich_help_panel=True,
 )
 
+queue_app = typer.Typer(
+    name="queue",
+    short_help="Queue print jobs and run them across all printers",
+    no_args_is_help=True,
+    rich_markup_mode="rich",
+)
+cassini.add_typer(queue_app, name="queue")
+
 verbosity_level = 0
 
 
@@ -85,19 +123,35 @@ def verbosity(
     version: Annotated[
         bool, typer.Option("-v", "--version", help="Show Cassini version", callback=version_callback)
     ] = False,
+    uvloop: Annotated[
+        bool, typer.Option("--uvloop", help="Run on the uvloop event loop (needs the 'fast' extra)")
+    ] = False,
 ) -> None:
     verbosity_level = verbose  # noqa: F841
+    if uvloop:
+        use_uvloop()
 
 
 @cassini.command(help="Discover and display status of all printers")
 def status(
-    printer: Annotated[str | None, typer.Argument(help="ID of printer to target")] = None,
-    broadcast: Annotated[str, typer.Option("--broadcast", help="Explicit broadcast IP address")] = "<broadcast>",
+    printer: Annotated[
+        str | None, typer.Argument(help="IP address, MainboardID, name or alias of the printer to target")
+    ] = None,
+    *,
+    broadcast: Annotated[str | None, typer.Option("--broadcast", help="Explicit broadcast IP address")] = None,
     status_full: Annotated[
         bool, typer.Option("--full", help="Discover and display full status of all printers")
     ] = False,
     live_update: Annotated[bool, typer.Option("--live", help="Update the status table in read time.")] = False,
     update_interval: Annotated[int, typer.Option("--interval", help="Live update interval, in seconds.")] = 1,
+    record_history: Annotated[
+        bool, typer.Option("--history", help="Record live status updates to the status history database")
+    ] = False,
+    capture: Annotated[Path | None, typer.Option("--capture", help="Record all printer traffic to a file")] = None,
+    output_format: Annotated[
+        OutputFormat,
+        typer.Option("--format", help="Output format; ndjson and csv write one record per printer per update"),
+    ] = OutputFormat.TABLE,
     debug: Annotated[bool, typer.Option("--debug")] = False,
     version: Annotated[
         bool, typer.Option("--version", help="Show version", callback=version_callback, is_eager=True)
@@ -105,26 +159,82 @@ def status(
 ):
     if debug:
         init_logger(3)
-    if printer:
-        printers = get_printers(printer=printer)
-    else:
-        printers = get_printers(broadcast=broadcast)
-    console = Console()
-    if live_update:
-        with Live(live_status(printers), console=console, refresh_per_second=4, transient=False, screen=False) as live:
-            while True:
-                time.sleep(update_interval)
-                live.update(do_status(printers))
-    elif status_full:
-        console.print(do_status_full(printers))
-    else:
-        console.print(do_status(printers))
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(capturing(capture))
+        history = stack.enter_context(StatusHistory(default_history_path())) if record_history else None
+        if printer:
+            printers = get_printers(printer=printer)
+        else:
+            printers = get_printers(broadcast=broadcast)
+        printers = [p for p in printers if p is not None]
+        console = Console()
+        if live_update:
+            for p in printers:
+                p.history = history
+            if output_format != OutputFormat.TABLE:
+                do_live_records(printers, output_format, interval=update_interval)
+                return
+            # Live redraws the dashboard at a fixed rate in its own thread, while another thread
+            # collects status from every printer in one batch per interval
+            dashboard = StatusDashboard(printers)
+            with (
+                Live(dashboard, console=console, refresh_per_second=4, transient=False, screen=False),
+                dashboard.refreshing(printers, interval=update_interval) as refresher,
+            ):
+                refresher.join()
+        elif output_format != OutputFormat.TABLE:
+            do_status_records(printers, output_format)
+        elif status_full:
+            do_status_full(printers)
+        else:
+            console.print(do_status(printers))
+
+
+@cassini.command(help="Search every local network for printers and remember them for later commands")
+def discover(
+    timeout: Annotated[float, typer.Option("--timeout", help="How long to wait for answers, in seconds")] = 1.0,
+    debug: Annotated[bool, typer.Option("--debug")] = False,
+):
+    if debug:
+        init_logger(3)
+    printers = discover_printers(timeout=timeout)
+    if not printers:
+        rprint("No printers found on network")
+        raise typer.Exit(1)
+    Console().print(do_discover(printers))
+
+
+@cassini.command(help="Give a printer a name to refer to it by in other commands")
+def alias(
+    name: Annotated[str, typer.Argument(help="Alias to give the printer")],
+    printer: Annotated[str, typer.Argument(help="IP address, MainboardID or name of the printer")],
+    debug: Annotated[bool, typer.Option("--debug")] = False,
+):
+    if debug:
+        init_logger(3)
+    registry = PrinterRegistry(default_registry_path())
+    found = PrinterResolver(registry).resolve(printer)
+    if found is None:
+        rprint(f"No response from printer {printer}")
+        raise typer.Exit(1)
+    registry.add_alias(found.id, name)
+    rprint(f"{name} -> {found.describe()} ({found.id})")
 
 
 @cassini.command(help="Continuously update the status of the selected printer")
 def watch(
-    printer_addr: Annotated[str | None, typer.Argument(help="ID of printer to target")] = None,
+    printer_addr: Annotated[
+        str | None, typer.Argument(help="IP address, MainboardID, name or alias of the printer to target")
+    ] = None,
+    *,
     interval: Annotated[int, typer.Option("--interval", help="Status update interval (seconds)")] = 5,
+    record_history: Annotated[
+        bool, typer.Option("--history", help="Record status updates to the status history database")
+    ] = False,
+    output_format: Annotated[
+        OutputFormat,
+        typer.Option("--format", help="Output format; ndjson and csv write one record per printer per update"),
+    ] = OutputFormat.TABLE,
     debug: Annotated[bool, typer.Option("--debug")] = False,
     version: Annotated[
         bool, typer.Option("--version", help="Show version", callback=version_callback, is_eager=True)
@@ -133,13 +243,77 @@ def watch(
     if debug:
         init_logger(3)
     printer_addr = find_printer_addr() if printer_addr is None else printer_addr
-    do_watch(printer_addr, interval=interval)
+    if record_history:
+        with StatusHistory(default_history_path()) as history:
+            do_watch(printer_addr, interval=interval, history=history, output_format=output_format)
+    else:
+        do_watch(printer_addr, interval=interval, output_format=output_format)
+
+
+# Open the status history for reading, exiting if nothing has been recorded there yet
+def read_history(database: Path | None) -> StatusHistory:
+    try:
+        return StatusHistory(database or default_history_path(), read_only=True)
+    except FileNotFoundError as e:
+        rprint(f"{e}: record one with status --live --history, watch --history or record")
+        raise typer.Exit(1) from e
+
+
+@cassini.command(help="Summarize recorded print history")
+def history(
+    printer_id: Annotated[str | None, typer.Argument(help="MainboardID of printer to summarize")] = None,
+    hours: Annotated[float | None, typer.Option("--hours", help="Only include the last N hours")] = None,
+    database: Annotated[Path | None, typer.Option("--db", help="Status history database")] = None,
+    debug: Annotated[bool, typer.Option("--debug")] = False,
+):
+    if debug:
+        init_logger(3)
+    since = time.time() - hours * 3600 if hours is not None else None
+    with read_history(database) as status_history:
+        Console().print(do_history(status_history, printer_id=printer_id, since=since))
+
+
+@cassini.command(help="Layer timing, ETAs, throughput and anomalies of every printer in the status history")
+def analytics(
+    printer_id: Annotated[str | None, typer.Argument(help="MainboardID of printer to analyze")] = None,
+    hours: Annotated[float, typer.Option("--hours", help="Only include the last N hours")] = 24,
+    database: Annotated[Path | None, typer.Option("--db", help="Status history database")] = None,
+    debug: Annotated[bool, typer.Option("--debug")] = False,
+):
+    if debug:
+        init_logger(3)
+    with read_history(database) as status_history:
+        try:
+            table = do_analytics(status_history, printer_id=printer_id, since=time.time() - hours * 3600)
+        except ImportError as e:
+            rprint(f"{e}")
+            raise typer.Exit(1) from e
+        Console().print(table)
 
 
 @cassini.command(help="Upload a file to the printer")
 def upload(
     filename: Annotated[Path, typer.Argument(help="File to upload")],
-    printer_addr: Annotated[str | None, typer.Argument(help="ID of printer to target")] = None,
+    printer_addr: Annotated[
+        str | None, typer.Argument(help="IP address, MainboardID, name or alias of the printer to target")
+    ] = None,
+    *,
+    start_printing: Annotated[
+        bool, typer.Option("--print", help="Start printing the file as soon as the upload is done")
+    ] = False,
+    max_rate: Annotated[int | None, typer.Option("--max-rate", help="Maximum transfer rate in KiB/s")] = None,
+    stage_local: Annotated[
+        bool,
+        typer.Option("--stage-local", help="Copy files to a local cache before serving them (for network storage)"),
+    ] = False,
+    broker: Annotated[
+        str | None, typer.Option("--broker", help="Drive the printer through this MQTT broker (host[:port])")
+    ] = None,
+    http_host: Annotated[
+        str | None,
+        typer.Option("--http-host", help="Address printers download files from when using --broker"),
+    ] = None,
+    capture: Annotated[Path | None, typer.Option("--capture", help="Record all printer traffic to a file")] = None,
     debug: Annotated[bool, typer.Option("--debug")] = False,
     version: Annotated[
         bool, typer.Option("--version", help="Show version", callback=version_callback, is_eager=True)
@@ -147,22 +321,45 @@ def upload(
 ):
     if debug:
         init_logger(3)
-    printer_addr = find_printer_addr() if printer_addr is None else printer_addr
-    printer = SaturnPrinter().find_printer(addr=printer_addr)
-    logger.info(f"Printer: {printer.describe()} ({printer.addr[0]})")
+    with capturing(capture) as capture_writer:
+        printer_addr = find_printer_addr() if printer_addr is None else printer_addr
+        printer = resolve_printer(printer_addr)
+        if printer is None:
+            msg = f"No response from printer {printer_addr}"
+            logger.error(msg)
+            raise PrintersError(msg)
+        logger.info(f"Printer: {printer.describe()} ({printer.addr[0]})")
 
-    if printer.busy:
-        msg = f"Printer is busy (status: {printer.current_status})"
-        logger.error(msg)
-        raise PrintError(msg)
-    else:
-        asyncio.run(do_upload(printer, filename))
+        if printer.busy:
+            msg = f"Printer is busy (status: {printer.current_status})"
+            logger.error(msg)
+            raise PrintError(msg)
+        else:
+            asyncio.run(
+                do_upload(
+                    printer,
+                    filename,
+                    capture=capture_writer,
+                    start_printing=start_printing,
+                    rate_limit=max_rate * 1024 if max_rate else None,
+                    broker=broker,
+                    stage_local=stage_local,
+                    http_host=http_host,
+                )
+            )
 
 
 @cassini.command(name="print", help="Start printing a file already present on the printer")
 def print_file(
     filename: Annotated[str, typer.Argument(help="File to print")],
-    printer_addr: Annotated[str | None, typer.Argument(help="ID of printer to target")] = None,
+    printer_addr: Annotated[
+        str | None, typer.Argument(help="IP address, MainboardID, name or alias of the printer to target")
+    ] = None,
+    *,
+    broker: Annotated[
+        str | None, typer.Option("--broker", help="Drive the printer through this MQTT broker (host[:port])")
+    ] = None,
+    capture: Annotated[Path | None, typer.Option("--capture", help="Record all printer traffic to a file")] = None,
     debug: Annotated[bool, typer.Option("--debug")] = False,
     version: Annotated[
         bool, typer.Option("--version", help="Show version", callback=version_callback, is_eager=True)
@@ -170,21 +367,64 @@ def print_file(
 ):
     if debug:
         init_logger(3)
-    printer_addr = find_printer_addr() if printer_addr is None else printer_addr
-    printer = SaturnPrinter().find_printer(addr=printer_addr)
-    logger.info(f"Printer: {printer.describe()} ({printer.addr[0]})")
-    if printer.busy:
-        msg = f"Printer is busy (status: {printer.current_status})"
-        logger.error(msg)
-        raise PrintError(msg)
+    with capturing(capture) as capture_writer:
+        printer_addr = find_printer_addr() if printer_addr is None else printer_addr
+        printer = resolve_printer(printer_addr)
+        if printer is None:
+            msg = f"No response from printer {printer_addr}"
+            logger.error(msg)
+            raise PrintersError(msg)
+        logger.info(f"Printer: {printer.describe()} ({printer.addr[0]})")
+        if printer.busy:
+            msg = f"Printer is busy (status: {printer.current_status})"
+            logger.error(msg)
+            raise PrintError(msg)
+        else:
+            asyncio.run(do_print(printer, filename, capture=capture_writer, broker=broker))
+
+
+@cassini.command(help="Replay a capture recorded with --capture")
+def replay(
+    capture: Annotated[Path, typer.Argument(help="Capture file to replay")],
+    speed: Annotated[
+        float, typer.Option("--speed", help="Playback speed multiplier; 0 replays as fast as possible")
+    ] = 1.0,
+    record_history: Annotated[
+        bool, typer.Option("--history", help="Record replayed status to the status history database")
+    ] = False,
+    debug: Annotated[bool, typer.Option("--debug")] = False,
+):
+    if debug:
+        init_logger(3)
+    if record_history:
+        with StatusHistory(default_history_path()) as history:
+            Console().print(asyncio.run(do_replay(capture, speed=speed, history=history)))
     else:
-        asyncio.run(do_print(printer, filename))
+        Console().print(asyncio.run(do_replay(capture, speed=speed)))
+
+
+@cassini.command(help="Record the status of all printers on an MQTT broker to the status history database")
+def record(
+    broker: Annotated[str, typer.Argument(help="MQTT broker the printers are connected to (host[:port])")],
+    share_group: Annotated[
+        str | None,
+        typer.Option("--share-group", help="Split the status stream with other recorders using the same group"),
+    ] = None,
+    database: Annotated[Path | None, typer.Option("--db", help="Status history database")] = None,
+    debug: Annotated[bool, typer.Option("--debug")] = False,
+):
+    if debug:
+        init_logger(3)
+    with StatusHistory(database or default_history_path()) as status_history:
+        asyncio.run(do_record(broker, status_history, share_group=share_group))
 
 
 @cassini.command(help="Connect printer to particular MQTT server")
 def connect_mqtt(
     address: Annotated[str, typer.Argument(help='MQTT host and port, e.g. "192.168.1.33:1883" or "mqtt.local:1883"')],
-    printer: Annotated[str | None, typer.Option("--printer", help="ID of printer to target")] = None,
+    printer: Annotated[
+        str | None, typer.Option("--printer", help="IP address, MainboardID, name or alias of the printer to target")
+    ] = None,
     broadcast: Annotated[str | None, typer.Option("--broadcast", help="Explicit broadcast IP address")] = None,
     debug: Annotated[bool, typer.Option("--debug")] = False,
     version: Annotated[
@@ -202,5 +442,84 @@ def connect_mqtt(
         p.connect_mqtt(mqtt_host, mqtt_port)
 
 
+@queue_app.command(name="add", help="Add files to the print queue")
+def queue_add(
+    filenames: Annotated[list[Path], typer.Argument(help="Files to print")],
+    printer_id: Annotated[
+        str | None, typer.Option("--printer", help="MainboardID of the printer to print on; any printer if omitted")
+    ] = None,
+):
+    queue = JobQueue(default_queue_path())
+    for filename in filenames:
+        if not filename.exists():
+            msg = f"{filename} does not exist"
+            logger.error(msg)
+            raise FileNotFoundError(msg)
+        job = queue.add(filename, printer_id)
+        rprint(f"Queued [cyan]{filename.name}[/] as job {job['id']}")
+
+
+@queue_app.command(name="list", help="Show the print queue")
+def queue_list():
+    Console().print(do_queue_list(JobQueue(default_queue_path())))
+
+
+@queue_app.command(name="clear", help="Remove finished and failed jobs from the print queue")
+def queue_clear():
+    removed = JobQueue(default_queue_path()).clear_finished()
+    rprint(f"Removed {removed} jobs")
+
+
+@queue_app.command(name="run", help="Print queued jobs on all available printers")
+def queue_run(
+    printer_addrs: Annotated[list[str] | None, typer.Argument(help="Printers to use; all printers if omitted")] = None,
+    *,
+    broadcast: Annotated[str | None, typer.Option("--broadcast", help="Explicit broadcast IP address")] = None,
+    keep_running: Annotated[
+        bool, typer.Option("--keep-running", help="Keep waiting for new jobs when the queue is empty")
+    ] = False,
+    max_rate: Annotated[
+        int | None, typer.Option("--max-rate", help="Maximum total transfer rate to all printers in KiB/s")
+    ] = None,
+    max_printer_rate: Annotated[
+        int | None, typer.Option("--max-printer-rate", help="Maximum transfer rate to each printer in KiB/s")
+    ] = None,
+    broker: Annotated[
+        str | None, typer.Option("--broker", help="Drive the printers through this MQTT broker (host[:port])")
+    ] = None,
+    http_host: Annotated[
+        str | None,
+        typer.Option("--http-host", help="Address printers download files from when using --broker"),
+    ] = None,
+    http_workers: Annotated[
+        int, typer.Option("--http-workers", help="Extra processes serving files to the printers", min=0)
+    ] = 0,
+    stage_local: Annotated[
+        bool,
+        typer.Option("--stage-local", help="Copy files to a local cache before serving them (for network storage)"),
+    ] = False,
+    debug: Annotated[bool, typer.Option("--debug")] = False,
+):
+    if debug:
+        init_logger(3)
+    if printer_addrs:
+        printers = [p for addr in printer_addrs for p in get_printers(printer=addr) if p is not None]
+    else:
+        printers = get_printers(broadcast=broadcast)
+    asyncio.run(
+        do_queue_run(
+            printers,
+            JobQueue(default_queue_path()),
+            keep_running=keep_running,
+            rate_limit=max_rate * 1024 if max_rate else None,
+            connection_rate_limit=max_printer_rate * 1024 if max_printer_rate else None,
+            broker=broker,
+            http_workers=http_workers,
+            stage_local=stage_local,
+            http_host=http_host,
+        )
+    )
+
+
 if __name__ == "main":
     cassini()
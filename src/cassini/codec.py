@@ -0,0 +1,52 @@
+"""
+JSON encoding/decoding for SDCP payloads
+
+Uses orjson or msgspec when one of them is installed, and falls back to the standard
+library otherwise. Both directions work in bytes so that frames coming off the MQTT
+and UDP sockets can be decoded without an intermediate ``str``.
+"""
+
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover
+    msgspec = None
+
+
+if orjson is not None:
+    BACKEND = "orjson"
+
+    def loads(data: bytes | bytearray | memoryview | str) -> Any:
+        return orjson.loads(data)
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+elif msgspec is not None:
+    BACKEND = "msgspec"
+    _decoder = msgspec.json.Decoder()
+    _encoder = msgspec.json.Encoder()
+
+    def loads(data: bytes | bytearray | memoryview | str) -> Any:
+        return _decoder.decode(data)
+
+    def dumps(obj: Any) -> bytes:
+        return _encoder.encode(obj)
+
+else:
+    BACKEND = "json"
+
+    def loads(data: bytes | bytearray | memoryview | str) -> Any:
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return json.loads(data)
+
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
@@ -5,7 +5,7 @@
 # Copyright (C) 2023 Vladimir Vukicevic
 # License: MIT
 #
-import asyncio
+import contextlib
 import time
 from importlib.metadata import PackageNotFoundError, version
 from pathlib import Path
@@ -23,11 +23,18 @@ from rich.progress import (
 )
 from rich.table import Table
 
-from cassini.exceptions import PrintError, PrintersError, UploadError
+from cassini import codec
+from cassini.analytics import PrintClock, analyze_fleet, numpy_available
+from cassini.capture import CaptureReplayer
+from cassini.exceptions import CommandError, PrintError, PrintersError
+from cassini.history import StatusHistory
+from cassini.loop import LoopLagMonitor
+from cassini.records import OutputFormat, RecordWriter
 from cassini.saturn_printer import CurrentStatus, FileStatus, PrintInfoStatus, SaturnPrinter
-from cassini.simple_http_server import SimpleHTTPServer
-from cassini.simple_mqtt_server import SimpleMQTTServer
-from cassini.utils import get_printers
+from cassini.scheduler import FleetScheduler, JobQueue
+from cassini.servers import create_http_server, create_mqtt_server
+from cassini.sessions import SessionPool
+from cassini.utils import get_printers, resolve_printer
 
 try:
     __version__ = version("cassini")
@@ -35,25 +42,13 @@ except PackageNotFoundError:  # pragma: no cover
     __version__ = "unknown"
 
 
-async def create_mqtt_server():
-    mqtt = SimpleMQTTServer("0.0.0.0", 0)  # noqa: S104
-    await mqtt.start()
-    mqtt_server_task = asyncio.create_task(mqtt.serve_forever())
-    return mqtt, mqtt.port, mqtt_server_task
-
-
-async def create_http_server():
-    http = SimpleHTTPServer("0.0.0.0", 0)  # noqa: S104
-    await http.start()
-    http_server_task = asyncio.create_task(http.serve_forever())
-    return http, http.port, http_server_task
-
-
 def do_status(printers: list[SaturnPrinter]) -> Table:
     table = Table(
         title="Status",
         show_header=False,
     )
+    table.add_column("", style="green", justify="right")
+    table.add_column("", style="cyan", justify="left")
     for p in printers:
         p.refresh()
         attrs = p.desc["Data"]["Attributes"]
@@ -61,9 +56,6 @@ def do_status(printers: list[SaturnPrinter]) -> Table:
         print_info = status["PrintInfo"]
         file_info = status["FileTransferInfo"]
 
-        table.add_column("", style="green", justify="right")
-        table.add_column("", style="cyan", justify="left")
-
         table.add_row("IP address", f"{p.addr[0]}")
         table.add_row(f"{attrs['Name']}", f"{attrs['MachineName']}")
         table.add_row("Machine Status:", f"{CurrentStatus(status['CurrentStatus']).name}")
@@ -74,44 +66,127 @@ def do_status(printers: list[SaturnPrinter]) -> Table:
     return table
 
 
-def live_status(printers: list[SaturnPrinter]):
-    for p in printers:
-        p.refresh()
-        attrs = p.desc["Data"]["Attributes"]
-        status = p.desc["Data"]["Status"]
-        print_info = status["PrintInfo"]
-        file_info = status["FileTransferInfo"]
-        table = Table(
-            title="Status",
-            show_header=False,
-        )
+def do_history(history: StatusHistory, printer_id: str | None = None, since: float | None = None) -> Table:
+    table = Table(title="Print history")
+    table.add_column("Printer", style="green")
+    table.add_column("File", style="cyan")
+    table.add_column("Started")
+    table.add_column("Duration", justify="right")
+    table.add_column("Layers", justify="right")
+    table.add_column("Layers/min", justify="right")
+    table.add_column("Result")
+
+    printer_ids = [printer_id] if printer_id else history.printers()
+    for pid in printer_ids:
+        failures = history.failure_times(pid, start=since)
+        for p in history.print_durations(pid, start=since):
+            end = p["end"] if p["end"] is not None else time.time()
+            if p["end"] is None:
+                result = "printing"
+            elif p["completed"]:
+                result = "[green]completed[/]"
+            elif any(p["start"] <= f["time"] <= end for f in failures):
+                result = "[red]failed[/]"
+            else:
+                result = "[yellow]stopped[/]"
+            table.add_row(
+                pid,
+                p["filename"],
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(p["start"])),
+                f"{(end - p['start']) / 60:.1f} min",
+                f"{p['layers']}/{p['total_layers']}",
+                f"{history.layers_per_minute(pid, p['start'], end):.2f}",
+                result,
+            )
+    return table
 
-        table.add_column("", style="green", justify="right")
-        table.add_column("", style="cyan", justify="left")
 
-        table.add_row("IP address", f"{p.addr[0]}")
-        table.add_row(f"{attrs['Name']}", f"{attrs['MachineName']}")
-        table.add_row("Machine Status:", f"{CurrentStatus(status['CurrentStatus']).name}")
-        table.add_row("Print Status:", f"{PrintInfoStatus(print_info['Status']).name}")
-        table.add_row("Layers:", f"{print_info['CurrentLayer']}/{print_info['TotalLayer']}")
-        table.add_row("File:", f"{print_info['Filename']}")
-        table.add_row("File Transfer Status:", f"{FileStatus(file_info['Status']).name}")
+def do_analytics(history: StatusHistory, printer_id: str | None = None, since: float | None = None) -> Table:
+    table = Table(title="Fleet analytics")
+    table.add_column("Printer", style="green")
+    table.add_column("File", style="cyan")
+    table.add_column("Layers", justify="right")
+    table.add_column("Layer time", justify="right")
+    table.add_column("Exposure", justify="right")
+    table.add_column("ETA", justify="right")
+    table.add_column("Layers/h", justify="right")
+    table.add_column("Prints", justify="right")
+    table.add_column("Busy", justify="right")
+    table.add_column("Flags", style="red")
+
+    printer_ids = [printer_id] if printer_id else None
+    for pid, p in analyze_fleet(history, printer_ids=printer_ids, since=since).items():
+        flags = [name for name in ("stalled", "slowdown") if p.get(name)]
+        if p.get("slow_layers"):
+            flags.append(f"{len(p['slow_layers'])} slow layers")
+        current, total = p.get("current_layer"), p.get("total_layers")
+        layers = f"{current:.0f}/{total:.0f}" if current is not None and total is not None else ""
+        table.add_row(
+            pid,
+            p.get("filename") or "",
+            layers,
+            f"{p['layer_time']:.1f} s" if p.get("layer_time") is not None else "",
+            f"{p['exposure']:.1f} s" if p.get("exposure") is not None else "",
+            format_eta(p["eta"]) if p.get("eta") is not None else "",
+            f"{p['layers_per_hour']:.0f}",
+            f"{p['finished_prints']}",
+            f"{p['utilization']:.0%}",
+            ", ".join(flags),
+        )
+    return table
 
+
+async def do_replay(path: Path, speed: float = 1.0, history: StatusHistory | None = None) -> Table:
+    stats = await CaptureReplayer(path, history=history).replay(speed=speed)
+    table = Table(title=f"Replay of {path.name}", show_header=False)
+    table.add_column("", style="green", justify="right")
+    table.add_column("", style="cyan", justify="left")
+    table.add_row("Frames:", f"{stats['frames']}")
+    table.add_row("Printers:", f"{stats['printers']}")
+    table.add_row("Elapsed:", f"{stats['elapsed']:.3f} s")
+    table.add_row("Frames/s:", f"{stats['frames_per_second']:.0f}")
     return table
 
 
 def do_status_full(printers: list[SaturnPrinter]) -> None:
+    console = Console()
     for p in printers:
-        console = Console()
         console.print_json(data=p.desc)
 
 
+def do_status_records(printers: list[SaturnPrinter], output_format: OutputFormat) -> None:
+    RecordWriter(output_format).write(printers)
+
+
+# Stream one record per printer per interval, for the printers that answered in that interval
+def do_live_records(printers: list[SaturnPrinter], output_format: OutputFormat, interval: float = 1) -> None:
+    writer = RecordWriter(output_format)
+    while True:
+        started = time.monotonic()
+        if answered := SaturnPrinter.refresh_all(printers, timeout=interval):
+            writer.write(answered)
+        time.sleep(max(interval - (time.monotonic() - started), 0))
+
+
 def do_watch(
     printer_addr: SaturnPrinter,
     interval: int = 5,
+    history: StatusHistory | None = None,
+    output_format: OutputFormat = OutputFormat.TABLE,
 ):
-    printer = SaturnPrinter().find_printer(addr=printer_addr)
+    printer = resolve_printer(printer_addr)
+    if printer is None:
+        msg = f"No response from printer {printer_addr}"
+        logger.error(msg)
+        raise PrintersError(msg)
+    printer.history = history
+    if output_format != OutputFormat.TABLE:
+        watch_records(printer, output_format, interval)
+        return
     status = printer.status()
+    # the ETA comes from recent layer times when NumPy is there, and rich's estimate otherwise
+    clock = PrintClock(history, printer.id) if numpy_available() else None
+    remaining = TextColumn("ETA {task.fields[eta]}") if clock is not None else TimeRemainingColumn()
     previous_layer = 0
     with Progress(
         TextColumn("[progress.description]{task.description}"),
@@ -119,40 +194,140 @@ def do_watch(
         TaskProgressColumn(),
         MofNCompleteColumn(),
         TimeElapsedColumn(),
-        TimeRemainingColumn(),
+        remaining,
     ) as progress:
-        task = progress.add_task(description=f"Printing {status['filename']}", total=status["totalLayers"])
+        task = progress.add_task(description=f"Printing {status['filename']}", total=status["totalLayers"], eta="-:--")
         progress.start()
         while True:
-            # printer_addr is not an optional argument, so there's no need to search for all the printers
-            # printers = SaturnPrinter.find_printers(broadcast=broadcast)
-            # if len(printers) > 1:
-            printer = SaturnPrinter().find_printer(addr=printer_addr)
             status = printer.status()
             pct = status["currentLayer"] / status["totalLayers"]
-            progress.update(task, advance=status["currentLayer"] - previous_layer, completed=status["currentLayer"])
+            fields = {}
+            if clock is not None:
+                clock.observe(status["currentLayer"])
+                eta, stalled = clock.eta(status["totalLayers"])
+                fields["eta"] = "[red]stalled[/]" if stalled else format_eta(eta)
+            progress.update(
+                task,
+                advance=status["currentLayer"] - previous_layer,
+                completed=status["currentLayer"],
+                **fields,
+            )
             if pct >= 1.0:
                 break
             previous_layer = status["currentLayer"]
             time.sleep(interval)
 
 
-async def create_servers():
-    mqtt, *_ = await create_mqtt_server()
-    http, *_ = await create_http_server()
+def watch_records(printer: SaturnPrinter, output_format: OutputFormat, interval: int = 5) -> None:
+    writer = RecordWriter(output_format)
+    while True:
+        status = printer.status()
+        writer.write([printer])
+        if status["totalLayers"] > 0 and status["currentLayer"] >= status["totalLayers"]:
+            break
+        time.sleep(interval)
 
-    return mqtt, http
 
+def do_discover(printers: list[SaturnPrinter]) -> Table:
+    table = Table(title="Printers")
+    table.add_column("ID", style="green")
+    table.add_column("Name", style="cyan")
+    table.add_column("Machine")
+    table.add_column("IP address")
+    for p in printers:
+        table.add_row(p.id, p.name, p.machine_name, p.addr[0])
+    return table
 
-async def do_print(printer, filename):
-    mqtt, http = await create_servers()
-    connected = await printer.connect(mqtt, http)
-    if not connected:
-        msg = "Failed to connect to printer"
-        logger.error(msg)
-        raise ConnectionError(msg)
 
-    result = await printer.print_file(filename)
+def do_queue_list(queue: JobQueue) -> Table:
+    table = Table(title="Print queue")
+    table.add_column("ID", justify="right")
+    table.add_column("File", style="cyan")
+    table.add_column("Printer", style="green")
+    table.add_column("State")
+    table.add_column("Error", style="red")
+    for job in queue.jobs:
+        printer = job["assigned_to"] or job["printer"] or "any"
+        table.add_row(f"{job['id']}", Path(job["filename"]).name, printer, job["state"], job["error"] or "")
+    return table
+
+
+async def do_queue_run(
+    printers: list[SaturnPrinter],
+    queue: JobQueue,
+    *,
+    keep_running: bool = False,
+    rate_limit: int | None = None,
+    connection_rate_limit: int | None = None,
+    broker: str | None = None,
+    http_workers: int = 0,
+    stage_local: bool = False,
+    http_host: str | None = None,
+) -> None:
+    if not printers:
+        msg = "No printers to schedule jobs on"
+        logger.error(msg)
+        raise PrintersError(msg)
+    # all printers download from one HTTP server, so that rate limits apply to the fleet as a whole
+    http, *_ = await create_http_server(
+        rate_limit=rate_limit,
+        connection_rate_limit=connection_rate_limit,
+        workers=http_workers,
+        stage_local=stage_local,
+    )
+    scheduler = FleetScheduler(
+        queue, printers, http=http, exit_when_empty=not keep_running, broker=broker, http_host=http_host
+    )
+    lag = LoopLagMonitor()
+    lag.start()
+    try:
+        await scheduler.run()
+    finally:
+        lag.stop()
+        logger.info(f"Queue run {lag.summary()}")
+        await http.close()
+
+
+# Record the status of every printer on a broker into the history database. Workers given the
+# same share_group split the fleet's status messages between them.
+async def do_record(broker: str, history: StatusHistory, share_group: str | None = None) -> None:
+    mqtt, *_ = await create_mqtt_server(broker=broker, share_group=share_group)
+    count = 0
+    try:
+        async for printer_id, payload in mqtt.status_messages():
+            history.record(printer_id, codec.loads(payload)["Data"]["Status"])
+            count += 1
+            if count % 1000 == 0:
+                logger.info(f"Recorded {count} status messages")
+    finally:
+        await mqtt.close()
+
+
+# A session from pool, or from a pool of our own that is closed again when the operation is done
+@contextlib.asynccontextmanager
+async def printer_session(printer, pool=None, stage=None, **pool_options):
+    if pool is not None:
+        async with pool.session(printer, stage=stage) as session:
+            yield session
+        return
+    async with (
+        SessionPool(**pool_options) as own_pool,
+        own_pool.session(printer, stage=stage) as session,
+    ):
+        yield session
+
+
+# With a pool, the printer's session in it is reused (and capture and broker are the pool's)
+async def do_print(printer, filename, capture=None, broker=None, pool=None):
+    async with printer_session(printer, pool, capture=capture, broker=broker) as session:
+        await start_print(session, filename)
+
+
+async def start_print(printer, filename):
+    try:
+        result = await printer.print_file(filename)
+    except CommandError as e:
+        raise PrintError(str(e)) from e
     if result:
         logger.info("Print started")
     else:
@@ -161,41 +336,75 @@ async def do_print(printer, filename):
         raise PrintError(msg)
 
 
-async def do_upload(printer: SaturnPrinter, filename: Path):
+# With start_printing, the print is started over the same connection as soon as the printer
+# reports the transfer as done
+async def do_upload(
+    printer: SaturnPrinter,
+    filename: Path,
+    *,
+    capture=None,
+    start_printing: bool = False,
+    rate_limit: int | None = None,
+    broker: str | None = None,
+    pool=None,
+    stage_local: bool = False,
+    http_host: str | None = None,
+):
     if not Path(filename).exists():
         msg = f"{filename} does not exist"
         logger.error(msg)
         raise FileNotFoundError(msg)
 
-    mqtt, http = await create_servers()
-    connected = await printer.connect(mqtt, http)
-    if not connected:
-        msg = "Failed to connect to printer"
-        logger.error(msg)
-        raise ConnectionError(msg)
-
-    upload_task = asyncio.create_task(printer.upload_file(filename))
-    # grab the first one, because we want the file size
-    basename = filename.name
-    file_size = filename.stat().st_size
-    with Progress() as progress:
-        task = progress.add_task(description=basename, total=file_size)
-        while True:
-            if printer.file_transfer_future is None:
-                await asyncio.sleep(0.1)
-                continue
-            print_progress = await printer.file_transfer_future
-            if print_progress[0] < 0:
-                msg = "File upload failed!"
-                logger.error(msg)
-                raise UploadError(msg)
-            progress.update(task, advance=print_progress[0])
-            if print_progress[0] >= print_progress[1]:
-                break
-    await upload_task
+    async with printer_session(
+        printer,
+        pool,
+        stage=filename,
+        capture=capture,
+        rate_limit=rate_limit,
+        broker=broker,
+        stage_local=stage_local,
+        http_host=http_host,
+    ) as session:
+        await upload_with_progress(session, filename, start_printing=start_printing)
+
+
+def format_rate(rate: float) -> str:
+    return f"{rate / 1024:.0f} KiB/s" if rate > 0 else ""
+
+
+def format_eta(eta: float | None) -> str:
+    if eta is None:
+        return "-:--"
+    minutes, seconds = divmod(round(eta), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+# The progress bar follows the offsets the printer reports, with the rate and ETA computed from them
+async def upload_with_progress(printer, filename, start_printing=False):
+    with Progress(
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        TaskProgressColumn(),
+        TextColumn("{task.fields[rate]}"),
+        TextColumn("ETA {task.fields[eta]}"),
+    ) as progress:
+        task = progress.add_task(description=filename.name, total=filename.stat().st_size, rate="", eta="-:--")
+        async for update in printer.upload_progress(filename):
+            progress.update(
+                task,
+                completed=update.offset,
+                rate=format_rate(update.rate),
+                eta=format_eta(update.eta),
+                **({"total": update.total} if update.total > 0 else {}),
+            )
+    if start_printing:
+        await start_print(printer, update.filename)
 
 
-def find_printer_addr(broadcast="<broadcast>") -> str:
+def find_printer_addr(broadcast=None) -> str:
     printers = get_printers(broadcast=broadcast)
     match len(printers):
         case 1:
@@ -0,0 +1,81 @@
+"""
+Compressed copies of print files for transfers with the UPLOAD_FILE ``Compress`` flag set
+
+Each file is compressed once and kept in a cache directory under the MD5 of the original,
+so uploading the same file again (to the same or another printer) reuses the compressed
+copy. The printer's expected compressed format isn't documented; gzip is used, which
+is why compressed transfers are only available through the API (``compress=True``) and not
+from the command line until the format has been confirmed on a printer.
+"""
+
+import contextlib
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Final
+
+from loguru import logger
+
+COMPRESSED_SUFFIX: Final[str] = ".gz"
+COMPRESSION_LEVEL: Final[int] = 6
+READ_SIZE: Final[int] = 1024768
+
+
+def default_cache_dir() -> Path:
+    if xdg_cache_home := os.environ.get("XDG_CACHE_HOME"):
+        return Path(xdg_cache_home) / "cassini" / "compressed"
+    return Path.home() / ".cache" / "cassini" / "compressed"
+
+
+def file_md5(filename: Path | str) -> str:
+    # TODO: can we replace use of hashlib?
+    md5 = hashlib.md5()  # noqa: S324
+    with open(filename, "rb") as f:
+        while data := f.read(READ_SIZE):
+            md5.update(data)
+    return md5.hexdigest()
+
+
+class CompressedFileCache:
+    def __init__(self, cache_dir: Path | str | None = None, level: int = COMPRESSION_LEVEL):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else default_cache_dir()
+        self.level = level
+
+    # Return the path of the compressed copy of filename, creating it if it isn't cached yet
+    def get(self, filename: Path | str, md5: str | None = None) -> Path:
+        md5 = md5 or file_md5(filename)
+        compressed = self.cache_dir / f"{md5}{COMPRESSED_SUFFIX}"
+        if compressed.exists():
+            logger.debug(f"Using cached compressed copy of {filename}: {compressed}")
+            return compressed
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # a temporary file of our own, so another process compressing the same file doesn't write into it
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=f"{md5}.", suffix=".tmp")
+        try:
+            with (
+                open(filename, "rb") as src,
+                open(fd, "wb") as raw,
+                gzip.GzipFile(filename="", mode="wb", compresslevel=self.level, fileobj=raw) as dst,
+            ):
+                shutil.copyfileobj(src, dst, READ_SIZE)
+            os.replace(tmp, compressed)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp)
+            raise
+
+        original_size = os.path.getsize(filename)
+        compressed_size = os.path.getsize(compressed)
+        logger.info(
+            f"Compressed {filename}: {original_size} -> {compressed_size} bytes "
+            f"({100 * compressed_size / max(original_size, 1):.0f}%)"
+        )
+        return compressed
+
+    def clear(self) -> None:
+        for f in self.cache_dir.glob(f"*{COMPRESSED_SUFFIX}"):
+            f.unlink()
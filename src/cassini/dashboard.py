@@ -0,0 +1,132 @@
+"""
+Live status table for any number of printers
+
+``StatusDashboard`` builds its table once and keeps one row of ``Text`` cells per printer.
+``update`` recomputes a printer's cells and queues them only when one of them changed, and
+when ``rich.live.Live`` asks for a frame the queued rows are written into their cells, with
+rows added for printers seen for the first time, so only the rows that changed are touched.
+Status is collected by ``refreshing`` in a thread of its own, so neither the batched probe
+nor the wait for answers holds up a frame: Live draws at its own fixed rate from whatever the
+last batch of updates left in the model.
+"""
+
+import contextlib
+import threading
+import time
+
+from rich.table import Table
+from rich.text import Text
+
+from cassini.saturn_printer import CurrentStatus, FileStatus, PrintInfoStatus, SaturnPrinter
+
+COLUMNS = (
+    ("Printer", {"style": "green", "no_wrap": True}),
+    ("Machine", {"style": "cyan"}),
+    ("IP address", {}),
+    ("Machine Status", {}),
+    ("Print Status", {}),
+    ("Layers", {"justify": "right"}),
+    ("File", {"style": "cyan", "overflow": "ellipsis", "no_wrap": True}),
+    ("File Transfer", {}),
+)
+
+
+def enum_name(enum, value) -> str:
+    try:
+        return enum(value).name
+    except ValueError:
+        return f"{value}"
+
+
+def status_cells(printer: SaturnPrinter) -> tuple[str, ...]:
+    attrs = printer.desc["Data"]["Attributes"]
+    status = printer.desc["Data"]["Status"]
+    print_info = status["PrintInfo"]
+    return (
+        attrs["Name"],
+        attrs["MachineName"],
+        printer.addr[0],
+        enum_name(CurrentStatus, status["CurrentStatus"]),
+        enum_name(PrintInfoStatus, print_info["Status"]),
+        f"{print_info['CurrentLayer']}/{print_info['TotalLayer']}",
+        print_info["Filename"],
+        enum_name(FileStatus, status["FileTransferInfo"]["Status"]),
+    )
+
+
+class StatusDashboard:
+    def __init__(self, printers: list[SaturnPrinter], title: str = "Status"):
+        self.lock = threading.Lock()
+        # printer id -> last computed cells, in the order printers were first seen
+        self.rows: dict[str, tuple[str, ...]] = {}
+        self.stale: set[str] = set()
+        # printer id -> rows changed since the last frame
+        self.changed: dict[str, tuple[str, ...]] = {}
+        # printer id -> (row index, cells shown in the table)
+        self.shown: dict[str, tuple[int, list[Text]]] = {}
+        self.table = Table(title=title)
+        for name, options in COLUMNS:
+            self.table.add_column(name, **options)
+        self.updated = None
+        for p in printers:
+            self.update(p)
+
+    def update(self, printer: SaturnPrinter, answered: bool = True) -> bool:
+        cells = status_cells(printer)
+        with self.lock:
+            changed = self.rows.get(printer.id) != cells or (printer.id in self.stale) == answered
+            if changed:
+                self.rows[printer.id] = cells
+                if answered:
+                    self.stale.discard(printer.id)
+                else:
+                    self.stale.add(printer.id)
+                self.changed[printer.id] = cells
+            self.updated = time.time()
+        return changed
+
+    # Refresh all printers with one batched probe and fold the answers into the table
+    def refresh(self, printers: list[SaturnPrinter], timeout: float = 1) -> int:
+        answered = {p.id for p in SaturnPrinter.refresh_all(printers, timeout=timeout)}
+        return sum(self.update(p, answered=p.id in answered) for p in printers)
+
+    # Refresh the printers every interval seconds in a background thread while the block runs
+    @contextlib.contextmanager
+    def refreshing(self, printers: list[SaturnPrinter], interval: float = 1):
+        stopped = threading.Event()
+
+        def run():
+            while not stopped.is_set():
+                started = time.monotonic()
+                self.refresh(printers, timeout=interval)
+                stopped.wait(max(interval - (time.monotonic() - started), 0))
+
+        thread = threading.Thread(target=run, name="dashboard-refresh", daemon=True)
+        thread.start()
+        try:
+            yield thread
+        finally:
+            stopped.set()
+            thread.join()
+
+    # Write the rows that changed since the last frame into the table. This runs in Live's
+    # thread, just before the table is drawn, so the cells don't change while they are drawn.
+    def render(self) -> Table:
+        with self.lock:
+            changed, self.changed = self.changed, {}
+            for printer_id, cells in changed.items():
+                style = "dim" if printer_id in self.stale else None
+                if printer_id not in self.shown:
+                    texts = [Text(cell) for cell in cells]
+                    self.table.add_row(*texts, style=style)
+                    self.shown[printer_id] = (len(self.table.rows) - 1, texts)
+                    continue
+                index, texts = self.shown[printer_id]
+                for text, cell in zip(texts, cells, strict=True):
+                    if text.plain != cell:
+                        text.plain = cell
+                self.table.rows[index].style = style
+        return self.table
+
+    def __rich__(self) -> Table:
+        return self.render()
@@ -0,0 +1,157 @@
+"""
+Network discovery helpers and the registry of known printers
+
+``broadcast_addresses`` lists the directed-broadcast address of every local IPv4
+interface (via psutil when it is installed, otherwise via ioctl on Linux), so a probe
+reaches printers on every attached subnet and not just the one behind the default route.
+``PrinterRegistry`` remembers every printer that answered, keyed by MainboardID, along with
+any aliases given to it, so later commands can ask the known printers directly by unicast
+instead of broadcasting, and can name a printer by its MainboardID, Name or an alias. Changes
+are made under a lock on the registry file and on its latest contents, so commands running at
+the same time don't lose each other's printers and aliases.
+"""
+
+import contextlib
+import os
+import socket
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Final
+
+from loguru import logger
+
+from cassini import codec
+from cassini.locking import file_lock
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+LIMITED_BROADCAST: Final[str] = "<broadcast>"
+SIOCGIFBRDADDR: Final[int] = 0x8919
+
+
+def psutil_broadcast_addresses() -> list[str] | None:
+    if psutil is None:
+        return None
+    return [
+        addr.broadcast
+        for addrs in psutil.net_if_addrs().values()
+        for addr in addrs
+        if addr.family == socket.AF_INET and addr.broadcast and not addr.address.startswith("127.")
+    ]
+
+
+def ioctl_broadcast_addresses() -> list[str] | None:
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return None
+    addresses = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, name in socket.if_nameindex():
+            if name == "lo":
+                continue
+            try:
+                ifreq = fcntl.ioctl(sock.fileno(), SIOCGIFBRDADDR, struct.pack("256s", name.encode()[:15]))
+            except OSError:
+                # no IPv4 address or no broadcast on this interface
+                continue
+            addresses.append(socket.inet_ntoa(ifreq[20:24]))
+    return addresses
+
+
+# Directed-broadcast addresses of all local interfaces, plus the limited broadcast address
+def broadcast_addresses() -> list[str]:
+    addresses = psutil_broadcast_addresses()
+    if addresses is None:
+        addresses = ioctl_broadcast_addresses() or []
+    addresses = [a for a in dict.fromkeys(addresses) if a != "0.0.0.0"]  # noqa: S104
+    logger.debug(f"Broadcast addresses: {addresses}")
+    return [*addresses, LIMITED_BROADCAST]
+
+
+class PrinterRegistry:
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self.lock_path = self.path.with_suffix(f"{self.path.suffix}.lock")
+        self.printers: dict[str, dict] = {}
+        self.load()
+
+    def load(self) -> None:
+        if not self.path.exists():
+            return
+        try:
+            self.printers = codec.loads(self.path.read_bytes())
+        except ValueError:
+            logger.warning(f"Ignoring unreadable printer registry {self.path}")
+            self.printers = {}
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f"{self.path.suffix}.tmp")
+        tmp.write_bytes(codec.dumps(self.printers))
+        os.replace(tmp, self.path)
+
+    # Make a change to the latest state of the registry file and save it, with the file locked so
+    # that changes made by other processes in the meantime aren't lost
+    @contextlib.contextmanager
+    def transaction(self):
+        with file_lock(self.lock_path):
+            self.load()
+            yield
+            self.save()
+
+    # Record the printers that just answered a probe
+    def update(self, printers) -> None:
+        if not printers:
+            return
+        now = time.time()
+        with self.transaction():
+            for p in printers:
+                entry = self.printers.setdefault(p.id, {"aliases": []})
+                entry.update(
+                    {
+                        "id": p.id,
+                        "name": p.name,
+                        "machine_name": p.machine_name,
+                        "addr": p.addr[0],
+                        "last_seen": now,
+                    }
+                )
+
+    def get(self, printer_id: str) -> dict | None:
+        return self.printers.get(printer_id)
+
+    # Look a printer up by MainboardID, alias or Name (the last two case-insensitively)
+    def find(self, name: str) -> dict | None:
+        if (entry := self.printers.get(name)) is not None:
+            return entry
+        folded = name.casefold()
+        for entry in self.printers.values():
+            if folded in (alias.casefold() for alias in entry.get("aliases", [])):
+                return entry
+        return next((entry for entry in self.printers.values() if entry["name"].casefold() == folded), None)
+
+    def add_alias(self, printer_id: str, alias: str) -> None:
+        with self.transaction():
+            for entry in self.printers.values():
+                if alias in entry.get("aliases", []):
+                    entry["aliases"].remove(alias)
+            self.printers[printer_id].setdefault("aliases", []).append(alias)
+
+    def by_addr(self, addr: str) -> dict | None:
+        return next((p for p in self.printers.values() if p["addr"] == addr), None)
+
+    def addresses(self) -> list[str]:
+        return [p["addr"] for p in self.printers.values()]
+
+    def forget(self, printer_id: str) -> None:
+        with self.transaction():
+            self.printers.pop(printer_id, None)
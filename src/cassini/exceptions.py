@@ -8,3 +8,18 @@ class UploadError(Exception):
 
 class PrintersError(Exception):
     pass
+
+
+# The printer answered a command with a non-zero Ack
+class CommandError(Exception):
+    def __init__(self, msg, command, ack):
+        super().__init__(msg)
+        self.command = command
+        self.ack = ack
+
+
+# The printer reported a file transfer as failed; offset is the last DownloadOffset it reported
+class TransferError(UploadError):
+    def __init__(self, msg, offset=0):
+        super().__init__(msg)
+        self.offset = offset
@@ -0,0 +1,224 @@
+"""
+Append-only on-disk history of printer status messages
+
+Status messages are flattened (``PrintInfo.CurrentLayer`` etc.) and only the fields that
+changed since the previous message for the same printer are stored, with a full keyframe
+every ``keyframe_interval`` rows so that reads never have to walk far back. Fields that a
+message no longer has are listed under ``DELETED_FIELDS`` in its delta. Writes are
+buffered and committed in batches, and the database runs in WAL mode with
+``synchronous=NORMAL`` so there is no fsync per message.
+"""
+
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Final
+
+from loguru import logger
+
+from cassini import codec
+from cassini.saturn_printer import ACTIVE_PRINT_STATES, FileStatus, PrintInfoStatus
+
+DEFAULT_BATCH_SIZE: Final[int] = 64
+DEFAULT_FLUSH_INTERVAL: Final[float] = 5.0
+DEFAULT_KEYFRAME_INTERVAL: Final[int] = 256
+
+LAYER_FIELD: Final[str] = "PrintInfo.CurrentLayer"
+PRINT_STATUS_FIELD: Final[str] = "PrintInfo.Status"
+ERROR_FIELD: Final[str] = "PrintInfo.ErrorNumber"
+FILENAME_FIELD: Final[str] = "PrintInfo.Filename"
+TOTAL_LAYERS_FIELD: Final[str] = "PrintInfo.TotalLayer"
+TRANSFER_STATUS_FIELD: Final[str] = "FileTransferInfo.Status"
+# key of a delta row listing the fields the message no longer has; status keys never start with _
+DELETED_FIELDS: Final[str] = "_deleted"
+
+FINISHED_PRINT_STATES: Final[frozenset[int]] = frozenset({PrintInfoStatus.FINISHED, PrintInfoStatus.COMPLETE})
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS status (
+    printer_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    keyframe INTEGER NOT NULL,
+    fields BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS status_printer_ts ON status (printer_id, ts);
+"""
+
+
+def flatten_status(status: dict, prefix: str = "") -> dict[str, Any]:
+    flat = {}
+    for key, value in status.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten_status(value, f"{name}."))
+        else:
+            flat[name] = value
+    return flat
+
+
+class StatusHistory:
+    def __init__(
+        self,
+        path: Path | str,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        keyframe_interval: int = DEFAULT_KEYFRAME_INTERVAL,
+        read_only: bool = False,
+    ):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.keyframe_interval = keyframe_interval
+
+        if read_only:
+            # reading must not leave an empty database behind where there was none
+            if not self.path.exists():
+                msg = f"No status history at {self.path}"
+                raise FileNotFoundError(msg)
+            self.db = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+
+        self.pending = []
+        self.last_flush = time.monotonic()
+        # per printer: (last full flattened status, rows since the last keyframe)
+        self.last_state: dict[str, tuple[dict, int]] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, printer_id: str, status: dict, timestamp: float | None = None) -> None:
+        timestamp = time.time() if timestamp is None else timestamp
+        flat = flatten_status(status)
+
+        previous, since_keyframe = self.last_state.get(printer_id, (None, self.keyframe_interval))
+        if previous is None or since_keyframe >= self.keyframe_interval:
+            self.pending.append((printer_id, timestamp, 1, codec.dumps(flat)))
+            since_keyframe = 0
+        else:
+            delta = {k: v for k, v in flat.items() if k not in previous or previous[k] != v}
+            if deleted := [k for k in previous if k not in flat]:
+                delta[DELETED_FIELDS] = deleted
+            if not delta:
+                return
+            self.pending.append((printer_id, timestamp, 0, codec.dumps(delta)))
+            since_keyframe += 1
+        self.last_state[printer_id] = (flat, since_keyframe)
+
+        if len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            with self.db:
+                self.db.executemany(
+                    "INSERT INTO status (printer_id, ts, keyframe, fields) VALUES (?, ?, ?, ?)", self.pending
+                )
+            logger.debug(f"Wrote {len(self.pending)} status rows to {self.path}")
+            self.pending = []
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        self.flush()
+        self.db.close()
+
+    def printers(self) -> list[str]:
+        self.flush()
+        return [row[0] for row in self.db.execute("SELECT DISTINCT printer_id FROM status ORDER BY printer_id")]
+
+    # Yield (timestamp, full flattened status) for every stored message of a printer in [start, end]
+    def snapshots(self, printer_id: str, start: float | None = None, end: float | None = None):
+        self.flush()
+        start = float("-inf") if start is None else start
+        end = float("inf") if end is None else end
+
+        # rebuild state from the last keyframe at or before the start of the range
+        row = self.db.execute(
+            "SELECT MAX(rowid) FROM status WHERE printer_id = ? AND keyframe = 1 AND ts <= ?",
+            (printer_id, start),
+        ).fetchone()
+        first_rowid = row[0] if row[0] is not None else 0
+
+        state = {}
+        rows = self.db.execute(
+            "SELECT ts, keyframe, fields FROM status WHERE printer_id = ? AND rowid >= ? AND ts <= ? ORDER BY rowid",
+            (printer_id, first_rowid, end),
+        )
+        for ts, keyframe, fields in rows:
+            changes = codec.loads(fields)
+            if keyframe:
+                state = changes
+            else:
+                for k in changes.pop(DELETED_FIELDS, ()):
+                    state.pop(k, None)
+                state.update(changes)
+            if ts >= start:
+                yield ts, dict(state)
+
+    def series(
+        self, printer_id: str, fields: list[str], start: float | None = None, end: float | None = None
+    ) -> list[tuple]:
+        return [(ts, *(state.get(f) for f in fields)) for ts, state in self.snapshots(printer_id, start, end)]
+
+    def layers_per_minute(self, printer_id: str, start: float | None = None, end: float | None = None) -> float:
+        layers = 0
+        first_ts = last_ts = previous_layer = None
+        for ts, layer in self.series(printer_id, [LAYER_FIELD], start, end):
+            if first_ts is None:
+                first_ts = ts
+            last_ts = ts
+            if previous_layer is not None and layer is not None and layer > previous_layer:
+                layers += layer - previous_layer
+            previous_layer = layer
+        if first_ts is None or last_ts == first_ts:
+            return 0.0
+        return layers / ((last_ts - first_ts) / 60)
+
+    # Each print is reported as a dict with the file, start/end time, duration, layers reached and
+    # whether it ran to completion. A print that is still running has an end of None.
+    def print_durations(self, printer_id: str, start: float | None = None, end: float | None = None) -> list[dict]:
+        prints = []
+        current = None
+        fields = [PRINT_STATUS_FIELD, FILENAME_FIELD, LAYER_FIELD, TOTAL_LAYERS_FIELD]
+        for ts, print_status, filename, layer, total_layers in self.series(printer_id, fields, start, end):
+            if current is None and print_status in ACTIVE_PRINT_STATES:
+                current = {
+                    "filename": filename,
+                    "start": ts,
+                    "end": None,
+                    "duration": None,
+                    "layers": layer,
+                    "total_layers": total_layers,
+                    "completed": False,
+                }
+            elif current is not None:
+                current["layers"] = layer
+                if print_status not in ACTIVE_PRINT_STATES:
+                    current["end"] = ts
+                    current["duration"] = ts - current["start"]
+                    current["completed"] = print_status in FINISHED_PRINT_STATES
+                    prints.append(current)
+                    current = None
+        if current is not None:
+            prints.append(current)
+        return prints
+
+    # Times at which the printer reported a print error or a failed file transfer
+    def failure_times(self, printer_id: str, start: float | None = None, end: float | None = None) -> list[dict]:
+        failures = []
+        previous_error = previous_transfer = None
+        fields = [ERROR_FIELD, TRANSFER_STATUS_FIELD, FILENAME_FIELD]
+        for ts, error, transfer, filename in self.series(printer_id, fields, start, end):
+            if error and error != previous_error:
+                failures.append({"time": ts, "kind": "print", "error": error, "filename": filename})
+            if transfer == FileStatus.ERROR and previous_transfer != FileStatus.ERROR:
+                failures.append({"time": ts, "kind": "transfer", "error": transfer, "filename": filename})
+            previous_error, previous_transfer = error, transfer
+        return failures
@@ -0,0 +1,36 @@
+"""
+Locking state files shared between cassini processes
+
+The job queue and the registry of known printers can be changed by several commands at once
+(``queue add`` while ``queue run`` works through the queue, or two ``discover`` runs), so each
+change is made while holding an exclusive lock on a separate lock file next to the state file.
+"""
+
+import contextlib
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+    import msvcrt
+
+
+# Hold an exclusive lock on path (created if needed), waiting for other processes to release it
+@contextlib.contextmanager
+def file_lock(path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
@@ -0,0 +1,249 @@
+"""
+Event loop selection and multi-process file serving
+
+``use_uvloop`` switches asyncio over to uvloop when it is installed (the ``fast`` extra),
+which makes the MQTT and HTTP servers noticeably cheaper per connection.
+
+``HTTPWorkerPool`` runs extra processes that each serve the HTTP server's routes on the same
+port through ``SO_REUSEPORT``, so that the kernel spreads printer downloads over several
+cores. Only file serving is spread out: routes are registered in the main process, which
+also keeps every MQTT connection, and are copied to the workers over a pipe. The total
+rate limit is split evenly between the processes, and the transfer statistics of the
+HTTP server only cover what the main process served itself.
+
+``LoopLagMonitor`` measures how late the event loop wakes up from a short sleep, which is
+how long anything blocking the loop delayed every MQTT message and HTTP transfer in the
+process.
+"""
+
+import asyncio
+import contextlib
+import multiprocessing
+import socket
+import time
+from collections import deque
+from typing import Final
+
+from loguru import logger
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from cassini.simple_http_server import SimpleHTTPServer
+
+WORKER_SYNC_TIMEOUT: Final[float] = 5.0
+WORKER_STOP_TIMEOUT: Final[float] = 2.0
+LAG_INTERVAL: Final[float] = 0.1
+LAG_WARNING: Final[float] = 0.05
+LAG_SAMPLES: Final[int] = 1000
+
+
+def use_uvloop() -> bool:
+    if uvloop is None:
+        logger.warning("uvloop is not installed, using the default asyncio event loop")
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def uvloop_active() -> bool:
+    return type(asyncio.get_event_loop_policy()).__module__.startswith("uvloop")
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = LAG_INTERVAL, warning: float = LAG_WARNING):
+        self.interval = interval
+        self.warning = warning
+        self.samples = deque(maxlen=LAG_SAMPLES)
+        self.max_lag = 0.0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - expected, 0.0)
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.warning:
+                logger.warning(f"Event loop was blocked for {lag * 1000:.0f} ms")
+
+    # Lag in seconds over the recent samples (p99 and mean) and since start (max)
+    def stats(self) -> dict:
+        if not self.samples:
+            return {"samples": 0, "mean": 0.0, "p99": 0.0, "max": 0.0}
+        ordered = sorted(self.samples)
+        return {
+            "samples": len(ordered),
+            "mean": sum(ordered) / len(ordered),
+            "p99": ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)],
+            "max": self.max_lag,
+        }
+
+    def summary(self) -> str:
+        stats = self.stats()
+        return (
+            f"event loop lag over {stats['samples']} samples: mean {stats['mean'] * 1000:.1f} ms, "
+            f"p99 {stats['p99'] * 1000:.1f} ms, max {stats['max'] * 1000:.1f} ms"
+        )
+
+
+def reuse_port_supported() -> bool:
+    return hasattr(socket, "SO_REUSEPORT")
+
+
+# Route as sent to the workers; the bookkeeping the main process keeps in it doesn't pickle
+def worker_route(route: dict) -> dict:
+    return {k: route[k] for k in ("file", "size", "md5", "compressed", "weight")}
+
+
+class HTTPWorkerPool:
+    def __init__(self, host, port, workers, *, rate_limit=None, connection_rate_limit=None, with_uvloop=None):
+        self.host = host
+        self.port = port
+        self.count = workers
+        self.rate_limit = rate_limit
+        self.connection_rate_limit = connection_rate_limit
+        self.with_uvloop = uvloop_active() if with_uvloop is None else with_uvloop
+        self.processes = []
+        self.connections = []
+        self.sync_seq = 0
+        # (connection, sequence number) -> future resolved when that worker has caught up
+        self.pending_syncs = {}
+
+    async def start(self):
+        # spawned rather than forked, so the workers don't inherit our running event loop
+        ctx = multiprocessing.get_context("spawn")
+        loop = asyncio.get_running_loop()
+        for _ in range(self.count):
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=run_http_worker,
+                args=(self.host, self.port, child_conn),
+                kwargs={
+                    "rate_limit": self.rate_limit,
+                    "connection_rate_limit": self.connection_rate_limit,
+                    "with_uvloop": self.with_uvloop,
+                },
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self.processes.append(process)
+            self.connections.append(conn)
+            loop.add_reader(conn.fileno(), self.handle_reply, conn)
+        await self.sync()
+        logger.debug(f"HTTP started {self.count} worker processes on port {self.port}")
+
+    def add_route(self, path, route):
+        self.send(("add", path, worker_route(route)))
+
+    def remove_route(self, path):
+        self.send(("remove", path))
+
+    def send(self, message):
+        for conn in self.connections:
+            try:
+                conn.send(message)
+            except OSError as e:
+                logger.error(f"HTTP worker connection failed: {e}")
+                self.drop(conn)
+
+    # Wait until every worker has applied all route changes sent so far
+    async def sync(self):
+        self.sync_seq += 1
+        loop = asyncio.get_running_loop()
+        futures = []
+        for conn in self.connections:
+            future = loop.create_future()
+            self.pending_syncs[(conn, self.sync_seq)] = future
+            futures.append(future)
+        self.send(("sync", self.sync_seq))
+        try:
+            await asyncio.wait_for(asyncio.gather(*futures), timeout=WORKER_SYNC_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("HTTP workers did not confirm route changes in time")
+        finally:
+            for conn in list(self.connections):
+                self.pending_syncs.pop((conn, self.sync_seq), None)
+
+    def handle_reply(self, conn):
+        try:
+            _, seq = conn.recv()
+        except (EOFError, OSError):
+            logger.error("HTTP worker process exited")
+            self.drop(conn)
+            return
+        if (future := self.pending_syncs.pop((conn, seq), None)) is not None and not future.done():
+            future.set_result(None)
+
+    def drop(self, conn):
+        if conn not in self.connections:
+            return
+        self.connections.remove(conn)
+        with contextlib.suppress(ValueError, OSError):
+            asyncio.get_running_loop().remove_reader(conn.fileno())
+        for (c, _), future in list(self.pending_syncs.items()):
+            if c is conn and not future.done():
+                future.set_result(None)
+        conn.close()
+
+    async def stop(self):
+        self.send(("stop",))
+        for conn in list(self.connections):
+            self.drop(conn)
+        # joining blocks, so it mustn't hold up the loop
+        await asyncio.get_running_loop().run_in_executor(None, self.join)
+
+    def join(self):
+        for process in self.processes:
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+
+def run_http_worker(host, port, conn, *, rate_limit, connection_rate_limit, with_uvloop):
+    if with_uvloop:
+        use_uvloop()
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve_http_worker(host, port, conn, rate_limit, connection_rate_limit))
+
+
+async def serve_http_worker(host, port, conn, rate_limit, connection_rate_limit):
+    http = SimpleHTTPServer(host, port, rate_limit=rate_limit, connection_rate_limit=connection_rate_limit)
+    http.reuse_port = True
+    await http.start()
+    stopped = asyncio.get_running_loop().create_future()
+
+    def handle_message():
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            # the main process went away
+            message = ("stop",)
+        match message:
+            case ("add", path, route):
+                http.routes[path] = route
+            case ("remove", path):
+                http.unregister_file_route(path)
+            case ("sync", seq):
+                conn.send(("synced", seq))
+            case ("stop",):
+                if not stopped.done():
+                    stopped.set_result(None)
+
+    asyncio.get_running_loop().add_reader(conn.fileno(), handle_message)
+    server_task = asyncio.create_task(http.serve_forever())
+    await stopped
+    server_task.cancel()
@@ -23,7 +23,7 @@ class Printer(ABC):
         pass
 
     @abstractmethod
-    async def upload_file(self, filename):
+    async def upload_file(self, filename, compress=False):
         pass
 
     @abstractmethod
@@ -0,0 +1,67 @@
+"""
+File transfer progress
+
+``ProgressTracker`` turns the ``DownloadOffset`` of every status update a printer sends
+during a transfer into a ``TransferProgress``, with the time it was received, a smoothed
+transfer rate and the estimated time left, and hands each one to an observer as soon as it
+arrives. The last update of a transfer has ``done`` set, and ``failed`` too if the transfer
+didn't succeed.
+"""
+
+import time
+from collections.abc import Callable
+from typing import Final, NamedTuple
+
+# weight of the newest rate sample in the smoothed rate
+RATE_SMOOTHING: Final[float] = 0.3
+
+
+class TransferProgress(NamedTuple):
+    offset: int
+    total: int
+    filename: str
+    timestamp: float
+    # bytes per second, smoothed over recent updates
+    rate: float
+    # seconds left at the current rate, or None while the rate is unknown
+    eta: float | None
+    done: bool = False
+    failed: bool = False
+
+    @property
+    def fraction(self) -> float:
+        return self.offset / self.total if self.total > 0 else 0.0
+
+
+class ProgressTracker:
+    def __init__(self, observer: Callable[[TransferProgress], object] | None = None):
+        self.observer = observer
+        self.rate = 0.0
+        self.last = None
+        self.latest = None
+
+    def update(self, offset: int, total: int, filename: str) -> TransferProgress:
+        now = time.monotonic()
+        if self.last is not None:
+            last_offset, last_time = self.last
+            if now > last_time and offset >= last_offset:
+                sample = (offset - last_offset) / (now - last_time)
+                self.rate = sample if self.rate == 0.0 else RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * self.rate
+        self.last = (offset, now)
+        eta = (total - offset) / self.rate if self.rate > 0 else None
+        return self.emit(TransferProgress(offset, total, filename, time.time(), self.rate, eta))
+
+    def finish(self, total: int, filename: str, failed: bool = False) -> TransferProgress:
+        offset = total
+        if failed:
+            offset = self.last[0] if self.last is not None else 0
+        eta = None if failed else 0.0
+        return self.emit(
+            TransferProgress(offset, total, filename, time.time(), self.rate, eta, done=True, failed=failed)
+        )
+
+    def emit(self, progress: TransferProgress) -> TransferProgress:
+        self.latest = progress
+        if self.observer is not None:
+            self.observer(progress)
+        return progress
@@ -0,0 +1,88 @@
+"""
+Machine-readable status output
+
+``RecordWriter`` writes one flat record per printer per update straight to a binary
+stream, as newline-delimited JSON or CSV, without going through rich. Every record has the
+same fields (``RECORD_FIELDS``), so the output can be fed to log shippers or time-series
+databases as it is produced.
+"""
+
+import csv
+import io
+import sys
+import time
+from enum import Enum
+from typing import Final
+
+from cassini import codec
+from cassini.saturn_printer import SaturnPrinter
+
+
+class OutputFormat(str, Enum):
+    TABLE = "table"
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+
+RECORD_FIELDS: Final[tuple[str, ...]] = (
+    "time",
+    "id",
+    "name",
+    "addr",
+    "status",
+    "print_status",
+    "layer",
+    "total_layers",
+    "filename",
+    "error",
+    "transfer_status",
+    "transfer_offset",
+    "transfer_size",
+)
+
+
+def status_record(printer: SaturnPrinter, timestamp: float | None = None) -> dict:
+    status = printer.desc["Data"]["Status"]
+    print_info = status["PrintInfo"]
+    file_info = status["FileTransferInfo"]
+    return {
+        "time": time.time() if timestamp is None else timestamp,
+        "id": printer.id,
+        "name": printer.name,
+        "addr": printer.addr[0],
+        "status": status["CurrentStatus"],
+        "print_status": print_info["Status"],
+        "layer": print_info["CurrentLayer"],
+        "total_layers": print_info["TotalLayer"],
+        "filename": print_info["Filename"],
+        "error": print_info.get("ErrorNumber", 0),
+        "transfer_status": file_info["Status"],
+        "transfer_offset": file_info["DownloadOffset"],
+        "transfer_size": file_info["FileTotalSize"],
+    }
+
+
+class RecordWriter:
+    def __init__(self, output_format: OutputFormat, stream=None):
+        self.format = OutputFormat(output_format)
+        self.stream = stream if stream is not None else sys.stdout.buffer
+        self.header_written = False
+        if self.format == OutputFormat.CSV:
+            self.buffer = io.StringIO()
+            self.csv = csv.writer(self.buffer, lineterminator="\n")
+
+    # Write one record for each printer, all stamped with the same time, in a single write
+    def write(self, printers: list[SaturnPrinter]) -> None:
+        now = time.time()
+        records = [status_record(p, now) for p in printers]
+        if self.format == OutputFormat.NDJSON:
+            self.stream.write(b"".join(codec.dumps(r) + b"\n" for r in records))
+        else:
+            if not self.header_written:
+                self.csv.writerow(RECORD_FIELDS)
+                self.header_written = True
+            self.csv.writerows([r[f] for f in RECORD_FIELDS] for r in records)
+            self.stream.write(self.buffer.getvalue().encode("utf-8"))
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        self.stream.flush()
@@ -1,3 +1,4 @@
+import functools
 import time
 from pathlib import Path
 from typing import Annotated, Literal
@@ -7,9 +8,12 @@ from flask import Flask, Response, jsonify, render_template, request
 from loguru import logger
 from werkzeug.utils import secure_filename
 
-from cassini.cli import do_print, do_upload
+from cassini.aio import Fleet
+from cassini.analytics import analyze_fleet
 from cassini.exceptions import PrintersError
-from cassini.saturn_printer import PrintInfoStatus, SaturnPrinter
+from cassini.history import StatusHistory
+from cassini.saturn_printer import PrintInfoStatus
+from cassini.utils import default_history_path
 
 app = Flask(__name__)
 
@@ -17,6 +21,7 @@ printer_ip = Literal["192.168.0.235"]
 UPLOAD_FOLDER = Path("uploads")
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 UNABLE_TO_READ_ADDRESS = Literal["The printer's IP address could not be read."]
+ANALYTICS_HOURS = 24
 
 if not UPLOAD_FOLDER.exists():
     UPLOAD_FOLDER.mkdir()
@@ -32,6 +37,13 @@ rpp = typer.Typer(
 )
 
 
+# All printer I/O runs on the fleet's own event loop, so request threads never block on it for
+# longer than the operation they asked for, and uploads run in the background on the same loop
+@functools.cache
+def get_fleet() -> Fleet:
+    return Fleet()
+
+
 # TODO: figure out gettext or some other localization library
 @app.route("/")
 def index() -> str:
@@ -41,7 +53,7 @@ def index() -> str:
 @app.route("/get-printer-ip", methods=["GET"])
 def get_printer_ip() -> Response:
     try:
-        printers = SaturnPrinter().find_printers()
+        printers = get_fleet().discover()
         match len(printers):
             case 0:
                 msg = "No printers were found"
@@ -62,7 +74,7 @@ def get_printer_ip() -> Response:
 
 def read_printer_ip() -> str | None:
     try:
-        sp = SaturnPrinter().find_printers()[0]
+        sp = get_fleet().discover(limit=1)[0]
         return sp.addr[0]
     except Exception as e:
         # print(f"Erreur lors de la lecture de l'adresse IP : {e}")
@@ -92,7 +104,7 @@ def print_status():
     if printer_ip is None:
         return jsonify({"error": UNABLE_TO_READ_ADDRESS})
     try:
-        sp = SaturnPrinter().find_printer(printer_ip)
+        sp = get_fleet().find_printer(printer_ip)
         output = PrintInfoStatus(sp.desc["Data"]["Status"]["PrintInfo"]["Status"]).name
 
         is_online = bool(sp.desc["Data"]["Status"]["CurrentStatus"])
@@ -114,6 +126,19 @@ def print_status():
         return jsonify({"error": str(e)})
 
 
+# Layer timing, ETA, throughput and anomaly flags per printer, from the status history that
+# cassini record, watch --history or status --live --history keep
+@app.route("/analytics")
+def fleet_analytics():
+    hours = request.args.get("hours", ANALYTICS_HOURS, type=float)
+    try:
+        with StatusHistory(default_history_path(), read_only=True) as history:
+            return jsonify(analyze_fleet(history, since=time.time() - hours * 3600))
+    except Exception as e:
+        logger.error(f"Unable to analyze the status history: {e}")
+        return jsonify({"error": str(e)})
+
+
 @app.route("/upload", methods=["POST"])
 def upload_file():
     if file := request.files["file"]:
@@ -135,25 +160,32 @@ def list_files():
     return jsonify(files_info)
 
 
+UPLOAD_FAILED = -1
 progress_status = {}
+# why an upload failed, for uploads whose progress is UPLOAD_FAILED
+upload_errors = {}
 
 
-def print_file_after_upload(filename):
-    printer_ip = read_printer_ip()
-    if printer_ip is None:
-        return jsonify({"error": UNABLE_TO_READ_ADDRESS})
-    # Envoie la mise à jour de progression à 75%
-    progress_status[filename] = 75  # Mettre à jour l'état d'avancement
-    time.sleep(10)
-    do_print(printer=printer_ip, filename=filename)
+def upload_progress(filename: str, update) -> None:
+    # 100 is left for when the print has been started too
+    progress_status[filename] = min(round(update.fraction * 100), 99)
+
 
-    # Envoie la mise à jour de progression à 100%
-    progress_status[filename] = 100  # Mettre à jour l'état d'avancement après impression
+def upload_finished(filename: str, upload) -> None:
+    if (e := upload.exception()) is not None:
+        logger.error(f"Unable to print {filename}: {e}")
+        upload_errors[filename] = str(e)
+        progress_status[filename] = UPLOAD_FAILED
+        return
+    progress_status[filename] = 100
 
 
 @app.route("/progress/<filename>")
 def get_progress(filename):
-    return jsonify({"progress": progress_status.get(filename, 0)})
+    progress = progress_status.get(filename, 0)
+    if progress == UPLOAD_FAILED:
+        return jsonify({"progress": progress, "error": upload_errors.get(filename, "Upload failed")})
+    return jsonify({"progress": progress})
 
 
 @app.route("/print-file", methods=["POST"])
@@ -165,7 +197,17 @@ def print_file():
     filename = request.json["filename"]
     filepath = app.config["UPLOAD_FOLDER"].joinpath(filename)
 
-    do_upload(printer=printer_ip, filename=filepath)
+    fleet = get_fleet()
+    printer = fleet.find_printer(printer_ip)
+    if printer is None:
+        return jsonify({"error": f"No response from printer {printer_ip}"})
+    progress_status[filename] = 0
+    upload_errors.pop(filename, None)
+    # the print is started on the same connection as soon as the printer has the whole file
+    upload = fleet.submit(
+        fleet.aio.upload(printer, filepath, start_printing=True, progress=functools.partial(upload_progress, filename))
+    )
+    upload.add_done_callback(functools.partial(upload_finished, filename))
 
     # Ici, nous supposons que la mise à jour de la progression est gérée dans un autre mécanisme
     return jsonify({"message": f"Uploading {filename}, printing will start shortly."})
@@ -197,6 +197,12 @@ function checkProgress(filename) {
     fetch(`/progress/${filename}`)
         .then(response => response.json())
         .then(data => {
+            if (data.error) {
+                // the upload or the start of the print failed, stop asking
+                hideLoadingIndicator();
+                alert(`Unable to print ${filename}: ${data.error}`);
+                return;
+            }
             updatePrintProgress(data.progress);
             if (data.progress < 100) {
                 setTimeout(() => checkProgress(filename), 1000); // Ask every second
@@ -0,0 +1,39 @@
+"""
+Round-trip time estimation for request/response exchanges over UDP
+
+``RttEstimator`` follows RFC 6298: a smoothed RTT and RTT variation are updated from each
+measured round trip, and the retransmission timeout is ``SRTT + 4 * RTTVAR``. On a timeout
+the RTO is doubled until a new measurement comes in, and (Karn's algorithm) exchanges that
+needed a retransmission are not measured, since the answer can't be matched to a request.
+The bounds are much tighter than TCP's, as printers are on the local network.
+"""
+
+from typing import Final
+
+ALPHA: Final[float] = 1 / 8
+BETA: Final[float] = 1 / 4
+INITIAL_RTO: Final[float] = 0.5
+MIN_RTO: Final[float] = 0.05
+MAX_RTO: Final[float] = 5.0
+
+
+class RttEstimator:
+    def __init__(self, initial_rto: float = INITIAL_RTO, min_rto: float = MIN_RTO, max_rto: float = MAX_RTO):
+        self.srtt = None
+        self.rttvar = None
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.rto = initial_rto
+
+    def sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+
+    def backoff(self) -> float:
+        self.rto = min(self.rto * 2, self.max_rto)
+        return self.rto
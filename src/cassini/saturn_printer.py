@@ -6,12 +6,11 @@
 #
 
 import asyncio
-import json
+import contextlib
 import secrets
 
 # import random
 import socket
-import sys
 import time
 from enum import IntEnum
 from pathlib import Path
@@ -19,10 +18,20 @@ from typing import Final
 
 from loguru import logger
 
+from cassini import codec
+from cassini.discovery import broadcast_addresses
+from cassini.exceptions import CommandError, TransferError, UploadError
 from cassini.printer import Printer
+from cassini.progress import ProgressTracker
+from cassini.rtt import RttEstimator
 
 SATURN_UDP_PORT: Final[int] = 3000
+DISCOVER_PROBE: Final[bytes] = b"M99999"
 TOO_MANY_STATUS_REPLIES: Final[int] = 5
+UPLOAD_ATTEMPTS: Final[int] = 3
+# seconds before the first retry of a failed upload, doubled for every further retry
+RETRY_DELAY: Final[float] = 2.0
+MAX_RETRY_DELAY: Final[float] = 30.0
 
 
 # CurrentStatus field inside Status
@@ -44,6 +53,16 @@ class PrintInfoStatus(IntEnum):
     COMPLETE = 16  # pretty sure this is correct
 
 
+ACTIVE_PRINT_STATES: Final[frozenset[int]] = frozenset(
+    {
+        PrintInfoStatus.STARTINGPRINT,
+        PrintInfoStatus.EXPOSURE,
+        PrintInfoStatus.RETRACTING,
+        PrintInfoStatus.LOWERING,
+    }
+)
+
+
 # Status field inside FileTransferInfo
 class FileStatus(IntEnum):
     NONE = 0
@@ -64,64 +83,213 @@ def random_hexstr():
     return f"{secrets.randbits(128):032x}"
 
 
+class SaturnDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+    def datagram_received(self, data, addr):
+        self.endpoint.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        logger.debug(f"UDP error: {exc}")
+
+
+class SaturnEndpoint:
+    def __init__(self):
+        self.transport = None
+        # address -> futures waiting for the next answer from that address
+        self.waiters: dict[tuple, list[asyncio.Future]] = {}
+        # queues that get every answer, for discovery
+        self.listeners: list[asyncio.Queue] = []
+
+    async def open(self):
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: SaturnDatagramProtocol(self),
+            local_addr=("0.0.0.0", 0),  # noqa: S104
+            allow_broadcast=True,
+        )
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def probe(self, addr):
+        try:
+            self.transport.sendto(DISCOVER_PROBE, addr)
+        except OSError as e:
+            logger.debug(f"Could not probe {addr[0]}: {e}")
+            return
+        if SaturnPrinter.capture is not None:
+            SaturnPrinter.capture.udp_out(addr, DISCOVER_PROBE)
+
+    def datagram_received(self, data, addr):
+        if SaturnPrinter.capture is not None:
+            SaturnPrinter.capture.udp_in(addr, data)
+        try:
+            desc = codec.loads(data)
+        except ValueError:
+            logger.debug(f"Ignoring malformed answer from {addr[0]}")
+            return
+        for future in self.waiters.pop(addr, []):
+            if not future.done():
+                future.set_result(desc)
+        for queue in self.listeners:
+            queue.put_nowait((addr, desc))
+
+    # Probe addr until it answers or timeout runs out, resending whenever the answer takes longer
+    # than the RTO estimated by rtt. Returns the answer, or None.
+    async def query(self, addr, rtt, timeout=5):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        probes = 0
+        while (remaining := deadline - loop.time()) > 0:
+            future = loop.create_future()
+            self.waiters.setdefault(addr, []).append(future)
+            self.probe(addr)
+            sent = loop.time()
+            rto = rtt.rto if probes == 0 else rtt.backoff()
+            probes += 1
+            try:
+                desc = await asyncio.wait_for(asyncio.shield(future), timeout=min(rto, remaining))
+            except asyncio.TimeoutError:
+                logger.debug("No answer from {} within {:.3f}s (probe {})", addr[0], rto, probes)
+                continue
+            finally:
+                with contextlib.suppress(KeyError, ValueError):
+                    self.waiters[addr].remove(future)
+                if not self.waiters.get(addr, True):
+                    del self.waiters[addr]
+            # Karn's algorithm: an answer after a resend can't be matched to its probe
+            if probes == 1:
+                rtt.sample(loop.time() - sent)
+            return desc
+        logger.warning(f"No answer from {addr[0]} after {probes} probes in {timeout}s")
+        return None
+
+    # Probe every address in broadcast and collect (address, answer) pairs for timeout seconds, or
+    # until limit different printers have answered
+    async def discover(self, broadcast, timeout=1, limit=None):
+        queue = asyncio.Queue()
+        self.listeners.append(queue)
+        found = {}
+        try:
+            for addr in broadcast:
+                self.probe((addr, SATURN_UDP_PORT))
+            deadline = asyncio.get_running_loop().time() + timeout
+            while limit is None or len(found) < limit:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                try:
+                    addr, desc = await asyncio.wait_for(queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                # a printer reachable through several of the probed addresses answers each of them
+                found.setdefault(desc["Data"]["Attributes"]["MainboardID"], (addr, desc))
+        finally:
+            self.listeners.remove(queue)
+        return list(found.values())
+
+    # Refresh printers concurrently; returns the ones that answered
+    async def refresh(self, printers, timeout=5):
+        answers = await asyncio.gather(*(self.query(p.addr, p.rtt, timeout) for p in printers))
+        for printer, desc in zip(printers, answers, strict=True):
+            if desc is not None:
+                printer.update(desc)
+        return [p for p, desc in zip(printers, answers, strict=True) if desc is not None]
+
+    # Refresh printers from an endpoint of their own, for callers without an event loop
+    @classmethod
+    async def refresh_once(cls, printers, timeout=5):
+        endpoint = cls()
+        await endpoint.open()
+        try:
+            return await endpoint.refresh(printers, timeout)
+        finally:
+            endpoint.close()
+
+
 # TODO: feels like we should change the desc member to either a namedtuple or dataclass
 class SaturnPrinter(Printer):
-    def __init__(self, addr=None, desc=None, timeout=5):
+    # set to a cassini.capture.CaptureWriter to record all UDP discovery/status traffic
+    capture = None
+
+    def __init__(self, addr=None, desc=None, timeout=5, history=None):
         self.addr = addr
         self.timeout = timeout
-        self.file_transfer_future = None
+        self.history = history
+        self.last_status = None
+        self.rtt = RttEstimator()
         if desc is not None:
             self.set_desc(desc)
         else:
             self.desc = None
 
-    # Broadcast and find all printers, return array of SaturnPrinter objects
+    # Broadcast and find all printers, return array of SaturnPrinter objects. broadcast can be a
+    # single address or a list of addresses, which are all probed at once; by default that's the
+    # broadcast address of every local interface. With limit, stops waiting once that many
+    # printers have answered.
     @classmethod
-    def find_printers(cls, timeout=1, broadcast=None):
+    def find_printers(cls, timeout=1, broadcast=None, limit=None):
         if broadcast is None:
-            broadcast = "<broadcast>"
-        printers = []
+            broadcast = broadcast_addresses()
+        elif isinstance(broadcast, str):
+            broadcast = [broadcast]
+        printers = {}
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         with sock:
             sock.settimeout(timeout)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, timeout)
-            sock.sendto(b"M99999", (broadcast, SATURN_UDP_PORT))
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            for addr in broadcast:
+                try:
+                    sock.sendto(b"M99999", (addr, SATURN_UDP_PORT))
+                except OSError as e:
+                    logger.debug(f"Could not probe {addr}: {e}")
+                    continue
+                if cls.capture is not None:
+                    cls.capture.udp_out((addr, SATURN_UDP_PORT), b"M99999")
 
             now = time.time()
-            while not time.time() - now > timeout:
+            while not time.time() - now > timeout and (limit is None or len(printers) < limit):
                 try:
                     data, addr = sock.recvfrom(1024)
                 except TimeoutError:
                     continue
                 else:
                     # logger.debug(f'Found printer at {addr}')
-                    pdata = json.loads(data.decode("utf-8"))
-                    printers.append(cls(addr=addr, desc=pdata))
-        return printers
+                    if cls.capture is not None:
+                        cls.capture.udp_in(addr, data)
+                    pdata = codec.loads(data)
+                    # a printer reachable through several of the probed addresses answers each of them
+                    printers.setdefault(pdata["Data"]["Attributes"]["MainboardID"], cls(addr=addr, desc=pdata))
+        return list(printers.values())
 
     # Find a specific printer at the given address, return a SaturnPrinter object
     # or None if no response is obtained
     @classmethod
     def find_printer(cls, addr: str):
         sp = cls()
-        printers = sp.find_printers(broadcast=addr)
+        printers = sp.find_printers(broadcast=addr, limit=1)
         if len(printers) == 0 or printers[0].addr[0] != addr:
             return None
         return printers[0]
 
-    # Refresh this SaturnPrinter with latest status
+    # Refresh many printers at once from a single endpoint, each probed again whenever it takes
+    # longer than its own RTO to answer. Returns the printers that answered.
+    @classmethod
+    def refresh_all(cls, printers, timeout=1):
+        return asyncio.run(SaturnEndpoint.refresh_once(printers, timeout))
+
+    # Refresh this SaturnPrinter with latest status. The probe is resent whenever the printer takes
+    # longer than the estimated RTO to answer, until timeout seconds have passed.
     def refresh(self, timeout=5):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        with sock:
-            sock.settimeout(timeout)
-            sock.sendto(b"M99999", self.addr)
-            try:
-                data, addr = sock.recvfrom(1024)
-            except TimeoutError:
-                return False
-            else:
-                pdata = json.loads(data.decode("utf-8"))
-                self.set_desc(pdata)
+        return bool(asyncio.run(SaturnEndpoint.refresh_once([self], timeout)))
+
+    # Take in a printer's answer to a status probe
+    def update(self, desc):
+        self.set_desc(desc)
+        self.incoming_status(desc["Data"]["Status"])
 
     def set_desc(self, desc):
         self.desc = desc
@@ -132,81 +300,132 @@ class SaturnPrinter(Printer):
         self.busy = self.current_status > 0
 
     # Tell this printer to connect to the specified mqtt and http
-    # servers, for further control
+    # servers, for further control. mqtt can be any MQTTTransport.
     async def connect(self, mqtt, http):
         self.mqtt = mqtt
         self.http = http
 
-        # Tell the printer to connect
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        with sock:
-            sock.sendto(b"M66666 " + str(mqtt.port).encode("utf-8"), self.addr)
-
-        # wait for the connection
-        client_id = await asyncio.wait_for(mqtt.client_connection, timeout=self.timeout)
-        if client_id != self.id:
-            logger.error(f"Client ID mismatch: {client_id} != {self.id}")
+        if not await mqtt.attach(self):
             return False
 
-        # wait for the client to subscribe to the request topic
-        topic = await asyncio.wait_for(self.mqtt.client_subscribed, timeout=self.timeout)
-        logger.debug(f"Client subscribed to {topic}")
-
         await self.send_command_and_wait(Command.CMD_0)
         await self.send_command_and_wait(Command.CMD_1)
         await self.send_command_and_wait(Command.SET_MYSTERY_TIME_PERIOD, {"TimePeriod": 5000})
 
         return True
 
-    async def disconnect(self):
-        await self.send_command_and_wait(Command.DISCONNECT)
+    # Tell the printer to connect to the MQTT server on this host at the given port
+    def redirect(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        with sock:
+            sock.sendto(b"M66666 " + str(port).encode("utf-8"), self.addr)
+            if self.capture is not None:
+                self.capture.udp_out(self.addr, b"M66666 " + str(port).encode("utf-8"))
 
-    async def upload_file(self, filename: Path):
+    async def disconnect(self):
+        await self.send_command_and_wait(Command.DISCONNECT, abort_on_bad_ack=False)
+
+    # Returns (offset, total size, filename) of the finished transfer.
+    # progress is called with a TransferProgress for every status update during the transfer.
+    # A transfer the printer reports as failed, or during which it goes quiet, is retried up to
+    # attempts times with a growing delay. Retries ask the printer to keep what it has downloaded
+    # (CleanCache 0), so that it can continue from its last DownloadOffset with a Range request.
+    # Raises UploadError once the upload has failed for good, with the last error as its cause.
+    async def upload_file(self, filename: Path, compress=False, progress=None, attempts=UPLOAD_ATTEMPTS):
+        if attempts < 1:
+            msg = f"attempts must be at least 1, not {attempts}"
+            raise ValueError(msg)
+        tracker = ProgressTracker(progress)
+        delay = RETRY_DELAY
+        error = None
+        for attempt in range(1, attempts + 1):
+            offset = tracker.latest.offset if tracker.latest is not None else 0
+            # the failure can be the first we hear of how far the printer got
+            if isinstance(error, TransferError):
+                offset = max(offset, error.offset)
+            if attempt > 1 and offset > 0:
+                logger.info(f"{self.describe()}: resuming upload of {filename} from byte {offset}")
+            try:
+                return await self.upload_file_inner(filename, compress=compress, tracker=tracker, resume=offset > 0)
+            except (TransferError, asyncio.TimeoutError) as e:
+                error = e
+                # a printer that dropped its connection won't hear the retry
+                if attempt == attempts or not self.mqtt.attached(self):
+                    break
+                logger.warning(
+                    f"{self.describe()}: upload of {filename} failed ({str(e) or 'no response'}), "
+                    f"retrying in {delay:.0f} s ({attempt + 1}/{attempts})"
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+            except Exception as e:
+                error = e
+                break
+        total = tracker.latest.total if tracker.latest is not None else -1
+        tracker.finish(total, str(filename), failed=True)
+        msg = f"Upload of {filename} to {self.describe()} failed after {attempt} attempt(s): {str(error) or 'no response'}"
+        logger.error(msg)
+        raise UploadError(msg) from error
+
+    # Upload filename, yielding a TransferProgress for every status update as it arrives. The last
+    # one has done set; if it also has failed set, the UploadError is raised after it.
+    async def upload_progress(self, filename: Path, compress=False):
+        updates = asyncio.Queue()
+        upload = asyncio.create_task(self.upload_file(filename, compress=compress, progress=updates.put_nowait))
         try:
-            await self.upload_file_inner(filename)
-        except Exception as ex:
-            logger.error(f"Exception during upload: {ex}")
-            self.file_transfer_future.set_result((-1, -1, filename))
-            self.file_transfer_future = asyncio.get_running_loop().create_future()
+            while True:
+                update = await updates.get()
+                yield update
+                if update.done:
+                    break
+            if update.failed:
+                await upload
+        finally:
+            if not upload.done():
+                upload.cancel()
 
-    async def upload_file_inner(self, filename: Path):
-        # schedule a future that can be used for status, in case this is kicked off as a task
-        self.file_transfer_future = asyncio.get_running_loop().create_future()
+    async def upload_file_inner(self, filename: Path, compress=False, tracker=None, resume=False):
+        tracker = tracker or ProgressTracker()
 
         # get base filename and extension
         if isinstance(filename, str):
             basename = filename.split("\\")[-1].split("/")[-1]
-            ext = basename.split(".")[-1].lower()
         elif isinstance(filename, Path):
             basename = filename.name.lstrip(".")
-            ext = filename.suffix
+        ext = basename.rsplit(".", 1)[-1].lower() if "." in basename else ""
         if ext not in ("ctb", "goo"):
             logger.warning(f"Unknown file extension: {ext}")
 
-        httpname = f"{random_hexstr()}.{ext}"
-        fileinfo = self.http.register_file_route(f"/{httpname}", filename)
-
+        httppath, fileinfo = await self.http.acquire_file(filename, ext, compress=compress)
+        try:
+            await self.http.routes_ready()
+            return await self.transfer_file(basename, httppath, fileinfo, compress, tracker, resume=resume)
+        finally:
+            self.http.release_file(httppath)
+
+    async def transfer_file(self, basename, httppath, fileinfo, compress, tracker, *, resume=False):
+        host = self.mqtt.http_host() or "${ipaddr}"
+        if ":" in host:
+            host = f"[{host}]"
         cmd_data = {
             "Check": 0,
-            "CleanCache": 1,
-            "Compress": 0,
+            "CleanCache": 0 if resume else 1,
+            "Compress": 1 if compress else 0,
             "FileSize": fileinfo["size"],
             "Filename": basename,
             "MD5": fileinfo["md5"],
-            "URL": f"http://${{ipaddr}}:{self.http.port}/{httpname}",
+            "URL": f"http://{host}:{self.http.port}{httppath}",
         }
 
         await self.send_command_and_wait(Command.UPLOAD_FILE, cmd_data)
 
         # now process status updates from the printer
+        transferring = False
         while True:
-            reply = await asyncio.wait_for(self.mqtt.next_published_message(), timeout=self.timeout * 2)
-            data = json.loads(reply["payload"])
-            if reply["topic"] == f"/sdcp/response/{self.id}":
-                logger.warning(
-                    f"Got unexpected RESPONSE (no outstanding request), topic: {reply['topic']} data: {data}"
-                )
-            elif reply["topic"] == f"/sdcp/status/{self.id}":
+            topic, data = await self.next_message(timeout=self.timeout * 2)
+            if topic == f"/sdcp/response/{self.id}":
+                logger.warning(f"Got unexpected RESPONSE (no outstanding request), topic: {topic} data: {data}")
+            elif topic == f"/sdcp/status/{self.id}":
                 self.incoming_status(data["Data"]["Status"])
 
                 status = data["Data"]["Status"]
@@ -215,45 +434,48 @@ class SaturnPrinter(Printer):
                 total_size = file_info["FileTotalSize"]
                 file_name = file_info["Filename"]
 
-                # We assume that the printer immediately goes into BUSY status after it processes
-                # the upload command
-                if status["CurrentStatus"] == CurrentStatus.READY:
-                    if file_info["Status"] == FileStatus.DONE:
-                        self.file_transfer_future.set_result((total_size, total_size, file_name))
-                    elif file_info["Status"] == FileStatus.ERROR:
-                        logger.error("Transfer error!")
-                        self.file_transfer_future.set_result((-1, total_size, file_name))
-                    else:
-                        logger.error(f"Unknown file transfer status code: {file_info['Status']}")
-                        self.file_transfer_future.set_result((-1, total_size, file_name))
-                    break
+                if file_info["Status"] == FileStatus.NONE and file_name == basename:
+                    transferring = True
 
-                self.file_transfer_future.set_result((current_offset, total_size, file_name))
-                self.file_transfer_future = asyncio.get_running_loop().create_future()
-            elif reply["topic"] != f"/sdcp/attributes/{self.id}":
-                logger.warning(f"Got unknown topic message: {reply['topic']}")
-
-        self.file_transfer_future = None
+                # We assume that the printer immediately goes into BUSY status after it processes
+                # the upload command. While it is printing it stays BUSY, so then we go by the transfer
+                # status instead, once we've seen this transfer in progress.
+                if status["CurrentStatus"] == CurrentStatus.READY or (
+                    transferring and file_info["Status"] in (FileStatus.DONE, FileStatus.ERROR)
+                ):
+                    if file_info["Status"] != FileStatus.DONE:
+                        msg = (
+                            f"transfer of {file_name} stopped at {current_offset}/{total_size} bytes "
+                            f"with status {file_info['Status']}"
+                        )
+                        raise TransferError(msg, current_offset)
+                    tracker.finish(total_size, file_name)
+                    return (total_size, total_size, file_name)
+
+                if transferring:
+                    tracker.update(current_offset, total_size, file_name)
+            elif topic != f"/sdcp/attributes/{self.id}":
+                logger.warning(f"Got unknown topic message: {topic}")
 
     async def send_command_and_wait(self, cmdid, data=None, abort_on_bad_ack=True):
         # Send the 0 and 1 messages
         req = self.send_command(cmdid, data)
-        logger.debug(f"Sent command {cmdid} as request {req}")
+        logger.debug("Sent command {} as request {}", cmdid, req)
         while True:
-            reply = await asyncio.wait_for(self.mqtt.next_published_message(), timeout=self.timeout)
-            data = json.loads(reply["payload"])
-            if reply["topic"] == f"/sdcp/response/{self.id}":
+            topic, data = await self.next_message()
+            if topic == f"/sdcp/response/{self.id}":
                 if data["Data"]["RequestID"] == req:
-                    logger.debug(f"Got response to {req}")
+                    logger.debug("Got response to {}", req)
                     result = data["Data"]["Data"]
                     if abort_on_bad_ack and result["Ack"] != 0:
-                        logger.error(f"Got bad ack in response: {result}")
-                        sys.exit(1)
+                        msg = f"{self.describe()} rejected command {getattr(cmdid, 'name', cmdid)} with Ack {result['Ack']}"
+                        logger.error(f"{msg}: {result}")
+                        raise CommandError(msg, cmdid, result["Ack"])
                     return result
-            elif reply["topic"] == f"/sdcp/status/{self.id}":
+            elif topic == f"/sdcp/status/{self.id}":
                 self.incoming_status(data["Data"]["Status"])
-            elif reply["topic"] != f"/sdcp/attributes/{self.id}":
-                logger.warning(f"Got unknown topic message: {reply['topic']}")
+            elif topic != f"/sdcp/attributes/{self.id}":
+                logger.warning(f"Got unknown topic message: {topic}")
 
     async def print_file(self, filename):
         cmd_data = {"Filename": filename, "StartLayer": 0}
@@ -264,13 +486,10 @@ class SaturnPrinter(Printer):
         # started or failed to start
         status_count = 0
         while True:
-            reply = await asyncio.wait_for(self.mqtt.next_published_message(), timeout=self.timeout * 2)
-            data = json.loads(reply["payload"])
-            if reply["topic"] == f"/sdcp/response/{self.id}":
-                logger.warning(
-                    f"Got unexpected RESPONSE (no outstanding request), topic: {reply['topic']} data: {data}"
-                )
-            elif reply["topic"] == f"/sdcp/status/{self.id}":
+            topic, data = await self.next_message(timeout=self.timeout * 2)
+            if topic == f"/sdcp/response/{self.id}":
+                logger.warning(f"Got unexpected RESPONSE (no outstanding request), topic: {topic} data: {data}")
+            elif topic == f"/sdcp/status/{self.id}":
                 self.incoming_status(data["Data"]["Status"])
                 status_count += 1
 
@@ -290,26 +509,67 @@ class SaturnPrinter(Printer):
                     logger.warning("Too many status replies without success or failure")
                     return False
 
-            elif reply["topic"] != f"/sdcp/attributes/{self.id}":
-                logger.warning(f"Got unknown topic message: {reply['topic']}")
+            elif topic != f"/sdcp/attributes/{self.id}":
+                logger.warning(f"Got unknown topic message: {topic}")
+
+    # Wait for the next message published by the printer and decode its payload. This is the
+    # only place MQTT payloads get decoded, so each frame is parsed exactly once.
+    async def next_message(self, timeout=None):
+        reply = await asyncio.wait_for(self.mqtt.next_published_message(self.id), timeout=timeout or self.timeout)
+        return reply["topic"], codec.loads(reply["payload"])
+
+    # Route a message from the printer that isn't part of a request/response exchange
+    def dispatch_message(self, topic, data):
+        if topic == f"/sdcp/response/{self.id}":
+            response = data["Data"]
+            self.incoming_response(response["RequestID"], response["Cmd"], response["Data"])
+        elif topic == f"/sdcp/status/{self.id}":
+            self.incoming_status(data["Data"]["Status"])
+        elif topic != f"/sdcp/attributes/{self.id}":
+            logger.warning(f"Got unknown topic message: {topic}")
 
     async def process_responses(self):
         while True:
-            reply = await asyncio.wait_for(self.mqtt.next_published_message(), timeout=self.timeout)
-            self.desc = json.loads(reply["payload"])
+            _, self.desc = await self.next_message()
+
+    # Process messages from the printer until a status update satisfies predicate, and return that
+    # status. Status updates are expected at least every TimePeriod (set in connect), so a silent
+    # printer raises asyncio.TimeoutError (the same as TimeoutError from Python 3.11), as does
+    # exceeding the overall timeout if one is given.
+    async def wait_for_status(self, predicate, timeout=None):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            message_timeout = self.timeout * 2
+            if deadline is not None:
+                message_timeout = min(message_timeout, deadline - loop.time())
+                if message_timeout <= 0:
+                    raise asyncio.TimeoutError
+            topic, data = await self.next_message(timeout=message_timeout)
+            self.dispatch_message(topic, data)
+            if topic == f"/sdcp/status/{self.id}" and predicate(data["Data"]["Status"]):
+                return data["Data"]["Status"]
 
     def incoming_status(self, status):
-        logger.debug(f"STATUS: {status}")
+        self.last_status = status
+        logger.debug("STATUS: {}", status)
+        if self.history is not None:
+            self.history.record(self.id, status)
 
     def incoming_response(self, response_id, cmd, data):
-        logger.debug(f"RESPONSE: {response_id} -- {cmd}: {data}")
+        logger.debug("RESPONSE: {} -- {}: {}", response_id, cmd, data)
 
     def describe(self):
         attrs = self.desc["Data"]["Attributes"]
         return f"{attrs['Name']} ({attrs['MachineName']})"
 
     def status(self):
-        self.refresh()
+        if not self.refresh():
+            logger.warning(f"{self.describe()}: using the last known status")
+        return self.summary()
+
+    # The last known status, without asking the printer
+    def summary(self):
         printinfo = self.desc["Data"]["Status"]["PrintInfo"]
         return {
             "status": self.desc["Data"]["Status"]["CurrentStatus"],
@@ -333,7 +593,7 @@ class SaturnPrinter(Printer):
             },
             "Id": self.desc["Id"],
         }
-        self.mqtt.publish(f"/sdcp/request/{self.id}", json.dumps(cmd_data))
+        self.mqtt.publish(f"/sdcp/request/{self.id}", codec.dumps(cmd_data))
         return hexstr
 
     def connect_mqtt(self, mqtt_host, mqtt_port):
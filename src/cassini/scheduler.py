@@ -0,0 +1,320 @@
+"""
+Print queue and scheduler for a fleet of printers
+
+Jobs are either pinned to a printer (by MainboardID) or left in the shared queue, from
+which any idle printer can take them. The queue is persisted to a JSON file after every
+change so that it survives restarts. Changes are made under a lock on the file and on its
+latest contents, so ``queue add`` can add jobs to a queue that ``queue run`` is working
+through. Each job records which run claimed it, so that a run only gives back its own jobs
+and jobs left behind by a run that died are recovered. While a printer is busy printing,
+the scheduler uploads the printer's next job so that the following print can start as
+soon as the current one finishes.
+"""
+
+import asyncio
+import contextlib
+import os
+import secrets
+import socket
+import time
+from pathlib import Path
+from typing import Final
+
+from loguru import logger
+
+from cassini import codec
+from cassini.exceptions import CommandError, UploadError
+from cassini.locking import file_lock
+from cassini.saturn_printer import ACTIVE_PRINT_STATES, CurrentStatus, PrintInfoStatus, SaturnPrinter
+from cassini.servers import create_http_server, create_mqtt_server
+
+QUEUED: Final[str] = "queued"
+ASSIGNED: Final[str] = "assigned"
+STAGED: Final[str] = "staged"
+PRINTING: Final[str] = "printing"
+DONE: Final[str] = "done"
+FAILED: Final[str] = "failed"
+
+DEFAULT_POLL_INTERVAL: Final[float] = 10.0
+
+
+def printer_is_ready(status: dict) -> bool:
+    return status["CurrentStatus"] == CurrentStatus.READY or status["PrintInfo"]["Status"] == PrintInfoStatus.COMPLETE
+
+
+def print_is_running(status: dict) -> bool:
+    return status["PrintInfo"]["Status"] in ACTIVE_PRINT_STATES
+
+
+def print_has_ended(status: dict) -> bool:
+    print_info = status["PrintInfo"]
+    return (
+        print_info["Status"] in (PrintInfoStatus.FINISHED, PrintInfoStatus.COMPLETE)
+        or print_info["ErrorNumber"] != 0
+        or (status["CurrentStatus"] == CurrentStatus.READY and print_info["Status"] == PrintInfoStatus.NOTPRINTING)
+    )
+
+
+# Identifies a queue run; the host and process id tell whether the run is still going
+def new_run_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+
+def run_is_alive(run_id: str) -> bool:
+    host, pid, _ = run_id.rsplit(":", 2)
+    # a run on another host, or on a platform where we can't check, has to be assumed alive
+    if host != socket.gethostname() or os.name != "posix":
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self.lock_path = self.path.with_suffix(f"{self.path.suffix}.lock")
+        self.jobs: list[dict] = []
+        self.next_id = 1
+        self.load()
+
+    def load(self) -> None:
+        if not self.path.exists():
+            return
+        state = codec.loads(self.path.read_bytes())
+        self.jobs = state["jobs"]
+        self.next_id = state["next_id"]
+
+    # Make a change to the latest state of the queue file and save it, with the file locked so
+    # that changes made by other processes in the meantime aren't lost
+    @contextlib.contextmanager
+    def transaction(self):
+        with file_lock(self.lock_path):
+            self.load()
+            yield
+            self.save()
+
+    def find(self, job_id: int) -> dict | None:
+        return next((job for job in self.jobs if job["id"] == job_id), None)
+
+    # Give back the jobs of a run that is ending: anything that was handed to a printer but not
+    # started goes through the queue again, and a print we can no longer follow has failed
+    def requeue_unstarted(self, run_id: str) -> None:
+        with self.transaction():
+            self.release_jobs(lambda job: job.get("run") == run_id)
+
+    # Give back the jobs of runs that died without doing so themselves
+    def recover_abandoned(self) -> None:
+        with self.transaction():
+            self.release_jobs(lambda job: job.get("run") is None or not run_is_alive(job["run"]))
+
+    def release_jobs(self, owned) -> None:
+        for job in self.jobs:
+            if job["state"] in (ASSIGNED, STAGED) and owned(job):
+                job.update(state=QUEUED, assigned_to=None, run=None)
+            elif job["state"] == PRINTING and owned(job):
+                job.update(state=FAILED, error="queue run stopped during the print", finished=time.time())
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f"{self.path.suffix}.tmp")
+        tmp.write_bytes(codec.dumps({"next_id": self.next_id, "jobs": self.jobs}))
+        os.replace(tmp, self.path)
+
+    def add(self, filename: Path | str, printer_id: str | None = None) -> dict:
+        with self.transaction():
+            job = {
+                "id": self.next_id,
+                "filename": str(Path(filename).resolve()),
+                "printer": printer_id,
+                "assigned_to": None,
+                "run": None,
+                "state": QUEUED,
+                "added": time.time(),
+                "started": None,
+                "finished": None,
+                "error": None,
+            }
+            self.next_id += 1
+            self.jobs.append(job)
+        return job
+
+    def pending(self) -> list[dict]:
+        return [job for job in self.jobs if job["state"] not in (DONE, FAILED)]
+
+    # Hand the next job to a printer: its own queue first, then the shared queue
+    def claim(self, printer_id: str, run_id: str | None = None) -> dict | None:
+        with self.transaction():
+            queued = [job for job in self.jobs if job["state"] == QUEUED]
+            job = next((j for j in queued if j["printer"] == printer_id), None)
+            if job is None:
+                job = next((j for j in queued if j["printer"] is None), None)
+            if job is not None:
+                job.update(state=ASSIGNED, assigned_to=printer_id, run=run_id)
+        return job
+
+    # job can be from an earlier state of the queue; it is updated along with the queue's copy
+    def update(self, job: dict, **fields) -> None:
+        with self.transaction():
+            if (current := self.find(job["id"])) is not None:
+                current.update(fields)
+        job.update(fields)
+
+    def clear_finished(self) -> int:
+        with self.transaction():
+            before = len(self.jobs)
+            self.jobs = self.pending()
+        return before - len(self.jobs)
+
+
+class FleetScheduler:
+    def __init__(
+        self,
+        queue: JobQueue,
+        printers: list[SaturnPrinter],
+        *,
+        http=None,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+        exit_when_empty: bool = True,
+        broker: str | None = None,
+        http_host: str | None = None,
+    ):
+        self.queue = queue
+        self.printers = printers
+        self.http = http
+        self.broker = broker
+        self.http_host = http_host
+        self.mqtt = None
+        self.poll_interval = poll_interval
+        self.exit_when_empty = exit_when_empty
+        self.run_id = new_run_id()
+
+    async def run(self) -> None:
+        self.queue.recover_abandoned()
+        own_http = self.http is None
+        try:
+            if own_http:
+                self.http, *_ = await create_http_server()
+            # through a broker, one connection serves all printers
+            if self.broker is not None:
+                self.mqtt, *_ = await create_mqtt_server(broker=self.broker, http_host=self.http_host)
+            # read the files of the first jobs while the printers connect
+            staging = [asyncio.create_task(self.stage(job)) for job in self.queue.pending()[: len(self.printers)]]
+            await asyncio.gather(*(self.run_printer(p) for p in self.printers))
+            for task in staging:
+                task.cancel()
+        finally:
+            self.queue.requeue_unstarted(self.run_id)
+            if self.mqtt is not None:
+                await self.mqtt.close()
+                self.mqtt = None
+            if own_http and self.http is not None:
+                await self.http.close()
+                self.http = None
+
+    async def stage(self, job: dict) -> None:
+        try:
+            await self.http.stage_file(job["filename"])
+        except OSError as e:
+            logger.warning(f"Job {job['id']}: could not stage {job['filename']}: {e}")
+
+    async def run_printer(self, printer: SaturnPrinter) -> None:
+        # every printer needs its own MQTT server, but they can all share the HTTP server
+        mqtt = self.mqtt
+        if mqtt is None:
+            mqtt, *_ = await create_mqtt_server()
+        try:
+            # one printer that can't be connected mustn't stop the others
+            try:
+                connected = await printer.connect(mqtt, self.http)
+            except (CommandError, ConnectionError, TimeoutError, asyncio.TimeoutError) as e:
+                logger.error(f"{printer.describe()}: {str(e) or 'no response'}")
+                connected = False
+            if not connected:
+                logger.error(f"{printer.describe()}: failed to connect, not scheduling any jobs on it")
+                return
+            await self.run_jobs(printer)
+        finally:
+            if mqtt is not self.mqtt:
+                await mqtt.close()
+
+    async def run_jobs(self, printer: SaturnPrinter) -> None:
+        staged = None
+        while True:
+            job = staged or self.queue.claim(printer.id, self.run_id)
+            staged = None
+            if job is None:
+                if self.exit_when_empty:
+                    break
+                # keep consuming the status stream while we wait for new jobs
+                with contextlib.suppress(TimeoutError, asyncio.TimeoutError):
+                    await printer.wait_for_status(lambda _: False, timeout=self.poll_interval)
+                continue
+
+            try:
+                if job["state"] != STAGED and not await self.upload(printer, job):
+                    continue
+
+                await printer.wait_for_status(printer_is_ready)
+                if not await printer.print_file(Path(job["filename"]).name):
+                    self.queue.update(job, state=FAILED, error="print did not start", finished=time.time())
+                    logger.error(f"{printer.describe()}: job {job['id']} failed to start")
+                    continue
+                self.queue.update(job, state=PRINTING, started=time.time())
+                logger.info(f"{printer.describe()}: printing job {job['id']} ({job['filename']})")
+                # print_file can return on the finished state of the previous print, so make sure this
+                # one is actually under way before looking for its end
+                await printer.wait_for_status(print_is_running)
+
+                # get the next file onto the printer while this one prints
+                staged = self.queue.claim(printer.id, self.run_id)
+                if staged is not None and not await self.upload(printer, staged, requeue_on_failure=True):
+                    staged = None
+
+                status = await printer.wait_for_status(print_has_ended)
+                if status["PrintInfo"]["ErrorNumber"] != 0:
+                    error = f"printer error {status['PrintInfo']['ErrorNumber']}"
+                    self.queue.update(job, state=FAILED, error=error, finished=time.time())
+                    logger.error(f"{printer.describe()}: job {job['id']} failed with {error}")
+                else:
+                    self.queue.update(job, state=DONE, finished=time.time())
+                    logger.info(f"{printer.describe()}: job {job['id']} finished")
+            except CommandError as e:
+                self.queue.update(job, state=FAILED, error=str(e), finished=time.time())
+                logger.error(f"{printer.describe()}: job {job['id']} failed: {e}")
+            # until 3.11 asyncio.wait_for raises asyncio.TimeoutError, which isn't TimeoutError
+            except (TimeoutError, asyncio.TimeoutError):
+                logger.error(f"{printer.describe()}: stopped responding, giving its jobs back to the queue")
+                if job["state"] == PRINTING:
+                    self.queue.update(job, state=FAILED, error="printer stopped responding", finished=time.time())
+                for j in (job, staged):
+                    if j is not None and j["state"] in (ASSIGNED, STAGED):
+                        self.queue.update(j, state=QUEUED, assigned_to=None, run=None)
+                return
+
+        await printer.disconnect()
+
+    async def upload(self, printer: SaturnPrinter, job: dict, requeue_on_failure: bool = False) -> bool:
+        filename = Path(job["filename"])
+        if not filename.exists():
+            self.queue.update(job, state=FAILED, error="file not found", finished=time.time())
+            logger.error(f"Job {job['id']}: {filename} does not exist")
+            return False
+
+        try:
+            await printer.upload_file(filename)
+        except UploadError as e:
+            if requeue_on_failure:
+                logger.warning(f"{printer.describe()}: could not prefetch job {job['id']}, will retry later")
+                self.queue.update(job, state=QUEUED, assigned_to=None, run=None)
+            else:
+                self.queue.update(job, state=FAILED, error=str(e), finished=time.time())
+                logger.error(f"{printer.describe()}: upload of job {job['id']} failed")
+            return False
+
+        self.queue.update(job, state=STAGED)
+        return True
@@ -0,0 +1,62 @@
+"""
+Creating the MQTT and HTTP servers printers talk to
+
+``create_mqtt_server`` starts our own MQTT server, or connects to an external broker, and
+``create_http_server`` starts the HTTP server printers download files from, with any worker
+processes. Both return the server, its port and the task serving it.
+"""
+
+import asyncio
+
+from loguru import logger
+
+from cassini.broker import BrokerTransport, parse_broker_address
+from cassini.loop import HTTPWorkerPool, reuse_port_supported
+from cassini.simple_http_server import SimpleHTTPServer
+from cassini.simple_mqtt_server import SimpleMQTTServer
+from cassini.staging import StagedFileCache
+
+
+# With a broker address ("host" or "host:port"), printers are driven through that MQTT broker
+# (they must have been pointed at it with connect-mqtt) instead of a server of our own. They
+# then download files from http_host, by default the address we reach the broker from.
+async def create_mqtt_server(capture=None, broker=None, share_group=None, http_host=None):
+    if broker is not None:
+        host, port = parse_broker_address(broker)
+        mqtt = BrokerTransport(host, port, share_group=share_group, capture=capture, http_host=http_host)
+    else:
+        mqtt = SimpleMQTTServer("0.0.0.0", 0, capture=capture)  # noqa: S104
+    await mqtt.start()
+    mqtt_server_task = asyncio.create_task(mqtt.serve_forever())
+    return mqtt, mqtt.port, mqtt_server_task
+
+
+# With workers, that many extra processes serve the same routes on the same port. With stage_local,
+# files are copied to a local cache directory and served from there.
+async def create_http_server(rate_limit=None, connection_rate_limit=None, workers=0, stage_local=False):
+    if workers and not reuse_port_supported():
+        logger.warning("SO_REUSEPORT is not supported here, serving files from this process only")
+        workers = 0
+    # the total rate limit is split between all processes serving files
+    if rate_limit:
+        rate_limit /= workers + 1
+    http = SimpleHTTPServer(
+        "0.0.0.0",  # noqa: S104
+        0,
+        rate_limit=rate_limit,
+        connection_rate_limit=connection_rate_limit,
+        reuse_port=workers > 0,
+        staged_files=StagedFileCache() if stage_local else None,
+    )
+    await http.start()
+    if workers:
+        http.workers = HTTPWorkerPool(
+            http.host,
+            http.port,
+            workers,
+            rate_limit=rate_limit,
+            connection_rate_limit=connection_rate_limit,
+        )
+        await http.workers.start()
+    http_server_task = asyncio.create_task(http.serve_forever())
+    return http, http.port, http_server_task
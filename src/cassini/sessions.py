@@ -0,0 +1,254 @@
+"""
+Reusing printer connections across operations
+
+``SessionPool`` keeps one connected ``SaturnPrinter`` per MainboardID together with the
+servers it is connected to, so a script that uploads ten files to one printer connects to
+it once. Every session gets its own MQTT server (or shares the connection to a broker),
+and all sessions share one HTTP server. A session that has been idle for a while is
+checked with a ``CMD_0`` round trip before it is reused, and reconnected if that fails.
+Sessions idle for longer than ``idle_timeout`` are disconnected and their servers closed;
+``close`` does that for all of them.
+
+Operations on one printer go through ``session``, which also makes sure only one of them
+reads the printer's messages at a time. Given the file an operation is about to upload, it
+has the HTTP server read and hash the file while the printer connects.
+"""
+
+import asyncio
+import contextlib
+import time
+from pathlib import Path
+from typing import Final
+
+from loguru import logger
+
+from cassini.exceptions import CommandError
+from cassini.saturn_printer import Command, SaturnPrinter
+from cassini.servers import create_http_server, create_mqtt_server
+
+IDLE_TIMEOUT: Final[float] = 300.0
+# sessions unused for longer than this are health checked before they are reused
+HEALTH_CHECK_AFTER: Final[float] = 10.0
+HEALTH_CHECK_TIMEOUT: Final[float] = 5.0
+DISCONNECT_TIMEOUT: Final[float] = 2.0
+
+
+class PrinterSession:
+    def __init__(self, printer: SaturnPrinter, mqtt, owns_mqtt: bool):
+        self.printer = printer
+        self.mqtt = mqtt
+        # False when the MQTT connection is a broker connection shared with other sessions
+        self.owns_mqtt = owns_mqtt
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+    def idle(self) -> float:
+        return time.monotonic() - self.last_used
+
+
+class SessionPool:
+    def __init__(
+        self,
+        *,
+        idle_timeout: float = IDLE_TIMEOUT,
+        capture=None,
+        rate_limit=None,
+        connection_rate_limit=None,
+        broker=None,
+        stage_local=False,
+        http_host=None,
+    ):
+        self.idle_timeout = idle_timeout
+        self.capture = capture
+        self.rate_limit = rate_limit
+        self.connection_rate_limit = connection_rate_limit
+        self.broker = broker
+        self.stage_local = stage_local
+        self.http_host = http_host
+        self.sessions: dict[str, PrinterSession] = {}
+        self.http = None
+        self.shared_mqtt = None
+        self.reaper = None
+        # MainboardID -> lock held while creating or dropping that printer's session, so concurrent
+        # callers don't connect it twice while other printers connect in parallel
+        self.printer_locks: dict[str, asyncio.Lock] = {}
+        self.http_lock = asyncio.Lock()
+        self.mqtt_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    # The connected printer for printer's MainboardID, connecting it first if there's no usable
+    # session. Raises ConnectionError if the printer doesn't connect.
+    async def get(self, printer: SaturnPrinter) -> SaturnPrinter:
+        return (await self.checkout(printer)).printer
+
+    # Run one operation on a printer:
+    #     async with pool.session(printer, stage=filename) as p:
+    #         await p.upload_file(filename)
+    # With stage, that file is read and hashed while the printer connects.
+    @contextlib.asynccontextmanager
+    async def session(self, printer: SaturnPrinter, stage: Path | None = None, compress: bool = False):
+        staging = asyncio.ensure_future(self.stage(stage, compress)) if stage is not None else None
+        try:
+            session = await self.checkout(printer)
+        except BaseException:
+            if staging is not None:
+                staging.cancel()
+                with contextlib.suppress(Exception, asyncio.CancelledError):
+                    await staging
+            raise
+        if staging is not None:
+            await staging
+        async with session.lock:
+            try:
+                yield session.printer
+            finally:
+                session.last_used = time.monotonic()
+
+    # Whether printer has a session whose MQTT connection is still up
+    def attached(self, printer: SaturnPrinter) -> bool:
+        session = self.sessions.get(printer.id)
+        return session is not None and session.mqtt.attached(session.printer)
+
+    def printer_lock(self, printer_id: str) -> asyncio.Lock:
+        return self.printer_locks.setdefault(printer_id, asyncio.Lock())
+
+    async def checkout(self, printer: SaturnPrinter) -> PrinterSession:
+        async with self.printer_lock(printer.id):
+            session = self.sessions.get(printer.id)
+            if session is not None and not await self.healthy(session):
+                await self.drop(session)
+                session = None
+            if session is None:
+                session = await self.connect(printer)
+            session.last_used = time.monotonic()
+            if self.reaper is None:
+                self.reaper = asyncio.create_task(self.reap())
+            return session
+
+    async def healthy(self, session: PrinterSession) -> bool:
+        if not session.mqtt.attached(session.printer):
+            logger.info(f"{session.printer.describe()}: printer went away, reconnecting")
+            return False
+        if session.idle() < HEALTH_CHECK_AFTER or session.lock.locked():
+            return True
+        try:
+            async with session.lock:
+                await asyncio.wait_for(
+                    session.printer.send_command_and_wait(Command.CMD_0, abort_on_bad_ack=False),
+                    timeout=HEALTH_CHECK_TIMEOUT,
+                )
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.info(f"{session.printer.describe()}: session is gone ({e!r}), reconnecting")
+            return False
+        return True
+
+    async def start_http(self):
+        async with self.http_lock:
+            if self.http is None:
+                self.http, *_ = await create_http_server(
+                    rate_limit=self.rate_limit,
+                    connection_rate_limit=self.connection_rate_limit,
+                    stage_local=self.stage_local,
+                )
+        return self.http
+
+    # Get filename ready to be served, so that its upload doesn't have to wait for the disk
+    async def stage(self, filename: Path, compress: bool = False):
+        http = await self.start_http()
+        started = time.monotonic()
+        await http.stage_file(filename, compress=compress)
+        logger.debug(f"Staged {filename} in {time.monotonic() - started:.2f} s")
+
+    async def connect(self, printer: SaturnPrinter) -> PrinterSession:
+        await self.start_http()
+        owns_mqtt = self.broker is None
+        if owns_mqtt:
+            mqtt, *_ = await create_mqtt_server(capture=self.capture)
+        else:
+            async with self.mqtt_lock:
+                if self.shared_mqtt is not None and self.shared_mqtt.closed:
+                    logger.info(f"Reconnecting to MQTT broker {self.broker}")
+                    await self.shared_mqtt.close()
+                    self.shared_mqtt = None
+                if self.shared_mqtt is None:
+                    self.shared_mqtt, *_ = await create_mqtt_server(
+                        capture=self.capture, broker=self.broker, http_host=self.http_host
+                    )
+            mqtt = self.shared_mqtt
+
+        # a printer that rejects or doesn't answer the handshake is as good as unreachable
+        cause = None
+        try:
+            connected = await printer.connect(mqtt, self.http)
+        except (CommandError, ConnectionError, TimeoutError, asyncio.TimeoutError) as e:
+            connected = False
+            cause = e
+        if not connected:
+            if owns_mqtt:
+                await mqtt.close()
+            else:
+                with contextlib.suppress(ConnectionError, asyncio.TimeoutError):
+                    await mqtt.detach(printer)
+            msg = f"Failed to connect to {printer.describe()}"
+            if cause is not None:
+                msg += f": {str(cause) or 'no response'}"
+            logger.error(msg)
+            raise ConnectionError(msg) from cause
+        logger.debug(f"{printer.describe()}: new session")
+        session = PrinterSession(printer, mqtt, owns_mqtt)
+        self.sessions[printer.id] = session
+        return session
+
+    async def drop(self, session: PrinterSession, disconnect: bool = False):
+        self.sessions.pop(session.printer.id, None)
+        if disconnect:
+            with contextlib.suppress(asyncio.TimeoutError, ConnectionError):
+                await asyncio.wait_for(session.printer.disconnect(), timeout=DISCONNECT_TIMEOUT)
+        if session.owns_mqtt:
+            await session.mqtt.close()
+        else:
+            await session.mqtt.detach(session.printer)
+
+    # Disconnect sessions that have been idle for longer than idle_timeout, all at once
+    async def reap(self):
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            await asyncio.gather(*(self.reap_session(s) for s in list(self.sessions.values())))
+
+    async def reap_session(self, session: PrinterSession):
+        lock = self.printer_lock(session.printer.id)
+        # a printer being checked out is about to be used
+        if lock.locked():
+            return
+        async with lock:
+            if (
+                self.sessions.get(session.printer.id) is session
+                and session.idle() > self.idle_timeout
+                and not session.lock.locked()
+            ):
+                logger.debug(f"{session.printer.describe()}: closing idle session")
+                await self.drop(session, disconnect=True)
+
+    async def close_session(self, session: PrinterSession):
+        async with self.printer_lock(session.printer.id):
+            if self.sessions.get(session.printer.id) is session:
+                await self.drop(session, disconnect=True)
+
+    async def close(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+            self.reaper = None
+        await asyncio.gather(*(self.close_session(s) for s in list(self.sessions.values())))
+        async with self.mqtt_lock:
+            if self.shared_mqtt is not None:
+                await self.shared_mqtt.close()
+                self.shared_mqtt = None
+        async with self.http_lock:
+            if self.http is not None:
+                await self.http.close()
+                self.http = None
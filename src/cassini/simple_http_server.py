@@ -5,99 +5,414 @@
 # License: MIT
 #
 import asyncio
-import hashlib
+import contextlib
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Final
 
 from loguru import logger
 
+from cassini.compression import CompressedFileCache, file_md5
+from cassini.staging import prefetch
+from cassini.throttle import FairQueue, TokenBucket
+
+MAX_HEADER_SIZE: Final[int] = 8192
+KEEP_ALIVE_TIMEOUT: Final[float] = 30.0
+# how long a shared file route stays up after its last upload finished, so the printer can retry
+ROUTE_TTL: Final[float] = 300.0
+# threads for blocking disk work (hashing, compressing, reading files), so that a slow disk
+# doesn't stall the event loop and with it every other printer's MQTT traffic
+FILE_IO_WORKERS: Final[int] = 4
+# how long close() waits for client connections to wind down
+CLOSE_TIMEOUT: Final[float] = 2.0
+
+
+def parse_request(head: bytes):
+    lines = head.decode("latin-1").split("\r\n")
+    match lines[0].split():
+        case [method, path, version] if version.startswith("HTTP/"):
+            pass
+        case _:
+            msg = f"Malformed request line: {lines[0]!r}"
+            raise ValueError(msg)
+
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(":")
+        if not sep:
+            msg = f"Malformed header line: {line!r}"
+            raise ValueError(msg)
+        headers[name.strip().lower()] = value.strip()
+    return method, path, version, headers
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [t.strip().removeprefix("W/").strip('"') for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+# Parse a single "bytes=" range into a half-open (start, end) interval. Returns None when the header
+# should be ignored (other units, several ranges, or garbage), and (-1, -1) when it can't be satisfied.
+def parse_range(range_header: str, size: int):
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            # suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                return (-1, -1)
+            return (max(size - length, 0), size)
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    if start >= size or end <= start:
+        return (-1, -1)
+    return (start, min(end, size))
+
+
+def read_at(f, offset: int, count: int) -> bytes:
+    f.seek(offset)
+    return f.read(count)
+
 
 class SimpleHTTPServer:
     BufferSize = 1024768
+    # smaller chunks when rate limited, so that the fair queue can interleave transfers finely
+    ThrottledBufferSize = 65536
 
-    def __init__(self, host="0.0.0.0", port=0):  # noqa: S104
+    # rate_limit caps the total rate of all transfers, shared between routes in proportion to their
+    # weight, and connection_rate_limit caps each individual connection (both in bytes/s)
+    def __init__(
+        self,
+        host="0.0.0.0",  # noqa: S104
+        port=0,
+        *,
+        compressed_files=None,
+        rate_limit=None,
+        connection_rate_limit=None,
+        route_ttl=ROUTE_TTL,
+        reuse_port=False,
+        staged_files=None,
+    ):
         self.host = host
         self.port = port
         self.server = None
         self.routes = {}
+        # (file, size, mtime, compress) -> path of its shared route, so a file is only hashed once
+        # while its route is up
+        self.shared_files = {}
+        self.route_ttl = route_ttl
+        self.compressed_files = compressed_files or CompressedFileCache()
+        # StagedFileCache to serve local copies of files from, instead of the files themselves
+        self.staged_files = staged_files
+        self.fair_queue = FairQueue(rate_limit) if rate_limit else None
+        self.connection_rate_limit = connection_rate_limit
+        self.stats = {}
+        # open client connections and the tasks serving them
+        self.connections = {}
+        self.reuse_port = reuse_port
+        # HTTPWorkerPool serving the same routes from other processes
+        self.workers = None
+        self.executor = ThreadPoolExecutor(max_workers=FILE_IO_WORKERS, thread_name_prefix="cassini-http-io")
+        # (file, size, mtime, compress) -> task building its route, so concurrent acquires hash it once
+        self.pending_routes = {}
+        # cleared when the event loop has no loop.sendfile (uvloop), to read files in threads instead
+        self.use_sendfile = True
 
-    def register_file_route(self, path, filename):
-        size = os.path.getsize(filename)
-        # TODO: can we replace use of hashlib?
-        md5 = hashlib.md5()  # noqa: S324
-        with open(filename, "rb") as f:
-            while True:
-                if data := f.read(1024):
-                    md5.update(data)
-                else:
-                    break
-        route = {"file": filename, "size": size, "md5": md5.hexdigest()}
-        self.routes[path] = route
+    # With compress, the route serves a compressed copy of the file, and the size and MD5 in the
+    # returned route are those of the compressed copy. The registration holds a reference to the
+    # route, so it stays up until unregister_file_route even if acquire_file shares it.
+    async def register_file_route(self, path, filename, compress=False, weight=1.0):
+        route = await self.run_blocking(self.make_route, filename, compress, weight)
+        self.install_route(path, route, refs=1)
         return route
 
+    def install_route(self, path, route, refs=0):
+        # (file, size, mtime, compress) keys in shared_files that lead to this route
+        route["keys"] = set()
+        route["refs"] = refs
+        route["expiry"] = None
+        self.routes[path] = route
+        if self.workers is not None:
+            self.workers.add_route(path, route)
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    # Hashes (and with compress, compresses) the whole file, so run it through run_blocking
+    def make_route(self, filename, compress=False, weight=1.0):
+        md5 = None
+        if self.staged_files is not None:
+            filename, md5 = self.staged_files.get(filename)
+        else:
+            prefetch(filename)
+        if compress:
+            filename = self.compressed_files.get(filename, md5)
+            md5 = None
+        size = os.path.getsize(filename)
+        return {
+            "file": filename,
+            "size": size,
+            "md5": md5 or file_md5(filename),
+            "compressed": compress,
+            "weight": weight,
+        }
+
+    # Bytes sent, time spent sending, and average rate per transfer of every route served so far
+    def throughput(self):
+        return {
+            path: {**stats, "rate": stats["bytes"] / stats["seconds"] if stats["seconds"] > 0 else 0.0}
+            for path, stats in self.stats.items()
+        }
+
     def unregister_file_route(self, path):
-        del self.routes[path]
+        route = self.routes.pop(path, None)
+        if route is None:
+            return
+        if (expiry := route.get("expiry")) is not None:
+            expiry.cancel()
+        for key in route.get("keys", ()):
+            self.shared_files.pop(key, None)
+        if (stats := self.stats.get(path)) is not None and stats["active"] == 0:
+            del self.stats[path]
+        if self.workers is not None:
+            self.workers.remove_route(path)
+        logger.debug(f"HTTP unregistered route {path}")
+
+    # Content-addressed route for serving filename to a printer. Routes are named after the MD5 of
+    # what they serve, so concurrent uploads of the same file share one route; every acquire_file
+    # has to be paired with a release_file, and the route goes away route_ttl seconds after the
+    # last release.
+    async def acquire_file(self, filename, ext, compress=False, weight=1.0):
+        st = await self.run_blocking(os.stat, filename)
+        key = (os.path.realpath(filename), st.st_size, st.st_mtime_ns, compress)
+        if key not in self.shared_files:
+            if (pending := self.pending_routes.get(key)) is None:
+                pending = asyncio.ensure_future(self.run_blocking(self.make_route, filename, compress, weight))
+                self.pending_routes[key] = pending
+                pending.add_done_callback(lambda _: self.pending_routes.pop(key, None))
+            route = await asyncio.shield(pending)
+        # whoever finished hashing first installs the route; the same content under another name
+        # is served from the route we already have
+        if (path := self.shared_files.get(key)) is None:
+            path = f"/{route['md5']}.{ext}"
+            if path not in self.routes:
+                self.install_route(path, route)
+            self.shared_files[key] = path
+            self.routes[path]["keys"].add(key)
+
+        route = self.routes[path]
+        route["refs"] += 1
+        if route["expiry"] is not None:
+            route["expiry"].cancel()
+            route["expiry"] = None
+        logger.debug("HTTP route {} acquired ({} active)", path, route["refs"])
+        return path, route
+
+    # Build the route for filename ahead of an upload, e.g. while the printer is still connecting,
+    # so that the acquire_file of the upload finds it ready. The route stays up for route_ttl.
+    async def stage_file(self, filename, compress=False):
+        ext = Path(filename).suffix.lstrip(".").lower()
+        path, _ = await self.acquire_file(filename, ext, compress=compress)
+        self.release_file(path)
+        return path
+
+    def release_file(self, path):
+        if (route := self.routes.get(path)) is None:
+            return
+        route["refs"] -= 1
+        logger.debug("HTTP route {} released ({} active)", path, route["refs"])
+        if route["refs"] <= 0:
+            route["expiry"] = asyncio.get_running_loop().call_later(self.route_ttl, self.unregister_file_route, path)
+
+    # Wait until routes registered so far can be served, by worker processes too
+    async def routes_ready(self):
+        if self.workers is not None:
+            await self.workers.sync()
 
     async def start(self):
-        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        # the stream limit caps how much of a request head we buffer while looking for its end
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port, limit=MAX_HEADER_SIZE, reuse_port=self.reuse_port or None
+        )
         self.port = self.server.sockets[0].getsockname()[1]
         logger.debug(f"HTTP Listening on {self.server.sockets[0].getsockname()}")
 
     async def serve_forever(self):
         await self.server.serve_forever()
 
+    # Stop listening, drop every connection and forget all routes
+    async def close(self):
+        if self.workers is not None:
+            workers, self.workers = self.workers, None
+            await workers.stop()
+        if self.server is None:
+            return
+        self.server.close()
+        for writer in self.connections:
+            writer.close()
+        if self.connections:
+            await asyncio.wait(self.connections.values(), timeout=CLOSE_TIMEOUT)
+        for path in list(self.routes):
+            self.unregister_file_route(path)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.server = None
+
     async def handle_client(self, reader, writer):
+        self.connections[writer] = asyncio.current_task()
         try:
             await self.handle_client_inner(reader, writer)
         except Exception as e:
             logger.error(f"HTTP Exception handling client: {e}")
+        finally:
+            del self.connections[writer]
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+            logger.debug("HTTP connection closed")
 
+    # Serve requests on one connection until the client closes it, asks us to, or goes idle
     async def handle_client_inner(self, reader, writer):
-        logger.debug(f"HTTP connection from {writer.get_extra_info('peername')}")
-        data = b""
+        logger.opt(lazy=True).debug("HTTP connection from {}", lambda: writer.get_extra_info("peername"))
         while True:
-            data += await reader.read(1024)
-            if b"\r\n\r\n" in data:
-                break
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=KEEP_ALIVE_TIMEOUT)
+            except (asyncio.IncompleteReadError, TimeoutError, asyncio.TimeoutError):
+                return
+            except asyncio.LimitOverrunError:
+                await self.send_response(writer, 431, "Request Header Fields Too Large", keep_alive=False)
+                return
+
+            logger.debug("HTTP request: {}", head)
+            try:
+                method, path, version, headers = parse_request(head)
+            except ValueError as e:
+                logger.debug("HTTP bad request: {}", e)
+                await self.send_response(writer, 400, "Bad Request", keep_alive=False)
+                return
 
-        logger.debug(f"HTTP request: {data}")
-        request_line = data.decode().splitlines()[0]
-        method, path, _ = request_line.split()
+            connection = headers.get("connection", "").lower()
+            keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+            if not await self.handle_request(writer, method, path, headers, keep_alive):
+                return
+
+    # Returns whether the connection can take another request
+    async def handle_request(self, writer, method, path, headers, keep_alive) -> bool:
+        if method not in ("GET", "HEAD"):
+            await self.send_response(writer, 405, "Method Not Allowed", {"Allow": "GET, HEAD"}, keep_alive)
+            return keep_alive
 
         if path not in self.routes:
-            logger.debug(f"HTTP path {path} not found in routes")
-            logger.debug(self.routes)
-            writer.write(b"HTTP/1.1 404 Not Found\r\n")
-            writer.close()
-            return
+            logger.debug("HTTP path {} not found in routes", path)
+            logger.opt(lazy=True).debug("HTTP routes: {}", lambda: list(self.routes))
+            await self.send_response(writer, 404, "Not Found", keep_alive=keep_alive)
+            return keep_alive
 
         route = self.routes[path]
-        logger.debug(f"HTTP method {method} path {path} route: {route}")
-
-        header = (
-            f"HTTP/1.1 200 OK\r\n"
-            f"Content-Type: text/plain; charset=utf-8\r\n"
-            f"Etag: {route['md5']}\r\n"
-            f"Content-Length: {route['size']}\r\n"
-            "\r\n"
-        )
+        logger.debug("HTTP method {} path {} route: {}", method, path, route)
+        size = route["size"]
+        route_headers = {"Etag": route["md5"], "Accept-Ranges": "bytes"}
+
+        if (etags := headers.get("if-none-match")) is not None and etag_matches(etags, route["md5"]):
+            await self.send_response(writer, 304, "Not Modified", route_headers, keep_alive, content_length=None)
+            return keep_alive
+
+        start, end = 0, size
+        status, reason = 200, "OK"
+        if (range_header := headers.get("range")) is not None:
+            match parse_range(range_header, size):
+                case None:
+                    pass
+                case (-1, _):
+                    route_headers["Content-Range"] = f"bytes */{size}"
+                    await self.send_response(writer, 416, "Range Not Satisfiable", route_headers, keep_alive)
+                    return keep_alive
+                case (start, end):
+                    status, reason = 206, "Partial Content"
+                    route_headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
 
-        logger.debug(f"Writing header:\n{header}")
+        await self.send_response(writer, status, reason, route_headers, keep_alive, content_length=end - start)
+        # after a body cut short, the client would read the next response as the rest of this one
+        if method == "GET" and await self.send_file(writer, path, route, start, end) < end - start:
+            logger.warning(f"HTTP transfer of {path} ended early, closing the connection")
+            return False
+        return keep_alive
+
+    async def send_response(self, writer, status, reason, headers=None, keep_alive=True, *, content_length=0):
+        header = f"HTTP/1.1 {status} {reason}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+        for name, value in (headers or {}).items():
+            header += f"{name}: {value}\r\n"
+        # a 304 has no body, and its Content-Length would have to describe the full file
+        if content_length is not None:
+            header += f"Content-Length: {content_length}\r\n"
+        if not keep_alive:
+            header += "Connection: close\r\n"
+        header += "\r\n"
+
+        logger.debug("Writing header:\n{}", header)
         writer.write(header.encode())
+        await writer.drain()
 
-        if method == "GET":
-            total = 0
-            with open(route["file"], "rb") as f:
-                while True:
-                    data = f.read(self.BufferSize)
-                    if not data:
+    async def send_file(self, writer, path, route, start=0, end=None):
+        throttled = self.fair_queue is not None or self.connection_rate_limit is not None
+        buffer_size = self.ThrottledBufferSize if throttled else self.BufferSize
+        connection_bucket = TokenBucket(self.connection_rate_limit) if self.connection_rate_limit else None
+
+        stats = self.stats.setdefault(path, {"bytes": 0, "seconds": 0.0, "transfers": 0, "active": 0})
+        stats["transfers"] += 1
+        stats["active"] += 1
+        started = time.monotonic()
+        remaining = (route["size"] if end is None else end) - start
+        total = 0
+        try:
+            with await self.run_blocking(open, route["file"], "rb") as f:
+                while remaining > 0:
+                    count = min(buffer_size, remaining)
+                    if self.fair_queue is not None:
+                        await self.fair_queue.acquire(path, count, route["weight"])
+                    if connection_bucket is not None:
+                        await connection_bucket.consume(count)
+                    if (sent := await self.send_chunk(writer, f, start + total, count)) == 0:
                         break
-                    writer.write(data)
-                    logger.debug(f"HTTP wrote {len(data)} bytes")
-                    # await asyncio.sleep(1)
-                    total += len(data)
-            logger.debug(f"HTTP wrote total {total} bytes")
+                    logger.trace("HTTP wrote {} bytes", sent)
+                    remaining -= sent
+                    total += sent
+                    stats["bytes"] += sent
+        finally:
+            elapsed = time.monotonic() - started
+            stats["seconds"] += elapsed
+            stats["active"] -= 1
+            if stats["active"] == 0:
+                if self.fair_queue is not None:
+                    self.fair_queue.remove_flow(path)
+                # the route went away during the transfer, and its stats are left to us
+                if path not in self.routes:
+                    del self.stats[path]
+            logger.info(
+                f"HTTP sent {total} bytes of {path} in {elapsed:.1f}s ({total / max(elapsed, 1e-6) / 1024:.0f} KiB/s)"
+            )
+        return total
 
+    # Send count bytes of f from offset without reading the file on the event loop: with
+    # loop.sendfile (os.sendfile where the platform has it), or by reading it in a thread
+    async def send_chunk(self, writer, f, offset, count):
+        if self.use_sendfile:
+            try:
+                return await asyncio.get_running_loop().sendfile(writer.transport, f, offset, count)
+            except NotImplementedError:
+                logger.debug("Event loop has no sendfile, reading files in threads")
+                self.use_sendfile = False
+        data = await self.run_blocking(read_at, f, offset, count)
+        writer.write(data)
         await writer.drain()
-        writer.close()
-        await writer.wait_closed()
-        logger.debug("HTTP connection closed")
+        return len(data)
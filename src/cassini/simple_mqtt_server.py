@@ -6,157 +6,411 @@
 #
 
 import asyncio
+import contextlib
 import struct
+import time
+from collections import deque
 from typing import Final
 
 from loguru import logger
 
+from cassini.topics import TopicTrie, valid_filter
+from cassini.transport import MQTTTransport
+
 MQTT_CONNECT: Final[int] = 1
 MQTT_CONNACK: Final[int] = 2
 MQTT_PUBLISH: Final[int] = 3
 MQTT_PUBACK: Final[int] = 4
+MQTT_PUBREC: Final[int] = 5
+MQTT_PUBREL: Final[int] = 6
+MQTT_PUBCOMP: Final[int] = 7
 MQTT_SUBSCRIBE: Final[int] = 8
 MQTT_SUBACK: Final[int] = 9
+MQTT_UNSUBSCRIBE: Final[int] = 10
+MQTT_UNSUBACK: Final[int] = 11
+MQTT_PINGREQ: Final[int] = 12
+MQTT_PINGRESP: Final[int] = 13
 MQTT_DISCONNECT: Final[int] = 14
 
-MIN_NUMBER_OF_BYTES: Final[int] = 2
 MAX_FINAL_REMAINING_LENGTH: Final[int] = 2097152
 
+# highest QoS granted to subscribers; QoS 2 subscriptions are downgraded to 1
+MAX_QOS: Final[int] = 1
+SUBACK_FAILURE: Final[int] = 0x80
+PUBLISH_DUP: Final[int] = 0x08
+CONNECT_CLEAN_SESSION: Final[int] = 0x02
+# unacknowledged QoS 1 messages per client before sending more has to wait
+MAX_INFLIGHT: Final[int] = 16
+RETRY_INTERVAL: Final[float] = 5.0
+MAX_RETRIES: Final[int] = 5
+# messages published while nobody is subscribed to their topic are held until someone is
+MAX_UNDELIVERED: Final[int] = 256
+# how long close() waits for client connections to wind down
+CLOSE_TIMEOUT: Final[float] = 2.0
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        digit = length % 128
+        length //= 128
+        if length > 0:
+            digit |= 0x80
+        encoded.append(digit)
+        if length == 0:
+            break
+    return encoded
+
+
+def decode_length(data):
+    multiplier = 1
+    value = 0
+    bytes_read = 0
+
+    for byte in data:
+        bytes_read += 1
+        value += (byte & 0x7F) * multiplier
+        if byte & 0x80 == 0:
+            break
+        multiplier *= 128
+        if multiplier > MAX_FINAL_REMAINING_LENGTH:
+            msg = "Malformed Remaining Length"
+            raise ValueError(msg)
+
+    return value, bytes_read
+
+
+# Read one control packet: (packet type, flags, everything after the remaining length)
+async def read_packet(reader):
+    header = await reader.readexactly(1)
+    length_bytes = b""
+    while True:
+        length_bytes += await reader.readexactly(1)
+        if length_bytes[-1] & 0x80 == 0:
+            break
+    length, _ = decode_length(length_bytes)
+    body = await reader.readexactly(length) if length else b""
+    return header[0] >> 4, header[0] & 0xF, body
+
+
+def read_string(data, offset=0):
+    length = struct.unpack("!H", data[offset : offset + 2])[0]
+    end = offset + 2 + length
+    return data[offset + 2 : end].decode("utf-8"), end
+
+
+class ClientSession:
+    def __init__(self, writer):
+        self.writer = writer
+        self.addr = writer.get_extra_info("peername")
+        self.client_id = None
+        self.clean_session = True
+        # topic filter -> granted QoS
+        self.filters: dict[str, int] = {}
+        self.outgoing = asyncio.Queue()
+        # packet id -> [topic, payload, time sent, retries] of QoS 1 messages not yet acknowledged
+        self.inflight: dict[int, list] = {}
+        self.window_open = asyncio.Event()
+        # packet ids of incoming QoS 2 messages waiting for PUBREL
+        self.awaiting_release: set[int] = set()
+        self.next_pack_id_value = 1
+
+    # Packet ids are counted per client, skipping any that are still in flight
+    def next_pack_id(self):
+        while True:
+            pack_id = self.next_pack_id_value
+            self.next_pack_id_value = pack_id % 0xFFFF + 1
+            if pack_id not in self.inflight:
+                return pack_id
+
 
-class SimpleMQTTServer:
-    def __init__(self, host: str, port: int):
+class SimpleMQTTServer(MQTTTransport):
+    def __init__(self, host: str, port: int, capture=None):
         self.host = host
         self.port = port
+        self.capture = capture
         self.server = None
         self.incoming_messages = asyncio.Queue()
-        self.outgoing_messages = asyncio.Queue()
+        self.subscriptions = TopicTrie()
+        self.undelivered = deque(maxlen=MAX_UNDELIVERED)
+        self.had_subscriber = False
         self.connected_clients = {}
-        self.next_pack_id_value = 1
+        # client id -> (topic filters with their QoS, messages not yet delivered) of clients that
+        # connected without clean session, kept for when they reconnect
+        self.stored_sessions: dict[str, tuple[dict[str, int], list]] = {}
+        self.sessions: set[ClientSession] = set()
+        self.client_tasks: set[asyncio.Task] = set()
 
     async def start(self):
         self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
         self.port = self.server.sockets[0].getsockname()[1]
+        loop = asyncio.get_running_loop()
+        self.client_connection = loop.create_future()
+        self.client_subscribed = loop.create_future()
         logger.debug(f"MQTT Listening on {self.server.sockets[0].getsockname()}")
 
     async def serve_forever(self):
-        loop = asyncio.get_event_loop()
-        self.client_connection = loop.create_future()
-        self.client_subscribed = loop.create_future()
         await self.server.serve_forever()
 
-    def publish(self, topic, payload):
-        self.outgoing_messages.put_nowait({"topic": topic, "payload": payload})
+    # Stop listening and drop every client, letting their handlers finish rather than leaving them
+    # to be cancelled when the event loop shuts down
+    async def close(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for session in self.sessions:
+            session.writer.close()
+        if self.client_tasks:
+            await asyncio.wait(self.client_tasks, timeout=CLOSE_TIMEOUT)
+        self.server = None
 
-    async def next_published_message(self):
+    # Tell the printer to connect to this server, and wait for it to do so and subscribe to its
+    # request topic
+    async def attach(self, printer):
+        printer.redirect(self.port)
+
+        client_id = await asyncio.wait_for(self.client_connection, timeout=printer.timeout)
+        if client_id != printer.id:
+            logger.error(f"Client ID mismatch: {client_id} != {printer.id}")
+            return False
+
+        topic = await asyncio.wait_for(self.client_subscribed, timeout=printer.timeout)
+        logger.debug(f"Client subscribed to {topic}")
+        return True
+
+    def attached(self, printer):
+        return printer.id in self.connected_clients
+
+    # Queue a message for every client subscribed to topic. A message nobody is subscribed to is
+    # held until someone subscribes to it: a request sent while the printer is still connecting,
+    # or while it reconnects after losing its connection.
+    def publish(self, topic, payload: bytes | str):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if not (subscribers := self.subscriptions.match(topic)):
+            if len(self.undelivered) == self.undelivered.maxlen:
+                logger.warning(f"Dropping oldest undelivered message on {self.undelivered[0][0]}")
+            if self.had_subscriber:
+                logger.warning(f"No subscribers for {topic}, holding the message until the printer subscribes again")
+            else:
+                logger.debug("No subscribers for {}, holding message", topic)
+            self.undelivered.append((topic, payload))
+            return
+        for session, qos in subscribers.items():
+            session.outgoing.put_nowait((topic, payload, qos))
+
+    # every printer has a server of its own, so all messages are from the same printer
+    async def next_published_message(self, printer_id=None):  # noqa: ARG002
         return await self.incoming_messages.get()
 
     async def handle_client(self, reader, writer):
+        session = ClientSession(writer)
+        self.sessions.add(session)
+        self.client_tasks.add(asyncio.current_task())
+        sender = asyncio.create_task(self.send_loop(session))
         try:
-            await self.handle_client_inner(reader, writer)
+            await self.handle_client_inner(reader, session)
+        except asyncio.IncompleteReadError:
+            logger.info(f"Client {session.addr} connection lost")
         except Exception as e:
             logger.error(f"MQTT Exception handling client: {e}")
-
-    async def handle_client_inner(self, reader, writer):
-        addr = writer.get_extra_info("peername")
-        logger.debug(f"Socket connected from {addr}")
-        data = b""
-
-        subscribed_topics = {}
-        client_id = None
-
-        read_future = asyncio.ensure_future(reader.read(1024))
-        outgoing_messages_future = asyncio.ensure_future(self.outgoing_messages.get())
-
+        finally:
+            sender.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await sender
+            self.end_session(session)
+            writer.close()
+            self.sessions.discard(session)
+            self.client_tasks.discard(asyncio.current_task())
+
+    async def handle_client_inner(self, reader, session):
+        logger.debug(f"Socket connected from {session.addr}")
         while True:
-            completed, pending = await asyncio.wait(
-                [read_future, outgoing_messages_future], return_when=asyncio.FIRST_COMPLETED
-            )
-
-            if outgoing_messages_future in completed:
-                outmsg = outgoing_messages_future.result()
-                topic = outmsg["topic"]
-                payload = outmsg["payload"]
-
-                if topic in subscribed_topics:
-                    qos = subscribed_topics[topic]
-                    await self.send_msg(
-                        writer, MQTT_PUBLISH, payload=self.encode_publish(topic, payload, self.next_pack_id())
-                    )
-                else:
-                    logger.debug(f"SEND: NOT SUBSCRIBED {topic}: {payload}")
-                # msg = (MQTT_PUBLISH, 0, topic.encode('utf-8') + payload.encode('utf-8'))
-                # await self.send_msg(writer, *msg)
-                outgoing_messages_future = asyncio.ensure_future(self.outgoing_messages.get())
+            msg_type, msg_flags, message = await read_packet(reader)
 
-            if read_future not in completed:
-                continue
+            if msg_type == MQTT_CONNECT:
+                if message[:6] != b"\x00\x04MQTT":
+                    logger.error(f"MQTT client {session.addr}: bad CONNECT")
+                    return
 
-            d = read_future.result()
-            data += d
-            read_future = asyncio.ensure_future(reader.read(1024))
-            # Process any messages
-            while len(data) >= MIN_NUMBER_OF_BYTES:
-                msg_type = data[0] >> 4
-                msg_flags = data[0] & 0xF
-                # print(f" msg_type: {msg_type} msg_flags: {msg_flags}")
-                # TODO -- we could maybe not have enough bytes to decode the length, but assume
-                # that won't happen
-                msg_length, len_bytes_consumed = self.decode_length(data[1:])
-                # logger.debug(f"mqtt in msg_type: {msg_type} flags: {msg_flags} msg_length {msg_length} bytes_consumed for msg_length {len_bytes_consumed}")
-
-                # is there enough to process the message?
-                head_len = len_bytes_consumed + 1
-                if msg_length + head_len > len(data):
-                    logger.debug("Not enough")
-                    break
-
-                # pull the message payload out, and move data to next packet
-                message = data[head_len : head_len + msg_length]
-                data = data[head_len + msg_length :]
-
-                if msg_type == MQTT_CONNECT:
-                    if message[:6] != b"\x00\x04MQTT":
-                        logger.error(f"MQTT client {addr}: bad CONNECT")
-                        writer.close()
-                        return
-
-                    client_id_len = struct.unpack("!H", message[10:12])[0]
-                    client_id = message[12 : 12 + client_id_len].decode("utf-8")
-
-                    logger.debug(f"MQTT client {client_id} at {addr} connected")
-                    self.connected_clients[client_id] = addr
-                    await self.send_msg(writer, MQTT_CONNACK, payload=b"\x00\x00")
+                client_id, _ = read_string(message, 10)
+                session.client_id = client_id
+                session.clean_session = bool(message[7] & CONNECT_CLEAN_SESSION)
+                logger.debug(f"MQTT client {client_id} at {session.addr} connected")
+                self.connected_clients[client_id] = session.addr
+                session_present = self.restore_session(session)
+                await self.send_msg(session.writer, MQTT_CONNACK, payload=bytes([session_present, 0]))
 
+                if not self.client_connection.done():
                     self.client_connection.set_result(client_id)
-                    self.client_connection = asyncio.get_event_loop().create_future()
-
-                elif msg_type == MQTT_PUBLISH:
-                    qos = (msg_flags >> 1) & 0x3
-                    topic, packid, content = self.parse_publish(message)
-
-                    # logger.debug(f"Got DATA on: {topic}")
-                    self.incoming_messages.put_nowait({"topic": topic, "payload": content})
-                    if qos > 0:
-                        await self.send_msg(writer, MQTT_PUBACK, packet_ident=packid)
-                elif msg_type == MQTT_SUBSCRIBE:
-                    qos = (msg_flags >> 1) & 0x3
-                    packid = message[0] << 8 | message[1]
-                    message = message[2:]
-                    topic = self.parse_subscribe(message)
-                    logger.debug(f"Client {addr} subscribed to topic '{topic}', QoS {qos}")
-                    subscribed_topics[topic] = qos
-                    await self.send_msg(writer, MQTT_SUBACK, packet_ident=packid, payload=bytes([qos]))
-
-                    self.client_subscribed.set_result(topic)
-                    self.client_subscribed = asyncio.get_event_loop().create_future()
-                elif msg_type == MQTT_DISCONNECT:
-                    logger.info(f"Client {addr} disconnected")
-                    writer.close()
-                    await writer.wait_closed()
-
-                    if client_id is not None:
-                        del self.connected_clients[client_id]
+                self.client_connection = asyncio.get_running_loop().create_future()
+
+            elif msg_type == MQTT_PUBLISH:
+                qos = (msg_flags >> 1) & 0x3
+                topic, packid, content = self.parse_publish(message, qos)
+                if qos == 2:  # noqa: PLR2004
+                    # exactly once: a resend of a message we already have is only acknowledged
+                    duplicate = packid in session.awaiting_release
+                    session.awaiting_release.add(packid)
+                    await self.send_msg(session.writer, MQTT_PUBREC, packet_ident=packid)
+                    if duplicate:
+                        continue
+                elif qos == 1:
+                    await self.send_msg(session.writer, MQTT_PUBACK, packet_ident=packid)
+
+                if self.capture is not None:
+                    self.capture.mqtt_in(topic, content)
+                self.incoming_messages.put_nowait({"topic": topic, "payload": content})
+
+            elif msg_type == MQTT_PUBREL:
+                packid = struct.unpack("!H", message[:2])[0]
+                session.awaiting_release.discard(packid)
+                await self.send_msg(session.writer, MQTT_PUBCOMP, packet_ident=packid)
+
+            elif msg_type == MQTT_PUBACK:
+                packid = struct.unpack("!H", message[:2])[0]
+                if session.inflight.pop(packid, None) is not None:
+                    session.window_open.set()
+
+            elif msg_type == MQTT_SUBSCRIBE:
+                packid = struct.unpack("!H", message[:2])[0]
+                requested = self.parse_subscribe(message[2:])
+                if not requested:
+                    # a SUBSCRIBE has to have at least one filter, anything else is a protocol violation
+                    logger.error(f"MQTT client {session.addr}: SUBSCRIBE without topic filters")
                     return
+                granted = []
+                for topic_filter, requested_qos in requested:
+                    if not valid_filter(topic_filter) or requested_qos > 2:  # noqa: PLR2004
+                        logger.warning(f"Client {session.addr} sent invalid subscription '{topic_filter}'")
+                        granted.append(SUBACK_FAILURE)
+                        continue
+                    qos = min(requested_qos, MAX_QOS)
+                    logger.debug(f"Client {session.addr} subscribed to topic '{topic_filter}', QoS {qos}")
+                    self.subscriptions.subscribe(topic_filter, session, qos)
+                    session.filters[topic_filter] = qos
+                    self.had_subscriber = True
+                    granted.append(qos)
+                await self.send_msg(session.writer, MQTT_SUBACK, packet_ident=packid, payload=bytes(granted))
+                self.deliver_held_messages()
+
+                if not self.client_subscribed.done():
+                    self.client_subscribed.set_result(topic_filter)
+                self.client_subscribed = asyncio.get_running_loop().create_future()
+
+            elif msg_type == MQTT_UNSUBSCRIBE:
+                packid = struct.unpack("!H", message[:2])[0]
+                offset = 2
+                while offset < len(message):
+                    topic_filter, offset = read_string(message, offset)
+                    self.subscriptions.unsubscribe(topic_filter, session)
+                    session.filters.pop(topic_filter, None)
+                    logger.debug(f"Client {session.addr} unsubscribed from '{topic_filter}'")
+                await self.send_msg(session.writer, MQTT_UNSUBACK, packet_ident=packid)
+
+            elif msg_type == MQTT_PINGREQ:
+                await self.send_msg(session.writer, MQTT_PINGRESP)
+
+            elif msg_type == MQTT_DISCONNECT:
+                logger.info(f"Client {session.addr} disconnected")
+                return
+
+    # Send queued messages to a client. QoS 1 messages stay in flight until the client acknowledges
+    # them, and are resent every RETRY_INTERVAL until then.
+    async def send_loop(self, session):
+        next_message = None
+        try:
+            while True:
+                if next_message is None and len(session.inflight) < MAX_INFLIGHT:
+                    next_message = asyncio.ensure_future(session.outgoing.get())
+                if next_message is not None:
+                    await asyncio.wait([next_message], timeout=RETRY_INTERVAL / 2)
+                else:
+                    # the window is full until the client acknowledges something
+                    window_open = asyncio.ensure_future(session.window_open.wait())
+                    await asyncio.wait([window_open], timeout=RETRY_INTERVAL / 2)
+                    window_open.cancel()
+                    session.window_open.clear()
+
+                if next_message is not None and next_message.done():
+                    topic, payload, qos = next_message.result()
+                    next_message = None
+                    packid = 0
+                    if qos > 0:
+                        packid = session.next_pack_id()
+                        session.inflight[packid] = [topic, payload, time.monotonic(), 0]
+                    if self.capture is not None:
+                        self.capture.mqtt_out(topic, payload)
+                    await self.send_publish(session.writer, topic, payload, qos, packid)
+
+                await self.retransmit(session)
+        finally:
+            if next_message is not None and next_message.done() and not next_message.cancelled():
+                session.outgoing.put_nowait(next_message.result())
+            elif next_message is not None:
+                next_message.cancel()
+
+    async def retransmit(self, session):
+        now = time.monotonic()
+        for packid, entry in list(session.inflight.items()):
+            topic, payload, sent, retries = entry
+            if now - sent < RETRY_INTERVAL:
+                continue
+            if retries >= MAX_RETRIES:
+                logger.error(f"Client {session.addr} never acknowledged message {packid} on {topic}, giving up")
+                del session.inflight[packid]
+                continue
+            logger.debug("Resending message {} on {} to {}", packid, topic, session.addr)
+            entry[2:] = [now, retries + 1]
+            await self.send_publish(session.writer, topic, payload, 1, packid, dup=True)
+
+    # Messages the client never got or never acknowledged are dropped with a clean session, as they
+    # were meant for that session only (a stale command mustn't reach the printer's next session),
+    # and kept with the client's subscriptions for when it comes back otherwise
+    def end_session(self, session):
+        for topic_filter in session.filters:
+            self.subscriptions.unsubscribe(topic_filter, session)
+        if session.client_id is not None and self.connected_clients.get(session.client_id) == session.addr:
+            del self.connected_clients[session.client_id]
+        pending = [(topic, payload, 1) for topic, payload, *_ in session.inflight.values()]
+        while not session.outgoing.empty():
+            pending.append(session.outgoing.get_nowait())
+        if session.client_id is not None and not session.clean_session:
+            self.stored_sessions[session.client_id] = (dict(session.filters), pending)
+            if pending:
+                logger.info(f"Client {session.client_id} went away, keeping {len(pending)} messages for it")
+        elif pending:
+            logger.warning(f"Client {session.addr} went away with {len(pending)} messages undelivered")
+
+    # Pick up the subscriptions and messages a client left behind when it last disconnected, unless
+    # it asks for a clean session. Returns whether there was a session to pick up.
+    def restore_session(self, session) -> bool:
+        stored = self.stored_sessions.pop(session.client_id, None)
+        if stored is None or session.clean_session:
+            return False
+        filters, pending = stored
+        for topic_filter, qos in filters.items():
+            self.subscriptions.subscribe(topic_filter, session, qos)
+        session.filters.update(filters)
+        self.had_subscriber = True
+        for message in pending:
+            session.outgoing.put_nowait(message)
+        return True
+
+    # Deliver the messages held from before anyone subscribed that a subscriber has turned up for
+    def deliver_held_messages(self):
+        held = list(self.undelivered)
+        self.undelivered.clear()
+        for topic, payload in held:
+            if subscribers := self.subscriptions.match(topic):
+                for session, qos in subscribers.items():
+                    session.outgoing.put_nowait((topic, payload, qos))
+            else:
+                self.undelivered.append((topic, payload))
+
+    async def send_publish(self, writer, topic, payload, qos, packid=0, *, dup=False):
+        flags = qos << 1 | (PUBLISH_DUP if dup else 0)
+        await self.send_msg(writer, MQTT_PUBLISH, flags=flags, payload=self.encode_publish(topic, payload, packid))
 
     async def send_msg(self, writer, msg_type, flags=0, packet_ident=0, payload=b""):
         head = bytes([msg_type << 4 | flags])
@@ -167,59 +421,38 @@ class SimpleMQTTServer:
         if packet_ident > 0:
             head += bytes([packet_ident >> 8, packet_ident & 0xFF])
         data = head + payload
-        # logger.debug(f"    writing {len(data)} bytes: {data}")
         writer.write(data)
         await writer.drain()
 
     def encode_length(self, length):
-        encoded = bytearray()
-        while True:
-            digit = length % 128
-            length //= 128
-            if length > 0:
-                digit |= 0x80
-            encoded.append(digit)
-            if length == 0:
-                break
-        return encoded
+        return encode_length(length)
 
     def decode_length(self, data):
-        multiplier = 1
-        value = 0
-        bytes_read = 0
-
-        for byte in data:
-            bytes_read += 1
-            value += (byte & 0x7F) * multiplier
-            if byte & 0x80 == 0:
-                break
-            multiplier *= 128
-            if multiplier > MAX_FINAL_REMAINING_LENGTH:
-                msg = "Malformed Remaining Length"
-                raise ValueError(msg)
-
-        return value, bytes_read
-
-    def parse_publish(self, data):
-        topic_len = struct.unpack("!H", data[:2])[0]
-        topic = data[2 : 2 + topic_len].decode("utf-8")
-        packid = struct.unpack("!H", data[2 + topic_len : 4 + topic_len])[0]
-        message_start = 4 + topic_len
-        message = data[message_start:].decode("utf-8")
-        return topic, packid, message
-
+        return decode_length(data)
+
+    # The packet identifier is only present in QoS 1 and 2 messages
+    def parse_publish(self, data, qos=1):
+        topic, offset = read_string(data)
+        packid = 0
+        if qos > 0:
+            packid = struct.unpack("!H", data[offset : offset + 2])[0]
+            offset += 2
+        # the payload is left as bytes; cassini.codec decodes it straight into JSON
+        return topic, packid, data[offset:]
+
+    # All (topic filter, requested QoS) pairs of a SUBSCRIBE payload
     def parse_subscribe(self, data):
-        topic_len = struct.unpack("!H", data[:2])[0]
-        return data[2 : 2 + topic_len].decode("utf-8")
+        subscriptions = []
+        offset = 0
+        while offset < len(data):
+            topic_filter, offset = read_string(data, offset)
+            subscriptions.append((topic_filter, data[offset] & 0x3))
+            offset += 1
+        return subscriptions
 
     def encode_publish(self, topic, message, packid=0):
-        topic_len = len(topic)
         topic = topic.encode("utf-8")
-        packid = struct.pack("!H", packid)
-        message = message.encode("utf-8")
-        return struct.pack("!H", topic_len) + topic + packid + message
-
-    def next_pack_id(self):
-        pack_id = self.next_pack_id_value
-        self.next_pack_id_value += 1
-        return pack_id
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        packid = struct.pack("!H", packid) if packid else b""
+        return struct.pack("!H", len(topic)) + topic + packid + message
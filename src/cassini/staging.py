@@ -0,0 +1,103 @@
+"""
+Getting print files off slow storage before a printer asks for them
+
+Before a file is served it is read once to compute its MD5, and ``SimpleHTTPServer.stage_file``
+does that (and builds the file's route) while the printer is still connecting, so the time
+spent reading the file overlaps with the MQTT handshake instead of following it.
+
+``prefetch`` asks the kernel to read the whole file into the page cache
+(``posix_fadvise(POSIX_FADV_WILLNEED)``, or ``madvise(MADV_WILLNEED)`` on a mapping where
+that isn't available), so the reads are queued at once rather than one readahead window at a
+time. For files on network storage, whose cached pages may not outlive the transfer,
+``StagedFileCache`` copies the file to a local cache directory in the same pass that hashes
+it and the printer is served the copy. Copies are named after the file's path, size and
+modification time, so a changed file is copied again, and the least recently used copies
+are removed once the cache grows past ``max_size``.
+"""
+
+import contextlib
+import hashlib
+import mmap
+import os
+import tempfile
+from pathlib import Path
+from typing import Final
+
+from loguru import logger
+
+READ_SIZE: Final[int] = 1024768
+DEFAULT_MAX_SIZE: Final[int] = 8 * 1024 * 1024 * 1024
+
+
+def default_staging_dir() -> Path:
+    if xdg_cache_home := os.environ.get("XDG_CACHE_HOME"):
+        return Path(xdg_cache_home) / "cassini" / "staged"
+    return Path.home() / ".cache" / "cassini" / "staged"
+
+
+# Ask the kernel to start reading all of filename into the page cache; returns without waiting
+def prefetch(filename: Path | str) -> None:
+    with open(filename, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            return
+        if not hasattr(mmap, "MADV_WILLNEED") or os.fstat(f.fileno()).st_size == 0:
+            return
+        with contextlib.suppress(OSError), mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            m.madvise(mmap.MADV_WILLNEED)
+
+
+class StagedFileCache:
+    def __init__(self, cache_dir: Path | str | None = None, max_size: int = DEFAULT_MAX_SIZE):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else default_staging_dir()
+        self.max_size = max_size
+
+    # Return the path and MD5 of the local copy of filename, copying it first if it isn't cached yet
+    def get(self, filename: Path | str) -> tuple[Path, str]:
+        st = os.stat(filename)
+        source = f"{os.path.realpath(filename)}:{st.st_size}:{st.st_mtime_ns}"
+        key = hashlib.sha1(source.encode()).hexdigest()  # noqa: S324
+        suffix = Path(filename).suffix
+        for staged in self.cache_dir.glob(f"{key}-*{suffix}"):
+            logger.debug(f"Using staged copy of {filename}: {staged}")
+            # mark it as recently used
+            os.utime(staged)
+            return staged, staged.name[len(key) + 1 : len(staged.name) - len(suffix)]
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # a temporary file of our own, so another process staging the same file doesn't write into it
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=f"{key}.", suffix=".tmp")
+        md5 = hashlib.md5()  # noqa: S324
+        try:
+            with open(filename, "rb") as src, open(fd, "wb") as dst:
+                while data := src.read(READ_SIZE):
+                    md5.update(data)
+                    dst.write(data)
+            staged = self.cache_dir / f"{key}-{md5.hexdigest()}{suffix}"
+            os.replace(tmp, staged)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp)
+            raise
+        logger.info(f"Staged {filename} ({st.st_size} bytes) to {staged}")
+        self.prune(keep=staged)
+        return staged, md5.hexdigest()
+
+    # Remove the least recently used copies until the cache fits in max_size
+    def prune(self, keep: Path | None = None) -> None:
+        copies = sorted(
+            ((f.stat(), f) for f in self.cache_dir.glob("*-*") if f != keep),
+            key=lambda c: c[0].st_mtime,
+        )
+        total = sum(st.st_size for st, _ in copies) + (keep.stat().st_size if keep is not None else 0)
+        for st, f in copies:
+            if total <= self.max_size:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                f.unlink()
+                logger.debug(f"Removed staged copy {f}")
+            total -= st.st_size
+
+    def clear(self) -> None:
+        for f in self.cache_dir.glob("*-*"):
+            f.unlink()
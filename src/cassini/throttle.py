@@ -0,0 +1,84 @@
+"""
+Bandwidth limiting for file transfers
+
+``TokenBucket`` paces a single stream of bytes. ``FairQueue`` shares one bucket between
+several flows (the routes being served) with self-clocked weighted fair queuing: each
+chunk is tagged with a virtual finish time of ``max(virtual time, flow's last tag) +
+size / weight`` and chunks are let through in tag order, so every active flow gets a
+share of the rate proportional to its weight no matter how fast its client reads.
+"""
+
+import asyncio
+import heapq
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # How long until nbytes can be sent. Chunks larger than the burst size only need a full bucket.
+    def delay_for(self, nbytes: int) -> float:
+        self.refill()
+        missing = min(nbytes, self.burst) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    # Take nbytes from the bucket and return how long to wait before sending them. The bucket is
+    # allowed to go negative so that chunks larger than the burst size still get through.
+    def reserve(self, nbytes: int) -> float:
+        self.refill()
+        self.tokens -= nbytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    async def consume(self, nbytes: int) -> None:
+        if (delay := self.reserve(nbytes)) > 0:
+            await asyncio.sleep(delay)
+
+
+class FairQueue:
+    def __init__(self, rate: float, burst: float | None = None):
+        self.bucket = TokenBucket(rate, burst)
+        self.virtual_time = 0.0
+        self.finish_tags = {}
+        self.waiting = []
+        self.sequence = 0
+        self.dispatcher = None
+
+    async def acquire(self, flow, nbytes: int, weight: float = 1.0) -> None:
+        tag = max(self.virtual_time, self.finish_tags.get(flow, 0.0)) + nbytes / weight
+        self.finish_tags[flow] = tag
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (tag, self.sequence, nbytes, future))
+        self.sequence += 1
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        await future
+
+    # Wait until the bucket can pay for the chunk at the head of the queue before popping it, so that
+    # a chunk with an earlier tag arriving in the meantime goes first
+    async def dispatch(self) -> None:
+        while self.waiting:
+            tag, _, nbytes, future = self.waiting[0]
+            if future.cancelled():
+                heapq.heappop(self.waiting)
+                continue
+            if (delay := self.bucket.delay_for(nbytes)) > 0:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self.waiting)
+            self.bucket.reserve(nbytes)
+            self.virtual_time = tag
+            future.set_result(None)
+            # let the flow that was just served queue its next chunk before picking the next one
+            await asyncio.sleep(0)
+
+    def remove_flow(self, flow) -> None:
+        self.finish_tags.pop(flow, None)
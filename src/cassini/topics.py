@@ -0,0 +1,88 @@
+"""
+MQTT topic filter matching
+
+``TopicTrie`` stores subscriptions one topic level per node, so finding the subscribers of
+a topic walks the trie once per level of the topic (plus the ``+`` and ``#`` branches at
+each level) no matter how many filters are stored. Matching follows MQTT 3.1.1 section
+4.7: ``+`` matches exactly one level, ``#`` matches the parent level and everything below
+it, and wildcards at the first level don't match topics starting with ``$``.
+"""
+
+from typing import Any
+
+
+def valid_filter(topic_filter: str) -> bool:
+    if not topic_filter:
+        return False
+    levels = topic_filter.split("/")
+    for i, level in enumerate(levels):
+        if "#" in level and (level != "#" or i != len(levels) - 1):
+            return False
+        if "+" in level and level != "+":
+            return False
+    return True
+
+
+class TopicNode:
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self):
+        self.children: dict[str, TopicNode] = {}
+        self.subscribers: dict[Any, int] = {}
+
+
+class TopicTrie:
+    def __init__(self):
+        self.root = TopicNode()
+
+    def subscribe(self, topic_filter: str, subscriber, qos: int) -> None:
+        node = self.root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, TopicNode())
+        node.subscribers[subscriber] = qos
+
+    # Returns whether the subscription existed. Branches left empty are pruned.
+    def unsubscribe(self, topic_filter: str, subscriber) -> bool:
+        path = [self.root]
+        levels = topic_filter.split("/")
+        for level in levels:
+            if (node := path[-1].children.get(level)) is None:
+                return False
+            path.append(node)
+        if path[-1].subscribers.pop(subscriber, None) is None:
+            return False
+        for level, parent, node in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:]), strict=True):
+            if node.subscribers or node.children:
+                break
+            del parent.children[level]
+        return True
+
+    # Subscribers of topic with the highest QoS each of their matching filters was granted
+    def match(self, topic: str) -> dict[Any, int]:
+        matches = {}
+        levels = topic.split("/")
+        nodes = [self.root]
+        for i, level in enumerate(levels):
+            following = []
+            for node in nodes:
+                wildcards = not (i == 0 and level.startswith("$"))
+                if wildcards and (multi := node.children.get("#")) is not None:
+                    self.collect(multi, matches)
+                if (child := node.children.get(level)) is not None:
+                    following.append(child)
+                if wildcards and (single := node.children.get("+")) is not None:
+                    following.append(single)
+            if not (nodes := following):
+                return matches
+        for node in nodes:
+            self.collect(node, matches)
+            # "a/#" also matches "a"
+            if (multi := node.children.get("#")) is not None:
+                self.collect(multi, matches)
+        return matches
+
+    @staticmethod
+    def collect(node: TopicNode, matches: dict[Any, int]) -> None:
+        for subscriber, qos in node.subscribers.items():
+            if qos > matches.get(subscriber, -1):
+                matches[subscriber] = qos
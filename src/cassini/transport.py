@@ -0,0 +1,37 @@
+from abc import ABC, abstractmethod
+
+
+class MQTTTransport(ABC):
+    """
+    Carries SDCP messages between SaturnPrinter and printers over MQTT, either as the
+    printer's own MQTT server or through an external broker
+    """
+
+    # Get the printer's messages flowing through this transport; False if that failed
+    @abstractmethod
+    async def attach(self, printer) -> bool:
+        pass
+
+    async def detach(self, printer) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    # Whether the printer's messages are still flowing through this transport, as far as it knows
+    def attached(self, printer) -> bool:  # noqa: ARG002
+        return True
+
+    # Host printers should download files from. None leaves "${ipaddr}" in the URL, which the
+    # printer replaces with the address of its MQTT server: that is us unless it's a broker.
+    def http_host(self) -> str | None:
+        return None
+
+    @abstractmethod
+    def publish(self, topic, payload: bytes | str):
+        pass
+
+    # Next message published by the given printer, as {"topic": ..., "payload": bytes}
+    @abstractmethod
+    async def next_published_message(self, printer_id=None):
+        pass
@@ -1,26 +1,126 @@
+import functools
+import ipaddress
+import os
+import time
+from pathlib import Path
+from typing import Final
+
 from loguru import logger
 
+from cassini.discovery import PrinterRegistry, broadcast_addresses
 from cassini.exceptions import PrintersError
 from cassini.saturn_printer import SaturnPrinter
 
+# how long a resolved printer is reused without asking the network again, and how long a name
+# that couldn't be resolved is remembered as missing
+RESOLVE_TTL: Final[float] = 60.0
+NEGATIVE_RESOLVE_TTL: Final[float] = 30.0
+
+
+def is_ip_address(value: str) -> bool:
+    try:
+        ipaddress.ip_address(value)
+    except ValueError:
+        return False
+    return True
+
+
+# Turns an IP address, MainboardID, Name or alias into a SaturnPrinter. Known printers are asked
+# at their last known address by unicast; the network is only searched when that fails.
+class PrinterResolver:
+    def __init__(
+        self,
+        registry: PrinterRegistry | None = None,
+        ttl: float = RESOLVE_TTL,
+        negative_ttl: float = NEGATIVE_RESOLVE_TTL,
+    ):
+        self.registry = registry if registry is not None else PrinterRegistry(default_registry_path())
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache: dict[str, tuple[SaturnPrinter, float]] = {}
+        self.misses: dict[str, float] = {}
+
+    def resolve(self, target: str) -> SaturnPrinter | None:
+        now = time.monotonic()
+        if (hit := self.cache.get(target)) is not None and hit[1] > now:
+            return hit[0]
+        if self.misses.get(target, 0.0) > now:
+            logger.debug(f"{target} was not found recently, not searching again yet")
+            return None
+
+        printer = self.lookup(target)
+        if printer is None:
+            self.misses[target] = now + self.negative_ttl
+            self.cache.pop(target, None)
+        else:
+            self.misses.pop(target, None)
+            self.cache[target] = (printer, now + self.ttl)
+            self.registry.update([printer])
+        return printer
+
+    def lookup(self, target: str) -> SaturnPrinter | None:
+        if is_ip_address(target):
+            return SaturnPrinter().find_printer(addr=target)
+
+        if (entry := self.registry.find(target)) is not None:
+            printer = SaturnPrinter().find_printer(addr=entry["addr"])
+            if printer is not None and printer.id == entry["id"]:
+                return printer
+            logger.info(f"{target} is no longer at {entry['addr']}, searching the network")
+
+        printers = SaturnPrinter().find_printers()
+        self.registry.update(printers)
+        if (entry := self.registry.find(target)) is None:
+            return None
+        return next((p for p in printers if p.id == entry["id"]), None)
+
+
+# one resolver per process, so long-running commands get the benefit of its caches
+@functools.cache
+def default_resolver() -> PrinterResolver:
+    return PrinterResolver()
+
 
+def resolve_printer(target: str) -> SaturnPrinter | None:
+    return default_resolver().resolve(target)
+
+
+# Find printers to talk to: the one with a given address, MainboardID, Name or alias, the printers answering on an explicit
+# broadcast address, or else every printer answering a broadcast to each local subnet, together with
+# the printers in the registry, which are probed by unicast in the same round so that those on other
+# subnets are found too. Printers that answer go into the registry.
 def get_printers(
     printer: str | None = None,
-    broadcast: str = "<broadcast>",
+    broadcast: str | None = None,
+    registry: PrinterRegistry | None = None,
 ):
+    # without a registry of its own, use the process-wide resolver so its caches carry over between calls
+    resolver = default_resolver() if registry is None else PrinterResolver(registry)
+    registry = resolver.registry
     if printer:
-        printer = SaturnPrinter().find_printer(addr=printer)
-        if printer is None:
+        found = resolver.resolve(printer)
+        if found is None:
             logger.error(f"No response from printer {printer}")
-        printers = [printer]
+            return [None]
+        printers = [found]
     else:
-        printers = SaturnPrinter().find_printers(broadcast=broadcast)
+        targets = [broadcast] if broadcast is not None else [*broadcast_addresses(), *registry.addresses()]
+        printers = SaturnPrinter().find_printers(broadcast=targets)
         if len(printers) == 0:
             logger.error("No printers found on network")
+    registry.update(printers)
     return printers
 
 
-def find_printer_addr(broadcast="<broadcast>") -> str:
+# Probe every local subnet, ignoring the registry, and record everything that answers
+def discover_printers(timeout: float = 1, registry: PrinterRegistry | None = None):
+    registry = registry if registry is not None else PrinterRegistry(default_registry_path())
+    printers = SaturnPrinter().find_printers(timeout=timeout, broadcast=broadcast_addresses())
+    registry.update(printers)
+    return printers
+
+
+def find_printer_addr(broadcast=None) -> str:
     printers = get_printers(broadcast=broadcast)
     match len(printers):
         case 1:
@@ -36,3 +136,21 @@ def find_printer_addr(broadcast="<broadcast>") -> str:
             )
             raise PrintersError(msg)
     return printer_addr
+
+
+def user_data_dir() -> Path:
+    if xdg_data_home := os.environ.get("XDG_DATA_HOME"):
+        return Path(xdg_data_home) / "cassini"
+    return Path.home() / ".local" / "share" / "cassini"
+
+
+def default_history_path() -> Path:
+    return user_data_dir() / "history.sqlite3"
+
+
+def default_queue_path() -> Path:
+    return user_data_dir() / "queue.json"
+
+
+def default_registry_path() -> Path:
+    return user_data_dir() / "printers.json"
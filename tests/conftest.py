@@ -0,0 +1,172 @@
+import asyncio
+import contextlib
+import hashlib
+import socket
+import threading
+import urllib.request
+
+import pytest
+
+from cassini import codec
+from cassini.broker import BrokerTransport
+from cassini.saturn_printer import Command, CurrentStatus, FileStatus, PrintInfoStatus, SaturnPrinter
+from cassini.simple_mqtt_server import SimpleMQTTServer
+
+PRINTER_ID = "ABCD1234ABCD1234"
+
+
+def printer_desc(printer_id=PRINTER_ID, current_status=CurrentStatus.READY):
+    return {
+        "Id": "0a69ee780fbd40d7bfb95b312250bf46",
+        "Data": {
+            "Attributes": {"Name": "Saturn", "MachineName": "Saturn 3 Ultra", "MainboardID": printer_id},
+            "Status": {
+                "CurrentStatus": current_status,
+                "PrintInfo": {"Status": 0, "CurrentLayer": 0, "TotalLayer": 0, "Filename": ""},
+                "FileTransferInfo": {
+                    "Status": FileStatus.NONE,
+                    "DownloadOffset": 0,
+                    "FileTotalSize": 0,
+                    "Filename": "",
+                },
+            },
+        },
+    }
+
+
+@pytest.fixture
+def desc():
+    return printer_desc()
+
+
+@pytest.fixture
+def printer(desc):
+    return SaturnPrinter(addr=("127.0.0.1", 3000), desc=desc, timeout=2)
+
+
+# Stands in for an MQTT broker: everything a client publishes goes to every subscriber
+class LocalBroker(SimpleMQTTServer):
+    def __init__(self):
+        super().__init__("127.0.0.1", 0)
+        self.incoming_messages = self
+
+    def put_nowait(self, message):
+        self.publish(message["topic"], message["payload"])
+
+
+# A printer connected to a broker: it acknowledges every command (with the Ack given in acks, or
+# not at all for commands in ignore), and downloads the files it is told to upload from the URL,
+# replacing ${ipaddr} with the broker's address as printers do. With prints, it reports that it is
+# ready after the download and a print under way when told to start one, and then goes quiet. With
+# fail_at, the first download breaks off after that many bytes; an upload with CleanCache 0
+# continues from there with a Range request.
+class BrokerPrinter:
+    def __init__(self, broker_port, printer_id=PRINTER_ID, *, acks=None, ignore=(), prints=False, fail_at=None):
+        self.id = printer_id
+        self.acks = acks or {}
+        self.ignore = ignore
+        self.prints = prints
+        self.fail_at = fail_at
+        self.partial = b""
+        self.client = BrokerTransport("127.0.0.1", broker_port, client_id=printer_id)
+        self.requests = []
+        self.downloaded = []
+        self.task = None
+
+    async def start(self):
+        await self.client.start()
+        self.client.queues[self.id] = asyncio.Queue()
+        await self.client.subscribe([f"/sdcp/request/{self.id}"])
+        self.task = asyncio.create_task(self.serve())
+
+    async def close(self):
+        self.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.task
+        await self.client.close()
+
+    async def serve(self):
+        while True:
+            message = await self.client.next_published_message(self.id)
+            request = codec.loads(message["payload"])["Data"]
+            self.requests.append(request)
+            if request["Cmd"] in self.ignore:
+                continue
+            self.respond(request)
+            if request["Cmd"] == Command.UPLOAD_FILE:
+                await self.download(request["Data"])
+            elif request["Cmd"] == Command.START_PRINTING and self.prints:
+                status = printer_desc(self.id, CurrentStatus.BUSY)["Data"]["Status"]
+                status["PrintInfo"].update(Status=PrintInfoStatus.EXPOSURE, Filename=request["Data"]["Filename"])
+                # one status to show that the print started, one to show that it is running
+                self.publish_status(status, times=2)
+
+    def publish_status(self, status, times=1):
+        for _ in range(times):
+            self.client.publish(f"/sdcp/status/{self.id}", codec.dumps({"Data": {"Status": status}}))
+
+    def respond(self, request):
+        response = {
+            "Data": {
+                "Cmd": request["Cmd"],
+                "Data": {"Ack": self.acks.get(request["Cmd"], 0)},
+                "RequestID": request["RequestID"],
+            }
+        }
+        self.client.publish(f"/sdcp/response/{self.id}", codec.dumps(response))
+
+    async def download(self, upload):
+        url = upload["URL"].replace("${ipaddr}", self.client.host)
+        request = urllib.request.Request(url)  # noqa: S310
+        if upload["CleanCache"] == 0 and self.partial:
+            request.add_header("Range", f"bytes={len(self.partial)}-")
+        else:
+            self.partial = b""
+        data = self.partial + await asyncio.to_thread(lambda: urllib.request.urlopen(request, timeout=5).read())  # noqa: S310
+        self.downloaded.append((url, data))
+        if self.fail_at is not None:
+            data, self.partial, self.fail_at = data[: self.fail_at], data[: self.fail_at], None
+        ok = hashlib.md5(data).hexdigest() == upload["MD5"]  # noqa: S324
+        status = printer_desc(self.id)["Data"]["Status"]
+        status["FileTransferInfo"] = {
+            "Status": FileStatus.DONE if ok else FileStatus.ERROR,
+            "DownloadOffset": len(data),
+            "FileTotalSize": upload["FileSize"],
+            "Filename": upload["Filename"],
+        }
+        self.publish_status(status, times=2 if self.prints else 1)
+
+
+# Answers UDP status probes like a printer does, after ignoring the first drop probes
+class UdpPrinter:
+    def __init__(self, printer_id=PRINTER_ID, drop=0):
+        self.desc = printer_desc(printer_id)
+        self.drop = drop
+        self.probes = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.addr = self.sock.getsockname()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stopped.set()
+        self.thread.join()
+        self.sock.close()
+
+    def serve(self):
+        self.sock.settimeout(0.05)
+        while not self.stopped.is_set():
+            try:
+                data, addr = self.sock.recvfrom(1024)
+            except TimeoutError:
+                continue
+            if data != b"M99999":
+                continue
+            self.probes += 1
+            if self.probes > self.drop:
+                self.sock.sendto(codec.dumps(self.desc), addr)
@@ -0,0 +1,88 @@
+import asyncio
+import threading
+
+import pytest
+
+from cassini.aio import AsyncFleet, Fleet
+from cassini.exceptions import PrintError
+from cassini.saturn_printer import Command, CurrentStatus
+
+from .conftest import PRINTER_ID, BrokerPrinter, LocalBroker, UdpPrinter, printer_desc
+
+
+def test_async_fleet_refreshes_the_printers_that_answer():
+    async def run(udp, silent):
+        async with AsyncFleet() as fleet:
+            printer = fleet.add(udp.addr, printer_desc())
+            fleet.add(silent.addr, printer_desc("EFGH5678EFGH5678"))
+            assert await fleet.refresh(timeout=1.2) == [printer]
+            return await fleet.statuses(timeout=0.5)
+
+    with UdpPrinter() as udp, UdpPrinter("EFGH5678EFGH5678", drop=100) as silent:
+        udp.desc = printer_desc(current_status=CurrentStatus.BUSY)
+        statuses = asyncio.run(run(udp, silent))
+    assert statuses[PRINTER_ID]["status"] == CurrentStatus.BUSY
+    assert "EFGH5678EFGH5678" in statuses
+
+
+def test_adding_a_known_printer_updates_it():
+    async def run():
+        async with AsyncFleet() as fleet:
+            printer = fleet.add(("127.0.0.1", 3000), printer_desc())
+            again = fleet.add(("127.0.0.2", 3000), printer_desc(current_status=CurrentStatus.BUSY))
+            return fleet, printer, again
+
+    fleet, printer, again = asyncio.run(run())
+    assert again is printer
+    assert len(fleet) == 1
+    assert printer.addr == ("127.0.0.2", 3000)
+    assert printer.printer.busy
+
+
+def test_fleet_serves_several_threads():
+    with UdpPrinter() as udp, Fleet() as fleet:
+        printer = fleet.aio.add(udp.addr, printer_desc())
+        answered = []
+        threads = [threading.Thread(target=lambda: answered.append(fleet.refresh(timeout=1.2))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=5)
+        assert answered == [[printer]] * 4
+        assert fleet.status(printer, timeout=1.2)["status"] == CurrentStatus.READY
+    assert fleet.loop.is_closed()
+    assert not fleet.thread.is_alive()
+
+
+async def fleet_upload(tmp_path, *, start_printing, acks=None):
+    broker = LocalBroker()
+    await broker.start()
+    remote = BrokerPrinter(broker.port, acks=acks, prints=True)
+    await remote.start()
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(b"layer data" * 1000)
+    updates = []
+    try:
+        async with AsyncFleet(timeout=2, broker=f"127.0.0.1:{broker.port}") as fleet:
+            printer = fleet.add(("127.0.0.1", 3000), printer_desc())
+            result = await fleet.upload(printer, filename, start_printing=start_printing, progress=updates.append)
+    finally:
+        await remote.close()
+        await broker.close()
+    return remote, result, updates
+
+
+def test_fleet_uploads_and_starts_the_print(tmp_path):
+    remote, result, updates = asyncio.run(fleet_upload(tmp_path, start_printing=True))
+    assert result == (10000, 10000, "cube.goo")
+    assert updates[-1].done
+    assert not updates[-1].failed
+    commands = [r["Cmd"] for r in remote.requests]
+    assert commands.index(Command.UPLOAD_FILE) < commands.index(Command.START_PRINTING)
+    start = remote.requests[commands.index(Command.START_PRINTING)]
+    assert start["Data"]["Filename"] == "cube.goo"
+
+
+def test_refused_print_is_an_error(tmp_path):
+    with pytest.raises(PrintError):
+        asyncio.run(fleet_upload(tmp_path, start_printing=True, acks={Command.START_PRINTING: 1}))
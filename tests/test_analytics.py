@@ -0,0 +1,94 @@
+import pytest
+
+from cassini.history import StatusHistory
+from cassini.saturn_printer import CurrentStatus, PrintInfoStatus
+
+np = pytest.importorskip("numpy")
+
+from cassini.analytics import (  # noqa: E402
+    PrintClock,
+    analyze_fleet,
+    estimate,
+    layer_durations,
+    print_segments,
+    right_aligned,
+)
+from cassini.commands import do_analytics  # noqa: E402
+
+
+def status(layer, print_status=PrintInfoStatus.EXPOSURE, total=100):
+    return {
+        "CurrentStatus": CurrentStatus.BUSY,
+        "PrintInfo": {
+            "Status": print_status,
+            "CurrentLayer": layer,
+            "TotalLayer": total,
+            "Filename": "cube.goo",
+            "ErrorNumber": 0,
+        },
+    }
+
+
+def test_layer_durations_split_skipped_layers():
+    ts = np.array([0.0, 10.0, 20.0, 40.0])
+    layer = np.array([0.0, 1.0, 2.0, 4.0])
+    layers, durations = layer_durations(ts, layer)
+    assert layers.tolist() == [2, 3, 4]
+    assert durations.tolist() == [10.0, 10.0, 10.0]
+
+
+def test_print_segments():
+    active = PrintInfoStatus.EXPOSURE
+    status_codes = np.array([0, active, active, PrintInfoStatus.COMPLETE, active])
+    assert print_segments(status_codes) == [(1, 3), (4, 5)]
+
+
+def test_right_aligned():
+    matrix = right_aligned([[1.0], [1.0, 2.0]])
+    assert np.isnan(matrix[0, 0])
+    assert matrix[:, -1].tolist() == [1.0, 2.0]
+
+
+def test_estimate_eta_and_stall():
+    result = estimate(
+        [np.full(30, 10.0), np.full(30, 10.0)],
+        current=[50, 50],
+        total=[100, 100],
+        last_change=[995.0, 0.0],
+        printing=[True, True],
+        now=1000.0,
+    )
+    assert result["eta"][0] == pytest.approx(50 * 10.0 - 5.0)
+    assert result["stalled"].tolist() == [False, True]
+
+
+def test_analyze_fleet(tmp_path):
+    with StatusHistory(tmp_path / "history.sqlite3") as history:
+        for i in range(40):
+            history.record("P1", status(i), timestamp=1000.0 + i * 10)
+        history.flush()
+        result = analyze_fleet(history, now=1000.0 + 39 * 10)["P1"]
+    assert result["current_layer"] == 39
+    assert result["layer_time"] == pytest.approx(10.0)
+    assert result["eta"] == pytest.approx(61 * 10.0)
+    assert result["layers_per_hour"] == pytest.approx(360.0)
+    assert not result["stalled"]
+
+
+def test_print_clock():
+    clock = PrintClock()
+    for i in range(10):
+        clock.observe(i, timestamp=i * 5.0)
+    eta, stalled = clock.eta(20, now=45.0)
+    assert eta == pytest.approx(11 * 5.0)
+    assert not stalled
+
+
+def test_analytics_table_without_current_layer(tmp_path):
+    with StatusHistory(tmp_path / "history.sqlite3") as history:
+        for ts in (0.0, 10.0):
+            status = {"Status": PrintInfoStatus.EXPOSURE, "TotalLayer": 100}
+            history.record("P1", {"CurrentStatus": CurrentStatus.BUSY, "PrintInfo": status}, timestamp=ts)
+        table = do_analytics(history, since=0.0)
+    assert table.row_count == 1
+    assert list(table.columns[2].cells) == [""]
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from cassini import saturn_printer
+from cassini.broker import BrokerTransport, parse_broker_address
+from cassini.saturn_printer import Command
+from cassini.servers import create_http_server, create_mqtt_server
+
+from .conftest import PRINTER_ID, BrokerPrinter, LocalBroker
+
+
+def test_parse_broker_address():
+    assert parse_broker_address("mqtt.local") == ("mqtt.local", 1883)
+    assert parse_broker_address("mqtt.local:8883") == ("mqtt.local", 8883)
+
+
+async def through_broker(printer, tmp_path, http_host=None):
+    broker = LocalBroker()
+    await broker.start()
+    remote = BrokerPrinter(broker.port)
+    await remote.start()
+    mqtt, *_ = await create_mqtt_server(broker=f"127.0.0.1:{broker.port}", http_host=http_host)
+    http, *_ = await create_http_server()
+    try:
+        assert await printer.connect(mqtt, http)
+        if http_host is None:
+            filename = tmp_path / "cube.goo"
+            filename.write_bytes(b"layer data" * 1000)
+            assert await printer.upload_file(filename) == (10000, 10000, "cube.goo")
+    finally:
+        await remote.close()
+        await mqtt.close()
+        await http.close()
+        await broker.close()
+    return remote
+
+
+def test_commands_through_broker(printer, tmp_path):
+    remote = asyncio.run(through_broker(printer, tmp_path, http_host="192.0.2.7"))
+    assert [r["Cmd"] for r in remote.requests] == [Command.CMD_0, Command.CMD_1, Command.SET_MYSTERY_TIME_PERIOD]
+    assert all(r["MainboardID"] == PRINTER_ID for r in remote.requests)
+
+
+# The printer would replace ${ipaddr} with the broker's address, so the URL has to name us
+def test_upload_url_names_us_not_the_broker(printer, tmp_path):
+    remote = asyncio.run(through_broker(printer, tmp_path))
+    upload = remote.requests[-1]
+    assert upload["Cmd"] == Command.UPLOAD_FILE
+    assert upload["Data"]["URL"].startswith("http://127.0.0.1:")
+    assert remote.downloaded[0][1] == b"layer data" * 1000
+
+
+def test_explicit_http_host():
+    async def run():
+        broker = LocalBroker()
+        await broker.start()
+        mqtt = BrokerTransport("127.0.0.1", broker.port, http_host="printers.example")
+        await mqtt.start()
+        try:
+            return mqtt.http_host()
+        finally:
+            await mqtt.close()
+            await broker.close()
+
+    assert asyncio.run(run()) == "printers.example"
+
+
+def test_lost_broker_is_noticed(printer):
+    async def run():
+        broker = LocalBroker()
+        await broker.start()
+        mqtt = BrokerTransport("127.0.0.1", broker.port)
+        await mqtt.start()
+        await mqtt.attach(printer)
+        assert mqtt.attached(printer)
+        waiting = asyncio.create_task(mqtt.next_published_message(printer.id))
+        await broker.close()
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(waiting, timeout=1)
+        assert not mqtt.attached(printer)
+        with pytest.raises(ConnectionError):
+            mqtt.publish(f"/sdcp/request/{printer.id}", b"{}")
+        await mqtt.detach(printer)
+        await mqtt.close()
+
+    asyncio.run(run())
+
+
+# The first download breaks off; the retry keeps what the printer has and asks for the rest
+def test_upload_resumes_after_partial_download(printer, tmp_path, monkeypatch):
+    async def run():
+        broker = LocalBroker()
+        await broker.start()
+        remote = BrokerPrinter(broker.port, fail_at=4000)
+        await remote.start()
+        mqtt, *_ = await create_mqtt_server(broker=f"127.0.0.1:{broker.port}")
+        http, *_ = await create_http_server()
+        try:
+            await printer.connect(mqtt, http)
+            filename = tmp_path / "cube.goo"
+            filename.write_bytes(b"layer data" * 1000)
+            assert await printer.upload_file(filename) == (10000, 10000, "cube.goo")
+        finally:
+            await remote.close()
+            await mqtt.close()
+            await http.close()
+            await broker.close()
+        return remote
+
+    monkeypatch.setattr(saturn_printer, "RETRY_DELAY", 0)
+    remote = asyncio.run(run())
+    uploads = [r["Data"] for r in remote.requests if r["Cmd"] == Command.UPLOAD_FILE]
+    assert [u["CleanCache"] for u in uploads] == [1, 0]
+    assert remote.downloaded[-1][1] == b"layer data" * 1000
+
+
+def test_upload_needs_an_attempt(printer, tmp_path):
+    with pytest.raises(ValueError, match="attempts"):
+        asyncio.run(printer.upload_file(tmp_path / "cube.goo", attempts=0))
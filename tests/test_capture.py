@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+from cassini import codec
+from cassini.capture import MQTT_IN, UDP_IN, UDP_OUT, CaptureReplayer, CaptureWriter, capturing, read_capture
+from cassini.history import StatusHistory
+from cassini.saturn_printer import CurrentStatus, SaturnPrinter
+
+from .conftest import PRINTER_ID, UdpPrinter, printer_desc
+
+
+def status_message(current_status):
+    status = printer_desc(current_status=current_status)["Data"]["Status"]
+    return codec.dumps({"Data": {"Status": status}})
+
+
+def test_frames_are_read_back(tmp_path):
+    with CaptureWriter(tmp_path / "capture.bin") as capture:
+        capture.udp_out(("10.0.0.1", 3000), b"M99999")
+        capture.mqtt_in(f"/sdcp/status/{PRINTER_ID}", b"{}")
+    records = list(read_capture(tmp_path / "capture.bin"))
+    assert [(r.kind, r.topic, r.payload) for r in records] == [
+        (UDP_OUT, "10.0.0.1:3000", b"M99999"),
+        (MQTT_IN, f"/sdcp/status/{PRINTER_ID}", b"{}"),
+    ]
+
+
+def test_truncated_record_is_skipped(tmp_path):
+    path = tmp_path / "capture.bin"
+    with CaptureWriter(path) as capture:
+        capture.mqtt_in("/sdcp/status/A", b"{}")
+    path.write_bytes(path.read_bytes() + b"\x00\x01")
+    assert len(list(read_capture(path))) == 1
+
+
+def test_refresh_is_captured(tmp_path):
+    with UdpPrinter() as udp, capturing(tmp_path / "capture.bin"):
+        assert SaturnPrinter(addr=udp.addr, desc=printer_desc()).refresh(timeout=2)
+    assert SaturnPrinter.capture is None
+    assert [r.kind for r in read_capture(tmp_path / "capture.bin")] == [UDP_OUT, UDP_IN]
+
+
+# Status from discovery and from MQTT ends up on the printer and in the history
+def test_replay(tmp_path):
+    path = tmp_path / "capture.bin"
+    with CaptureWriter(path) as capture:
+        capture.udp_in(("10.0.0.1", 3000), codec.dumps(printer_desc()))
+        capture.mqtt_in(f"/sdcp/status/{PRINTER_ID}", status_message(CurrentStatus.BUSY))
+
+    with StatusHistory(tmp_path / "history.sqlite3") as history:
+        replayer = CaptureReplayer(path, history=history)
+        started = time.monotonic()
+        stats = asyncio.run(replayer.replay(speed=0))
+        assert time.monotonic() - started < 1
+        assert history.printers() == [PRINTER_ID]
+    assert (stats["frames"], stats["printers"]) == (2, 1)
+    assert replayer.printers[PRINTER_ID].last_status["CurrentStatus"] == CurrentStatus.BUSY
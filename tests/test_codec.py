@@ -0,0 +1,21 @@
+import pytest
+
+from cassini import codec
+
+from .conftest import printer_desc
+
+
+@pytest.mark.parametrize("wrap", [bytes, bytearray, memoryview, lambda b: b.decode()])
+def test_round_trip(wrap):
+    desc = printer_desc()
+    assert codec.loads(wrap(codec.dumps(desc))) == desc
+
+
+def test_dumps_is_compact_bytes():
+    data = codec.dumps({"Cmd": 0, "Data": None})
+    assert isinstance(data, bytes)
+    assert b" " not in data
+
+
+def test_unicode():
+    assert codec.loads(codec.dumps({"Name": "Würfel ✓"})) == {"Name": "Würfel ✓"}
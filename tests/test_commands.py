@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from cassini import codec, commands
+from cassini.exceptions import PrintError
+from cassini.history import StatusHistory
+from cassini.saturn_printer import Command
+from cassini.scheduler import JobQueue
+
+from .conftest import PRINTER_ID, BrokerPrinter, LocalBroker, printer_desc
+
+
+# Keep hold of the servers a command creates, to check that it closes them
+@pytest.fixture
+def servers(monkeypatch):
+    created = []
+
+    def keeping(create):
+        async def create_and_keep(*args, **kwargs):
+            server, *rest = await create(*args, **kwargs)
+            created.append(server)
+            return (server, *rest)
+
+        return create_and_keep
+
+    monkeypatch.setattr(commands, "create_http_server", keeping(commands.create_http_server))
+    monkeypatch.setattr(commands, "create_mqtt_server", keeping(commands.create_mqtt_server))
+    return created
+
+
+def test_queue_run_closes_its_http_server(printer, tmp_path, servers):
+    async def run():
+        broker = LocalBroker()
+        await broker.start()
+        remote = BrokerPrinter(broker.port)
+        await remote.start()
+        try:
+            await commands.do_queue_run([printer], JobQueue(tmp_path / "queue.json"), broker=f"127.0.0.1:{broker.port}")
+        finally:
+            await remote.close()
+            await broker.close()
+
+    asyncio.run(run())
+    [http] = servers
+    assert http.server is None
+
+
+def test_record_stops_and_closes_when_the_broker_goes_away(tmp_path, servers):
+    async def run(history):
+        broker = LocalBroker()
+        await broker.start()
+        recording = asyncio.create_task(commands.do_record(f"127.0.0.1:{broker.port}", history))
+        while not servers or servers[0].fleet_status is None:
+            await asyncio.sleep(0.01)
+        status = printer_desc()["Data"]["Status"]
+        broker.publish(f"/sdcp/status/{PRINTER_ID}", codec.dumps({"Data": {"Status": status}}))
+        await asyncio.sleep(0.1)
+        await broker.close()
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(recording, timeout=1)
+
+    with StatusHistory(tmp_path / "history.sqlite3") as history:
+        asyncio.run(run(history))
+        assert history.printers() == [PRINTER_ID]
+    [mqtt] = servers
+    assert mqtt.writer is None
+
+
+def upload(printer, tmp_path, **remote_options):
+    async def run():
+        broker = LocalBroker()
+        await broker.start()
+        remote = BrokerPrinter(broker.port, prints=True, **remote_options)
+        await remote.start()
+        filename = tmp_path / "cube.goo"
+        filename.write_bytes(b"layer data" * 1000)
+        try:
+            await commands.do_upload(printer, filename, start_printing=True, broker=f"127.0.0.1:{broker.port}")
+        finally:
+            await remote.close()
+            await broker.close()
+        return remote
+
+    return asyncio.run(run())
+
+
+def test_upload_starts_the_print_on_the_same_connection(printer, tmp_path):
+    remote = upload(printer, tmp_path)
+    sent = [r["Cmd"] for r in remote.requests]
+    assert sent.index(Command.UPLOAD_FILE) < sent.index(Command.START_PRINTING)
+    # connected once, for both
+    assert sent.count(Command.CMD_0) == 1
+    assert remote.requests[sent.index(Command.START_PRINTING)]["Data"]["Filename"] == "cube.goo"
+
+
+def test_upload_reports_a_print_that_did_not_start(printer, tmp_path):
+    with pytest.raises(PrintError):
+        upload(printer, tmp_path, acks={Command.START_PRINTING: 1})
@@ -0,0 +1,25 @@
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+
+from cassini.compression import CompressedFileCache, file_md5
+
+
+def test_compressed_copy_is_cached(tmp_path):
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(b"layer data" * 1000)
+    cache = CompressedFileCache(tmp_path / "cache")
+    compressed = cache.get(filename)
+    assert compressed.name == f"{file_md5(filename)}.gz"
+    assert gzip.decompress(compressed.read_bytes()) == filename.read_bytes()
+    assert cache.get(filename) == compressed
+
+
+def test_concurrent_compression_of_the_same_file(tmp_path):
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(bytes(range(256)) * 4096)
+    caches = [CompressedFileCache(tmp_path / "cache") for _ in range(8)]
+    with ThreadPoolExecutor(8) as pool:
+        copies = list(pool.map(lambda cache: cache.get(filename), caches))
+    assert len(set(copies)) == 1
+    assert gzip.decompress(copies[0].read_bytes()) == filename.read_bytes()
+    assert [f.name for f in (tmp_path / "cache").iterdir()] == [copies[0].name]
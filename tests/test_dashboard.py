@@ -0,0 +1,51 @@
+import io
+import time
+
+from rich.console import Console
+
+from cassini.dashboard import StatusDashboard
+from cassini.saturn_printer import CurrentStatus, SaturnPrinter
+
+from .conftest import UdpPrinter, printer_desc
+
+
+def saturn(printer_id, addr=("127.0.0.1", 3000)):
+    return SaturnPrinter(addr=addr, desc=printer_desc(printer_id))
+
+
+def cells(table, row):
+    return [column._cells[row].plain for column in table.columns]
+
+
+def test_only_changed_rows_are_rewritten():
+    printers = [saturn("A"), saturn("B")]
+    dashboard = StatusDashboard(printers)
+    table = dashboard.render()
+    untouched = [column._cells[0] for column in table.columns]
+
+    printers[1].desc["Data"]["Status"]["CurrentStatus"] = CurrentStatus.BUSY
+    assert dashboard.update(printers[1])
+    assert not dashboard.update(printers[0])
+    assert dashboard.update(saturn("C"), answered=False)
+    assert dashboard.render() is table
+
+    assert [column._cells[0] for column in table.columns] == untouched
+    assert cells(table, 1)[3] == "BUSY"
+    assert len(table.rows) == 3
+    assert table.rows[2].style == "dim"
+    output = io.StringIO()
+    Console(file=output, width=200).print(table)
+    assert "BUSY" in output.getvalue()
+
+
+def test_refreshing_in_the_background():
+    with UdpPrinter() as remote:
+        printer = saturn(remote.desc["Data"]["Attributes"]["MainboardID"], remote.addr)
+        remote.desc["Data"]["Status"]["CurrentStatus"] = CurrentStatus.BUSY
+        dashboard = StatusDashboard([printer])
+        dashboard.render()
+        with dashboard.refreshing([printer], interval=0.5):
+            deadline = time.monotonic() + 2
+            while not dashboard.changed and time.monotonic() < deadline:
+                time.sleep(0.01)
+    assert cells(dashboard.render(), 0)[3] == "BUSY"
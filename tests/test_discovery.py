@@ -0,0 +1,31 @@
+from cassini.discovery import PrinterRegistry
+from cassini.saturn_printer import SaturnPrinter
+
+from .conftest import printer_desc
+
+
+def saturn(printer_id, addr):
+    return SaturnPrinter(addr=(addr, 3000), desc=printer_desc(printer_id))
+
+
+# Two commands each with their own registry on the same file, as with two `discover` runs
+def test_changes_by_another_process_are_kept(tmp_path):
+    first = PrinterRegistry(tmp_path / "printers.json")
+    second = PrinterRegistry(tmp_path / "printers.json")
+    first.update([saturn("A", "10.0.0.1")])
+    second.update([saturn("B", "10.0.0.2")])
+    first.add_alias("A", "left")
+    second.add_alias("B", "right")
+
+    registry = PrinterRegistry(tmp_path / "printers.json")
+    assert sorted(registry.addresses()) == ["10.0.0.1", "10.0.0.2"]
+    assert registry.find("left")["id"] == "A"
+    assert registry.find("right")["id"] == "B"
+
+
+def test_forget_keeps_other_printers(tmp_path):
+    first = PrinterRegistry(tmp_path / "printers.json")
+    first.update([saturn("A", "10.0.0.1")])
+    PrinterRegistry(tmp_path / "printers.json").update([saturn("B", "10.0.0.2")])
+    first.forget("A")
+    assert list(PrinterRegistry(tmp_path / "printers.json").printers) == ["B"]
@@ -0,0 +1,46 @@
+import pytest
+from typer.testing import CliRunner
+
+from cassini.cli import cassini
+from cassini.history import StatusHistory
+
+
+def test_deleted_fields_are_dropped(tmp_path):
+    with StatusHistory(tmp_path / "history.sqlite3") as history:
+        history.record("a", {"PrintInfo": {"CurrentLayer": 1, "Filename": "cube.goo"}}, timestamp=1.0)
+        history.record("a", {"PrintInfo": {"CurrentLayer": 2}}, timestamp=2.0)
+        history.record("a", {"PrintInfo": {"CurrentLayer": 2, "Filename": None}}, timestamp=3.0)
+        snapshots = list(history.snapshots("a"))
+    assert snapshots == [
+        (1.0, {"PrintInfo.CurrentLayer": 1, "PrintInfo.Filename": "cube.goo"}),
+        (2.0, {"PrintInfo.CurrentLayer": 2}),
+        (3.0, {"PrintInfo.CurrentLayer": 2, "PrintInfo.Filename": None}),
+    ]
+
+
+def test_keyframes_replace_the_state(tmp_path):
+    with StatusHistory(tmp_path / "history.sqlite3", keyframe_interval=1) as history:
+        history.record("a", {"Old": 1}, timestamp=1.0)
+        history.record("a", {"Old": 1, "New": 2}, timestamp=2.0)
+        history.record("a", {"New": 3}, timestamp=3.0)
+        assert list(history.snapshots("a"))[-1] == (3.0, {"New": 3})
+
+
+def test_read_only_history(tmp_path):
+    path = tmp_path / "history.sqlite3"
+    with pytest.raises(FileNotFoundError):
+        StatusHistory(path, read_only=True)
+    assert not path.exists()
+
+    with StatusHistory(path) as history:
+        history.record("a", {"CurrentStatus": 1}, timestamp=1.0)
+    with StatusHistory(path, read_only=True) as history:
+        assert history.printers() == ["a"]
+
+
+def test_history_command_without_database(tmp_path):
+    path = tmp_path / "history.sqlite3"
+    result = CliRunner().invoke(cassini, ["history", "--db", str(path)])
+    assert result.exit_code == 1
+    assert "No status history" in result.output
+    assert not path.exists()
@@ -0,0 +1,73 @@
+import asyncio
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+from loguru import logger
+
+from cassini.loop import LoopLagMonitor, reuse_port_supported
+from cassini.servers import create_http_server
+
+
+def test_blocked_loop_is_measured():
+    warnings = []
+    handler = logger.add(warnings.append, level="WARNING")
+    logger.enable("cassini")
+
+    async def run():
+        lag = LoopLagMonitor(interval=0.01, warning=0.05)
+        lag.start()
+        await asyncio.sleep(0.05)
+        time.sleep(0.2)
+        await asyncio.sleep(0.05)
+        lag.stop()
+        return lag.stats()
+
+    try:
+        stats = asyncio.run(run())
+    finally:
+        logger.disable("cassini")
+        logger.remove(handler)
+    assert stats["samples"] > 2
+    assert 0.15 < stats["max"] < 0.5
+    assert stats["mean"] < stats["max"]
+    assert any("Event loop was blocked" in str(w) for w in warnings)
+
+
+def fetch(url):
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:  # noqa: S310
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, b""
+
+
+# Every process serving the port knows every route, and forgets it once it is gone
+@pytest.mark.skipif(not reuse_port_supported(), reason="needs SO_REUSEPORT")
+def test_worker_processes_serve_the_routes(tmp_path):
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(b"layer data" * 100)
+
+    async def run():
+        http, port, _ = await create_http_server(workers=2)
+        try:
+            assert len(http.workers.processes) == 2
+            path, _ = await http.acquire_file(filename, "goo")
+            await http.routes_ready()
+            url = f"http://127.0.0.1:{port}{path}"
+            # new connections each time, so the kernel spreads them over the processes
+            served = await asyncio.gather(*(asyncio.to_thread(fetch, url) for _ in range(20)))
+            http.release_file(path)
+            http.unregister_file_route(path)
+            await http.routes_ready()
+            gone = await asyncio.gather(*(asyncio.to_thread(fetch, url) for _ in range(20)))
+            processes = list(http.workers.processes)
+        finally:
+            await http.close()
+        return served, gone, processes
+
+    served, gone, processes = asyncio.run(run())
+    assert set(served) == {(200, b"layer data" * 100)}
+    assert {status for status, _ in gone} == {404}
+    assert not any(p.is_alive() for p in processes)
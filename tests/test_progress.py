@@ -0,0 +1,34 @@
+import pytest
+
+from cassini.progress import ProgressTracker
+
+
+def test_rate_and_eta(monkeypatch):
+    clock = iter([0.0, 1.0, 2.0])
+    monkeypatch.setattr("cassini.progress.time.monotonic", lambda: next(clock))
+    updates = []
+    tracker = ProgressTracker(updates.append)
+    tracker.update(0, 1000, "cube.goo")
+    tracker.update(100, 1000, "cube.goo")
+    last = tracker.update(300, 1000, "cube.goo")
+    # 100 B/s, then 200 B/s smoothed in
+    assert last.rate == pytest.approx(0.3 * 200 + 0.7 * 100)
+    assert last.eta == pytest.approx(700 / last.rate)
+    assert last.fraction == pytest.approx(0.3)
+    assert updates[-1] is last
+    assert updates[0].eta is None
+
+
+def test_finish():
+    tracker = ProgressTracker()
+    tracker.update(10, 1000, "cube.goo")
+    done = tracker.finish(1000, "cube.goo")
+    assert (done.offset, done.done, done.failed, done.eta) == (1000, True, False, 0.0)
+
+
+def test_failed_transfer_keeps_its_last_offset():
+    tracker = ProgressTracker()
+    tracker.update(400, 1000, "cube.goo")
+    failed = tracker.finish(1000, "cube.goo", failed=True)
+    assert (failed.offset, failed.done, failed.failed, failed.eta) == (400, True, True, None)
+    assert tracker.latest is failed
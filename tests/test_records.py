@@ -0,0 +1,40 @@
+import csv
+import io
+import json
+
+from cassini.records import RECORD_FIELDS, OutputFormat, RecordWriter
+from cassini.saturn_printer import SaturnPrinter
+
+from .conftest import printer_desc
+
+
+def saturn(printer_id, addr):
+    printer = SaturnPrinter(addr=(addr, 3000), desc=printer_desc(printer_id))
+    printer.desc["Data"]["Status"]["PrintInfo"].update(CurrentLayer=12, TotalLayer=100, Filename="cube.goo")
+    return printer
+
+
+def test_ndjson_records():
+    stream = io.BytesIO()
+    writer = RecordWriter(OutputFormat.NDJSON, stream)
+    writer.write([saturn("A", "10.0.0.1"), saturn("B", "10.0.0.2")])
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(r["id"], r["addr"], r["layer"], r["filename"]) for r in records] == [
+        ("A", "10.0.0.1", 12, "cube.goo"),
+        ("B", "10.0.0.2", 12, "cube.goo"),
+    ]
+    assert all(list(r) == list(RECORD_FIELDS) for r in records)
+    # every record of one write has the same time
+    assert records[0]["time"] == records[1]["time"]
+
+
+def test_csv_header_is_written_once():
+    stream = io.BytesIO()
+    writer = RecordWriter(OutputFormat.CSV, stream)
+    writer.write([saturn("A", "10.0.0.1")])
+    writer.write([saturn("A", "10.0.0.1")])
+    rows = list(csv.reader(io.StringIO(stream.getvalue().decode())))
+    assert rows[0] == list(RECORD_FIELDS)
+    assert len(rows) == 3
+    assert rows[1][RECORD_FIELDS.index("id")] == "A"
+    assert rows[2][RECORD_FIELDS.index("total_layers")] == "100"
@@ -0,0 +1,34 @@
+from concurrent.futures import Future
+
+import pytest
+
+pytest.importorskip("flask")
+
+
+@pytest.fixture
+def rpp(tmp_path, monkeypatch):
+    # rpp creates its upload folder in the working directory when it is imported
+    monkeypatch.chdir(tmp_path)
+    from cassini.rpp import rpp  # noqa: PLC0415
+
+    return rpp
+
+
+def finished(result=None, exception=None):
+    upload = Future()
+    if exception is not None:
+        upload.set_exception(exception)
+    else:
+        upload.set_result(result)
+    return upload
+
+
+def test_progress_of_failed_upload(rpp):
+    rpp.upload_finished("cube.goo", finished(exception=ConnectionError("printer went away")))
+    response = rpp.app.test_client().get("/progress/cube.goo")
+    assert response.json == {"progress": rpp.UPLOAD_FAILED, "error": "printer went away"}
+
+
+def test_progress_of_finished_upload(rpp):
+    rpp.upload_finished("cube.goo", finished())
+    assert rpp.app.test_client().get("/progress/cube.goo").json == {"progress": 100}
@@ -0,0 +1,26 @@
+import pytest
+
+from cassini.rtt import MAX_RTO, MIN_RTO, RttEstimator
+
+
+def test_first_sample():
+    rtt = RttEstimator()
+    rtt.sample(0.1)
+    assert rtt.srtt == 0.1
+    assert rtt.rttvar == 0.05
+    assert rtt.rto == pytest.approx(0.3)
+
+
+def test_steady_rtt_converges_to_the_minimum():
+    rtt = RttEstimator()
+    for _ in range(100):
+        rtt.sample(0.001)
+    assert rtt.srtt == pytest.approx(0.001)
+    assert rtt.rto == MIN_RTO
+
+
+def test_backoff_doubles_up_to_the_maximum():
+    rtt = RttEstimator(initial_rto=1.0)
+    assert [rtt.backoff() for _ in range(4)] == [2.0, 4.0, MAX_RTO, MAX_RTO]
+    rtt.sample(0.1)
+    assert rtt.rto < 1.0
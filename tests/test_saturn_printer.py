@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from cassini.exceptions import UploadError
+from cassini.saturn_printer import Command, CurrentStatus, SaturnPrinter
+from cassini.servers import create_http_server, create_mqtt_server
+
+from .conftest import BrokerPrinter, LocalBroker, UdpPrinter, printer_desc
+
+
+def test_refresh_resends_lost_probes():
+    with UdpPrinter(drop=1) as udp:
+        udp.desc = printer_desc(current_status=CurrentStatus.BUSY)
+        printer = SaturnPrinter(addr=udp.addr, desc=printer_desc())
+        assert printer.refresh(timeout=3)
+        assert udp.probes == 2
+    assert printer.busy
+    assert printer.last_status["CurrentStatus"] == CurrentStatus.BUSY
+
+
+def test_refresh_all_returns_the_printers_that_answered():
+    with UdpPrinter() as udp, UdpPrinter(drop=100) as silent:
+        printers = [SaturnPrinter(addr=a.addr, desc=printer_desc()) for a in (udp, silent)]
+        assert SaturnPrinter.refresh_all(printers, timeout=1.2) == printers[:1]
+        assert silent.probes > 1
+
+
+def upload_progress(printer, tmp_path, updates, **remote_options):
+    async def run():
+        broker = LocalBroker()
+        await broker.start()
+        remote = BrokerPrinter(broker.port, **remote_options)
+        await remote.start()
+        mqtt, *_ = await create_mqtt_server(broker=f"127.0.0.1:{broker.port}")
+        http, *_ = await create_http_server()
+        filename = tmp_path / "cube.goo"
+        filename.write_bytes(b"layer data" * 1000)
+        try:
+            assert await printer.connect(mqtt, http)
+            async for update in printer.upload_progress(filename):
+                updates.append(update)
+        finally:
+            await remote.close()
+            await mqtt.close()
+            await http.close()
+            await broker.close()
+
+    asyncio.run(run())
+
+
+def test_upload_progress_ends_with_the_finished_transfer(printer, tmp_path):
+    updates = []
+    upload_progress(printer, tmp_path, updates)
+    assert [u.done for u in updates] == [False] * (len(updates) - 1) + [True]
+    assert (updates[-1].offset, updates[-1].total, updates[-1].failed) == (10000, 10000, False)
+
+
+def test_failed_upload_is_raised_after_its_last_progress(printer, tmp_path):
+    updates = []
+    with pytest.raises(UploadError):
+        upload_progress(printer, tmp_path, updates, acks={Command.UPLOAD_FILE: 1})
+    assert updates[-1].done
+    assert updates[-1].failed
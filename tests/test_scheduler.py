@@ -0,0 +1,128 @@
+import asyncio
+import subprocess
+import sys
+
+from cassini.scheduler import ASSIGNED, DONE, FAILED, PRINTING, QUEUED, STAGED, FleetScheduler, JobQueue
+
+from .conftest import BrokerPrinter, LocalBroker
+
+
+def test_shared_jobs_after_own_jobs(tmp_path):
+    queue = JobQueue(tmp_path / "queue.json")
+    shared = queue.add(tmp_path / "a.goo")
+    own = queue.add(tmp_path / "b.goo", "P1")
+    assert queue.claim("P1")["id"] == own["id"]
+    assert queue.claim("P2")["id"] == shared["id"]
+    assert queue.claim("P2") is None
+
+
+# `queue add` and a running `queue run` each have their own JobQueue on the same file
+def test_jobs_added_by_another_process_are_seen_and_kept(tmp_path):
+    running = JobQueue(tmp_path / "queue.json")
+    first = running.add(tmp_path / "a.goo")
+    job = running.claim("P1")
+
+    JobQueue(tmp_path / "queue.json").add(tmp_path / "b.goo")
+    running.update(job, state=DONE)
+    assert running.claim("P1")["id"] == first["id"] + 1
+
+    states = {j["id"]: j["state"] for j in JobQueue(tmp_path / "queue.json").jobs}
+    assert states == {first["id"]: DONE, first["id"] + 1: ASSIGNED}
+
+
+def test_unstarted_jobs_are_requeued(tmp_path):
+    queue = JobQueue(tmp_path / "queue.json")
+    queue.add(tmp_path / "a.goo")
+    queue.claim("P1", "host:1:run")
+    queue = JobQueue(tmp_path / "queue.json")
+    assert queue.jobs[0]["state"] == ASSIGNED
+    queue.requeue_unstarted("host:1:run")
+    assert queue.jobs[0]["state"] == QUEUED
+    assert queue.jobs[0]["assigned_to"] is None
+
+
+# Another `queue run` working through the same file keeps its jobs; only our own go back
+def test_only_own_jobs_are_given_back(tmp_path):
+    queue = JobQueue(tmp_path / "queue.json")
+    for name in ("a.goo", "b.goo", "c.goo"):
+        queue.add(tmp_path / name)
+    ours, theirs, printing = (queue.claim("P1", run) for run in ("host:1:ours", "host:2:theirs", "host:1:ours"))
+    queue.update(theirs, state=STAGED)
+    queue.update(printing, state=PRINTING)
+    queue.requeue_unstarted("host:1:ours")
+    states = {j["id"]: (j["state"], j["error"]) for j in JobQueue(tmp_path / "queue.json").jobs}
+    assert states == {
+        ours["id"]: (QUEUED, None),
+        theirs["id"]: (STAGED, None),
+        printing["id"]: (FAILED, "queue run stopped during the print"),
+    }
+
+
+def test_jobs_of_dead_runs_are_recovered(tmp_path):
+    queue = JobQueue(tmp_path / "queue.json")
+    queue.add(tmp_path / "a.goo")
+    queue.add(tmp_path / "b.goo")
+    alive = FleetScheduler(queue, []).run_id
+    queue.claim("P1", alive)
+    dead = subprocess.Popen([sys.executable, "-c", ""])
+    dead.wait()
+    queue.claim("P2", f"{alive.split(':')[0]}:{dead.pid}:dead")
+    queue.recover_abandoned()
+    assert [j["state"] for j in JobQueue(tmp_path / "queue.json").jobs] == [ASSIGNED, QUEUED]
+
+
+def test_clear_finished(tmp_path):
+    queue = JobQueue(tmp_path / "queue.json")
+    queue.add(tmp_path / "a.goo")
+    queue.update(queue.claim("P1"), state=DONE)
+    queue.add(tmp_path / "b.goo")
+    assert queue.clear_finished() == 1
+    assert [j["state"] for j in JobQueue(tmp_path / "queue.json").jobs] == [QUEUED]
+
+
+# The printer takes the file and then goes quiet: its job goes back to the queue and the run ends
+def test_silent_printer_gives_its_job_back(printer, tmp_path):
+    async def run():
+        broker = LocalBroker()
+        await broker.start()
+        remote = BrokerPrinter(broker.port)
+        await remote.start()
+        filename = tmp_path / "cube.goo"
+        filename.write_bytes(b"layer data")
+        queue = JobQueue(tmp_path / "queue.json")
+        queue.add(filename)
+        try:
+            await FleetScheduler(queue, [printer], broker=f"127.0.0.1:{broker.port}").run()
+        finally:
+            await remote.close()
+            await broker.close()
+        return remote
+
+    printer.timeout = 0.2
+    remote = asyncio.run(run())
+    assert remote.downloaded
+    job = JobQueue(tmp_path / "queue.json").jobs[0]
+    assert (job["state"], job["assigned_to"]) == (QUEUED, None)
+
+
+# The printer starts the print and then goes quiet: the print can't be followed any more
+def test_silent_printer_fails_its_print(printer, tmp_path):
+    async def run():
+        broker = LocalBroker()
+        await broker.start()
+        remote = BrokerPrinter(broker.port, prints=True)
+        await remote.start()
+        filename = tmp_path / "cube.goo"
+        filename.write_bytes(b"layer data")
+        queue = JobQueue(tmp_path / "queue.json")
+        queue.add(filename)
+        try:
+            await FleetScheduler(queue, [printer], broker=f"127.0.0.1:{broker.port}").run()
+        finally:
+            await remote.close()
+            await broker.close()
+
+    printer.timeout = 0.2
+    asyncio.run(run())
+    job = JobQueue(tmp_path / "queue.json").jobs[0]
+    assert (job["state"], job["error"]) == (FAILED, "printer stopped responding")
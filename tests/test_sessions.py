@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+import pytest
+
+from cassini.saturn_printer import Command, SaturnPrinter
+from cassini.scheduler import FleetScheduler, JobQueue
+from cassini.sessions import SessionPool
+
+from .conftest import BrokerPrinter, LocalBroker, printer_desc
+
+
+async def with_remote(run, **remote_options):
+    broker = LocalBroker()
+    await broker.start()
+    remote = BrokerPrinter(broker.port, **remote_options)
+    await remote.start()
+    try:
+        return await run(f"127.0.0.1:{broker.port}")
+    finally:
+        await remote.close()
+        await broker.close()
+
+
+def test_session_is_reused(printer):
+    async def run(broker):
+        async with SessionPool(broker=broker) as pool:
+            first = await pool.get(printer)
+            second = await pool.get(printer)
+            return first is second
+
+    assert asyncio.run(with_remote(run))
+
+
+@pytest.mark.parametrize("remote_options", [{"acks": {Command.CMD_1: 1}}, {"ignore": {Command.CMD_0}}])
+def test_failed_handshake_raises_connection_error(printer, remote_options):
+    async def run(broker):
+        async with SessionPool(broker=broker) as pool:
+            with pytest.raises(ConnectionError):
+                await pool.get(printer)
+            return pool.attached(printer)
+
+    printer.timeout = 0.2
+    assert not asyncio.run(with_remote(run, **remote_options))
+
+
+# A printer rejecting the handshake is left out instead of ending the queue run
+def test_scheduler_survives_rejected_handshake(printer, tmp_path):
+    async def run(broker):
+        queue = JobQueue(tmp_path / "queue.json")
+        await FleetScheduler(queue, [printer], broker=broker).run()
+
+    asyncio.run(with_remote(run, acks={Command.CMD_0: 1}))
+
+
+# A printer that doesn't answer holds up its own checkout only
+def test_printers_connect_in_parallel(printer):
+    other = SaturnPrinter(addr=("127.0.0.2", 3000), desc=printer_desc("SLOWSLOWSLOWSLOW"), timeout=1)
+
+    async def run():
+        broker = LocalBroker()
+        await broker.start()
+        remotes = [BrokerPrinter(broker.port), BrokerPrinter(broker.port, other.id, ignore={Command.CMD_0})]
+        for remote in remotes:
+            await remote.start()
+        try:
+            async with SessionPool(broker=f"127.0.0.1:{broker.port}") as pool:
+                slow = asyncio.ensure_future(pool.get(other))
+                await asyncio.sleep(0.05)
+                started = time.monotonic()
+                await pool.get(printer)
+                fast = time.monotonic() - started
+                with pytest.raises(ConnectionError):
+                    await slow
+                return fast
+        finally:
+            for remote in remotes:
+                await remote.close()
+            await broker.close()
+
+    assert asyncio.run(run()) < 0.5
+
+
+def test_idle_sessions_are_closed(printer):
+    async def run(broker):
+        async with SessionPool(broker=broker, idle_timeout=0.1) as pool:
+            await pool.get(printer)
+            await asyncio.sleep(0.3)
+            return pool.sessions
+
+    assert asyncio.run(with_remote(run)) == {}
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+
+from loguru import logger
+
+from cassini import simple_http_server
+from cassini.simple_http_server import SimpleHTTPServer, parse_range
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-99", 1000) == (0, 100)
+    assert parse_range("bytes=900-", 1000) == (900, 1000)
+    assert parse_range("bytes=-100", 1000) == (900, 1000)
+    assert parse_range("bytes=1000-", 1000) == (-1, -1)
+    assert parse_range("items=0-1", 1000) is None
+
+
+async def with_server(run):
+    http = SimpleHTTPServer("127.0.0.1", 0, route_ttl=0.05)
+    await http.start()
+    try:
+        return await run(http)
+    finally:
+        await http.close()
+
+
+def test_same_file_is_hashed_once(tmp_path, monkeypatch):
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(b"layer data")
+    hashed = []
+
+    async def run(http):
+        make_route = http.make_route
+        monkeypatch.setattr(http, "make_route", lambda *args: hashed.append(args) or make_route(*args))
+        first, _ = await http.acquire_file(filename, "goo")
+        second, route = await http.acquire_file(filename, "goo")
+        return first, second, route
+
+    first, second, route = asyncio.run(with_server(run))
+    assert first == second == f"/{hashlib.md5(b'layer data').hexdigest()}.goo"  # noqa: S324
+    assert route["refs"] == 2
+    assert len(hashed) == 1
+
+
+# A copy of the file under another name shares the route, and isn't hashed again next time
+def test_same_content_shares_a_route(tmp_path, monkeypatch):
+    original = tmp_path / "cube.goo"
+    original.write_bytes(b"layer data")
+    copy = tmp_path / "copy.goo"
+    copy.write_bytes(b"layer data")
+    hashed = []
+
+    async def run(http):
+        make_route = http.make_route
+        monkeypatch.setattr(http, "make_route", lambda *args: hashed.append(args) or make_route(*args))
+        paths = [(await http.acquire_file(f, "goo"))[0] for f in (original, copy, copy)]
+        return paths, http.routes[paths[0]]["refs"]
+
+    paths, refs = asyncio.run(with_server(run))
+    assert len(set(paths)) == 1
+    assert refs == 3
+    assert len(hashed) == 2
+
+
+def test_acquire_registered_route(tmp_path):
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(b"layer data")
+
+    async def run(http):
+        route = await http.register_file_route(f"/{hashlib.md5(b'layer data').hexdigest()}.goo", filename)  # noqa: S324
+        path, _ = await http.acquire_file(filename, "goo")
+        http.release_file(path)
+        await asyncio.sleep(0.1)
+        # the registration still holds it
+        return http.routes.get(path) is route
+
+    assert asyncio.run(with_server(run))
+
+
+def test_released_route_expires(tmp_path):
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(b"layer data")
+
+    async def run(http):
+        path, _ = await http.acquire_file(filename, "goo")
+        http.release_file(path)
+        await asyncio.sleep(0.1)
+        return http.routes, http.shared_files
+
+    assert asyncio.run(with_server(run)) == ({}, {})
+
+
+def test_idle_connection_is_closed_quietly(monkeypatch):
+    monkeypatch.setattr(simple_http_server, "KEEP_ALIVE_TIMEOUT", 0.05)
+    errors = []
+    handler = logger.add(errors.append, level="ERROR")
+    logger.enable("cassini")
+
+    async def run(http):
+        reader, writer = await asyncio.open_connection("127.0.0.1", http.port)
+        data = await asyncio.wait_for(reader.read(), timeout=1)
+        writer.close()
+        return data
+
+    try:
+        assert asyncio.run(with_server(run)) == b""
+    finally:
+        logger.disable("cassini")
+        logger.remove(handler)
+    assert errors == []
+
+
+# A body cut short (here the file shrank after its route was made) leaves the client waiting for
+# bytes that never come, so the connection can't be kept for another request
+def test_short_transfer_closes_the_connection(tmp_path):
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(b"x" * 1000)
+
+    async def run(http):
+        path, _ = await http.acquire_file(filename, "goo")
+        filename.write_bytes(b"x" * 100)
+        reader, writer = await asyncio.open_connection("127.0.0.1", http.port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: printer\r\n\r\n".encode())
+        data = await asyncio.wait_for(reader.read(), timeout=1)
+        writer.close()
+        return data
+
+    head, body = asyncio.run(with_server(run)).split(b"\r\n\r\n", 1)
+    assert b"Content-Length: 1000" in head
+    assert body == b"x" * 100
+
+
+def test_stats_of_a_route_removed_during_a_transfer_are_dropped(tmp_path):
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(b"x" * 65536 * 3)
+
+    async def run(http):
+        # the first chunk goes at once, the other two take about a second
+        http.connection_rate_limit = 100_000
+        path, _ = await http.acquire_file(filename, "goo")
+        reader, writer = await asyncio.open_connection("127.0.0.1", http.port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: printer\r\nConnection: close\r\n\r\n".encode())
+        for _ in range(100):
+            if http.stats.get(path, {}).get("active") == 1:
+                break
+            await asyncio.sleep(0.01)
+        http.unregister_file_route(path)
+        stats_during_transfer = dict(http.stats)
+        data = await asyncio.wait_for(reader.read(), timeout=5)
+        writer.close()
+        await asyncio.sleep(0.05)
+        return path, stats_during_transfer, len(data), http.stats
+
+    path, during, received, after = asyncio.run(with_server(run))
+    assert path in during
+    assert received > 65536 * 3
+    assert after == {}
@@ -0,0 +1,142 @@
+import asyncio
+import struct
+
+from cassini.broker import mqtt_string
+from cassini.simple_mqtt_server import (
+    MQTT_CONNACK,
+    MQTT_CONNECT,
+    MQTT_PUBLISH,
+    MQTT_SUBACK,
+    MQTT_SUBSCRIBE,
+    SimpleMQTTServer,
+    encode_length,
+    read_packet,
+)
+
+TOPIC = "/sdcp/request/ABCD1234ABCD1234"
+
+
+class Client:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, server, client_id="printer", clean=True):
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        client = cls(reader, writer)
+        variable_header = mqtt_string("MQTT") + bytes([4, 0x02 if clean else 0]) + struct.pack("!H", 60)
+        client.send(MQTT_CONNECT, 0, variable_header + mqtt_string(client_id))
+        msg_type, _, body = await client.read()
+        assert msg_type == MQTT_CONNACK
+        client.session_present = bool(body[0] & 1)
+        return client
+
+    def send(self, msg_type, flags, payload):
+        self.writer.write(bytes([msg_type << 4 | flags]) + encode_length(len(payload)) + payload)
+
+    async def read(self):
+        return await asyncio.wait_for(read_packet(self.reader), timeout=1)
+
+    async def subscribe(self, *topics):
+        self.send(MQTT_SUBSCRIBE, 0x2, struct.pack("!H", 1) + b"".join(mqtt_string(t) + b"\x01" for t in topics))
+        msg_type, _, _ = await self.read()
+        assert msg_type == MQTT_SUBACK
+
+    # The next PUBLISH, left unacknowledged
+    async def received(self):
+        topic, _, payload = await self.received_with_id()
+        return topic, payload
+
+    async def received_with_id(self):
+        msg_type, _, body = await self.read()
+        assert msg_type == MQTT_PUBLISH
+        topic_len = struct.unpack("!H", body[:2])[0]
+        packid = struct.unpack("!H", body[2 + topic_len : 4 + topic_len])[0]
+        return body[2 : 2 + topic_len].decode(), packid, body[4 + topic_len :]
+
+    async def close(self):
+        self.writer.close()
+        await asyncio.sleep(0.05)
+
+
+async def with_server(run):
+    server = SimpleMQTTServer("127.0.0.1", 0)
+    await server.start()
+    try:
+        return await run(server)
+    finally:
+        await server.close()
+
+
+def test_message_published_before_subscription_is_held():
+    async def run(server):
+        server.publish(TOPIC, b"hello")
+        client = await Client.connect(server)
+        await client.subscribe(TOPIC)
+        return await client.received()
+
+    assert asyncio.run(with_server(run)) == (TOPIC, b"hello")
+
+
+# A command the printer never acknowledged mustn't reach it again in its next session, but one sent
+# while it was away is held for it
+def test_clean_session_messages_are_dropped_on_disconnect():
+    async def run(server):
+        client = await Client.connect(server)
+        await client.subscribe(TOPIC)
+        server.publish(TOPIC, b"start printing")
+        await client.received()
+        await client.close()
+        server.publish(TOPIC, b"sent while away")
+        client = await Client.connect(server)
+        await client.subscribe(TOPIC)
+        server.publish(TOPIC, b"new session")
+        return [await client.received(), await client.received()], list(server.undelivered)
+
+    assert asyncio.run(with_server(run)) == ([(TOPIC, b"sent while away"), (TOPIC, b"new session")], [])
+
+
+def test_persistent_session_is_restored():
+    async def run(server):
+        client = await Client.connect(server, clean=False)
+        await client.subscribe(TOPIC)
+        server.publish(TOPIC, b"unacknowledged")
+        await client.received()
+        await client.close()
+        client = await Client.connect(server, clean=False)
+        return client.session_present, await client.received()
+
+    present, (topic, payload) = asyncio.run(with_server(run))
+    assert present
+    assert (topic, payload) == (TOPIC, b"unacknowledged")
+
+
+def test_subscribe_without_filters_closes_the_connection():
+    async def run(server):
+        client = await Client.connect(server)
+        client.send(MQTT_SUBSCRIBE, 0x2, struct.pack("!H", 1))
+        return await client.reader.read()
+
+    assert asyncio.run(with_server(run)) == b""
+
+
+# Packet ids wrap around per client and skip those of messages the client hasn't acknowledged yet
+def test_packet_ids_skip_unacknowledged_messages():
+    async def run(server):
+        first = await Client.connect(server, "first")
+        await first.subscribe(TOPIC)
+        server.publish(TOPIC, b"one")
+        _, unacknowledged, _ = await first.received_with_id()
+        [session] = server.sessions
+        session.next_pack_id_value = 0xFFFF
+        server.publish(TOPIC, b"two")
+        server.publish(TOPIC, b"three")
+        ids = [unacknowledged] + [(await first.received_with_id())[1] for _ in range(2)]
+        second = await Client.connect(server, "second")
+        await second.subscribe(TOPIC)
+        server.publish(TOPIC, b"four")
+        await first.received_with_id()
+        return ids, (await second.received_with_id())[1]
+
+    assert asyncio.run(with_server(run)) == ([1, 0xFFFF, 2], 1)
@@ -0,0 +1,61 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from cassini.staging import StagedFileCache, prefetch
+
+
+def test_prefetch(tmp_path):
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(b"layer data")
+    prefetch(filename)
+    (tmp_path / "empty.goo").touch()
+    prefetch(tmp_path / "empty.goo")
+
+
+def test_copy_is_made_once(tmp_path):
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(b"layer data")
+    cache = StagedFileCache(tmp_path / "staged")
+    staged, md5 = cache.get(filename)
+    assert md5 == hashlib.md5(b"layer data").hexdigest()  # noqa: S324
+    assert staged.read_bytes() == b"layer data"
+    assert staged.suffix == ".goo"
+    assert cache.get(filename) == (staged, md5)
+
+
+def test_changed_file_is_copied_again(tmp_path):
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(b"layer data")
+    cache = StagedFileCache(tmp_path / "staged")
+    first, _ = cache.get(filename)
+    filename.write_bytes(b"other layer data")
+    second, md5 = cache.get(filename)
+    assert second != first
+    assert md5 == hashlib.md5(b"other layer data").hexdigest()  # noqa: S324
+
+
+def test_concurrent_staging_of_the_same_file(tmp_path):
+    filename = tmp_path / "cube.goo"
+    filename.write_bytes(bytes(range(256)) * 4096)
+    caches = [StagedFileCache(tmp_path / "staged") for _ in range(8)]
+    with ThreadPoolExecutor(8) as pool:
+        copies = list(pool.map(lambda cache: cache.get(filename), caches))
+    assert len(set(copies)) == 1
+    assert copies[0][0].read_bytes() == filename.read_bytes()
+    assert [f.name for f in (tmp_path / "staged").iterdir()] == [copies[0][0].name]
+
+
+def test_least_recently_used_copies_are_pruned(tmp_path):
+    cache = StagedFileCache(tmp_path / "staged", max_size=25)
+    staged = []
+    for i in range(3):
+        filename = tmp_path / f"cube{i}.goo"
+        filename.write_bytes(b"0123456789")
+        path, _ = cache.get(filename)
+        # make the copies' ages distinct
+        os.utime(path, (i, i))
+        staged.append(path)
+    assert [p.exists() for p in staged] == [False, True, True]
+    cache.clear()
+    assert not any(p.exists() for p in staged)
@@ -0,0 +1,41 @@
+import asyncio
+import time
+
+import pytest
+
+from cassini.throttle import FairQueue, TokenBucket
+
+
+def test_token_bucket_burst_then_rate():
+    bucket = TokenBucket(rate=1000, burst=1000)
+    assert bucket.reserve(1000) == 0.0
+    assert bucket.reserve(500) == pytest.approx(0.5, abs=0.01)
+    assert bucket.delay_for(100) == pytest.approx(0.6, abs=0.01)
+
+
+def test_chunks_larger_than_the_burst_only_need_a_full_bucket():
+    bucket = TokenBucket(rate=1000, burst=100)
+    assert bucket.delay_for(10000) == 0.0
+
+
+# Two flows sending as fast as they can share the rate in proportion to their weights
+def test_fair_queue_weights():
+    async def run():
+        queue = FairQueue(rate=400_000, burst=10_000)
+        sent = {"light": 0, "heavy": 0}
+
+        async def flow(name, weight):
+            while True:
+                await queue.acquire(name, 10_000, weight)
+                sent[name] += 10_000
+
+        tasks = [asyncio.create_task(flow("light", 1.0)), asyncio.create_task(flow("heavy", 3.0))]
+        started = time.monotonic()
+        await asyncio.sleep(0.5)
+        for task in tasks:
+            task.cancel()
+        return sent, time.monotonic() - started
+
+    sent, elapsed = asyncio.run(run())
+    assert sent["heavy"] / sent["light"] == pytest.approx(3, rel=0.3)
+    assert sum(sent.values()) / elapsed == pytest.approx(400_000, rel=0.25)
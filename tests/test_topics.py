@@ -0,0 +1,55 @@
+import pytest
+
+from cassini.topics import TopicTrie, valid_filter
+
+
+@pytest.mark.parametrize(
+    ("topic_filter", "valid"),
+    [
+        ("/sdcp/status/+", True),
+        ("sport/#", True),
+        ("#", True),
+        ("", False),
+        ("sport/#/ranking", False),
+        ("sport+", False),
+        ("sport/ten#", False),
+    ],
+)
+def test_valid_filter(topic_filter, valid):
+    assert valid_filter(topic_filter) is valid
+
+
+@pytest.mark.parametrize(
+    ("topic_filter", "topic", "matches"),
+    [
+        ("/sdcp/status/+", "/sdcp/status/ABCD", True),
+        ("/sdcp/status/+", "/sdcp/status/ABCD/more", False),
+        ("/sdcp/#", "/sdcp/status/ABCD", True),
+        ("sport/#", "sport", True),
+        ("+/+", "/finance", True),
+        ("+", "/finance", False),
+        ("#", "$SYS/info", False),
+        ("+/info", "$SYS/info", False),
+        ("$SYS/#", "$SYS/info", True),
+    ],
+)
+def test_match(topic_filter, topic, matches):
+    trie = TopicTrie()
+    trie.subscribe(topic_filter, "client", 1)
+    assert bool(trie.match(topic)) is matches
+
+
+def test_highest_qos_of_overlapping_filters():
+    trie = TopicTrie()
+    trie.subscribe("/sdcp/#", "a", 0)
+    trie.subscribe("/sdcp/status/+", "a", 1)
+    trie.subscribe("/sdcp/status/ABCD", "b", 0)
+    assert trie.match("/sdcp/status/ABCD") == {"a": 1, "b": 0}
+
+
+def test_unsubscribe_prunes_empty_branches():
+    trie = TopicTrie()
+    trie.subscribe("/sdcp/status/ABCD", "a", 1)
+    assert trie.unsubscribe("/sdcp/status/ABCD", "a")
+    assert not trie.unsubscribe("/sdcp/status/ABCD", "a")
+    assert trie.root.children == {}
@@ -0,0 +1,31 @@
+from cassini import utils
+from cassini.discovery import PrinterRegistry
+from cassini.saturn_printer import SaturnPrinter
+from cassini.utils import PrinterResolver, default_resolver, get_printers
+
+from .conftest import printer_desc
+
+
+def test_get_printers_reuses_the_default_resolver(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path))
+    lookups = []
+    monkeypatch.setattr(PrinterResolver, "lookup", lambda _, target: lookups.append(target))
+    default_resolver.cache_clear()
+    try:
+        assert get_printers(printer="nowhere") == [None]
+        # remembered as missing, so the network isn't searched again
+        assert get_printers(printer="nowhere") == [None]
+    finally:
+        default_resolver.cache_clear()
+    assert lookups == ["nowhere"]
+
+
+# A new printer only answers the broadcast, a known printer on another subnet only its unicast probe
+def test_get_printers_broadcasts_and_asks_known_printers(tmp_path, monkeypatch):
+    registry = PrinterRegistry(tmp_path / "printers.json")
+    registry.update([SaturnPrinter(addr=("10.9.0.5", 3000), desc=printer_desc("KNOWN"))])
+    probed = []
+    monkeypatch.setattr(utils, "broadcast_addresses", lambda: ["192.168.1.255"])
+    monkeypatch.setattr(SaturnPrinter, "find_printers", lambda _, broadcast: probed.extend(broadcast) or [])
+    get_printers(registry=registry)
+    assert probed == ["192.168.1.255", "10.9.0.5"]